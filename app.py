@@ -1,7 +1,12 @@
-from flask import Flask, render_template, request
-from myEphem import Ephem
+from flask import Flask, render_template, request, Response, stream_with_context
+from myEphem import MoonSprites
 # from myContec import Contec
 from myDatabase import DB
+from myControl import Controller
+from myEvents import EventBus
+from myDevice import open_devices, open_analog
+from myExport import Exporter, FORMATS
+from mySampler import Sampler
 import json
 import random
 from time import sleep
@@ -9,7 +14,7 @@ import datetime
 import configparser
 import os
 import subprocess as sp
-import numpy as np
+import threading
 
 """
 import RPi.GPIO as GPIO
@@ -38,12 +43,63 @@ def getTime():
     return dt.strftime("%Y/%m/%d %H:%M:%S")
 
 
-"""
-contec = Contec()                   # コンテックのクラス
-"""
 db = DB()                           # データベースのクラス
+contec, humi_sensor, simulator = open_devices()     # コンテックと温湿度計（AGRI_DEVICE=simならシミュレーター）
+events = EventBus()                 # 画面へのプッシュ配信
+db.add_listener(lambda table, date: events.publish("graph", {"table": table, "date": date}))     # グラフの描き直しを知らせる
+analog = open_analog(simulator)     # MCP3004の連続取り込み（使えなければNone）
+if analog is not None:
+    analog.add_listener(db.set_analog)                      # 1分ごとの平均をDBに残す
+controller = Controller(db, contec, events, analog=analog)     # 育成LEDの制御ループ
+
+
+def on_config(values, changed):
+    global sensing_count
+    sensing_count = int(values["sensing_count"])    # 光センサー計測リセット回数（トライ用のgetContec）
+
+db.config.subscribe(on_config, ["sensing_count"])   # 設定が変わったら知らされる
+sampler = Sampler(humi_sensor) if humi_sensor is not None else None    # 温湿度計はバックグラウンドで読む
+
+
+def on_humi(latest):
+    """
+    温湿度計が読めたときに1回だけDBに書き込み、画面に知らせる
+    """
+    db.set_temperature(latest["temp"], latest["humi"])
+    events.publish("humi", latest)
+
+if sampler is not None:
+    sampler.add_listener(on_humi)
+    sampler.start()
+moon_sprites = MoonSprites(float(os.environ.get("AGRI_MOON_STEP", 0.25)))     # 月の画像（月齢の刻みは日単位）
+
+
+def warm_up():
+    """
+    グラフと月の画像に使う重いモジュール（matplotlib、OpenCV）を読み込んでおく
+    AGRI_STARTUP=warm のときだけ、起動の後にバックグラウンドで行う（既定のlazyでは最初に使うときに読み込む）
+    """
+    db.figures
+    moon_sprites.prerender()
+
+if os.environ.get("AGRI_STARTUP", "lazy") == "warm":
+    threading.Thread(target=warm_up, name="warm_up", daemon=True).start()
 
 app = Flask(__name__)
+use_reloader = True                 # python app.py で動かすときデバッグのリローダーを使うか
+
+
+def start_controller():
+    """
+    制御ループを始める　flask run・gunicorn・リローダーなしの直接実行のどれでも、アプリを作ったときに始まる
+    デバッグのリローダーの親プロセス（python app.py で子プロセスを立ち上げるだけの方）では始めない
+    Controller.startは既に動いていれば何もしないので、何度呼んでも一つだけ
+    """
+    if __name__ == "__main__" and use_reloader and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+        return
+    controller.start()
+
+start_controller()
 
 @app.route("/")
 def index():
@@ -98,42 +154,127 @@ def showDairyGraph():
         return json.dumps(result)
 
 
+# 一日グラフのデータ（ブラウザで描画する）
+@app.route("/getDailyData", methods=["POST"])
+def getDailyData():
+    if request.method == "POST":
+        date = request.form.get("date")             # 日付の指定がなければ今日
+        return json.dumps(db.get_daily_data(date))
+
+
+# サマリーグラフのデータ（ブラウザで描画する）
+@app.route("/getSummaryData", methods=["POST"])
+def getSummaryData():
+    if request.method == "POST":
+        return json.dumps(db.get_summary_data())
+
+
+# テーブルの書き出し（CSV / NDJSON）　少しずつ送るので大きな期間でもメモリは一定
+# 例: /export?table=temperature&from=2024/01/01&to=2024/12/31&format=ndjson&gzip=1
+@app.route("/export")
+def export():
+    exporter = Exporter(db)
+    table = request.args.get("table", "temperature")
+    date_from = request.args.get("from")            # 期間の指定がなければ全部
+    date_to = request.args.get("to")
+    format = request.args.get("format", "csv")
+    compress = request.args.get("gzip") in ["1", "true"]
+    with db.pool.connection() as conn:
+        tables = exporter.tables(conn)
+    if table not in tables or format not in FORMATS:
+        return Response(json.dumps({"error": "table または format が違います", "tables": tables}), status=400,
+                        mimetype="application/json")
+    filename = exporter.filename(table, date_from, date_to, format, compress)
+    return Response(stream_with_context(exporter.export(table, date_from, date_to, format, compress)),
+                    mimetype="application/gzip" if compress else FORMATS[format],
+                    headers={"Content-Disposition": f"attachment; filename={filename}",
+                             "X-Accel-Buffering": "no"})
+
+
+# 古い生データをアーカイブに移す
+@app.route("/archiveDB", methods=["POST"])
+def archiveDB():
+    if request.method == "POST":
+        days = int(request.form.get("days", 90))    # SQLiteに残す日数
+        return json.dumps(db.archive_old(days))
+
+
+# 長い期間の気温と点灯時間（ロールアップから）
+@app.route("/getRange", methods=["POST"])
+def getRange():
+    if request.method == "POST":
+        date_from = request.form["from"]
+        date_to = request.form["to"]
+        max_points = int(request.form.get("points", 500))
+        return json.dumps(db.get_range(date_from, date_to, max_points))
+
+
+# グラフキャッシュのヒット・ミスと描画時間
+@app.route("/getGraphStats", methods=["POST"])
+def getGraphStats():
+    if request.method == "POST":
+        return json.dumps(db.graph_cache.stats())
+
+
 # 暦
 @app.route("/getEphem", methods = ["POST"])
 def getEphem():
     try:
-        ephem = Ephem(db.ephem_config)              # 設定をもとにephemを作成する
-        dict = ephem.get_data()                     # データを辞書として取得する
+        dict = db.get_ephem()                       # 1年分の暦の表から今日の分を引く
         db.set_ephem(dict)
+        dict["moon_image"] = moon_sprites.url(dict["moon_phase"])  # 月の画像のURL
     except Exception as e:
         message = str(e)
         dict = {"error": message}                   # エラーメッセージ
     return json.dumps(dict)                         # 辞書をJSONにして返す
 
 
+# 月の画像　月齢の刻みごとに描いておいたPNGをETag付きで返す
+@app.route("/moon/<key>.png")
+def moon(key):
+    sprite = moon_sprites.get(key)
+    if sprite is None:
+        return Response(status=404)
+    png, etag = sprite
+    response = Response(png, mimetype="image/png")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400                          # 同じキーの画像は変わらない
+    return response.make_conditional(request)
+
+
 # 温湿度計
 @app.route("/getHumi", methods=["POST"])
 def getHumi():
     if request.method == "POST":
         is_try = request.form["isTry"]
-        if is_try=="true":                          # トライならば
-            temp = random.randint(30, 60)
-            humi = random.randint(60, 90)
+        if is_try=="true":                          # トライならば（表示するだけで書き込まない）
+            dict = {"temp": random.randint(30, 60),
+                    "humi": random.randint(60, 90)}
+        elif sampler is None:                       # 温湿度計がなければ
+            dict = {"temp": -1,
+                    "humi": -1}
         else:                                       # 本番ならば
-            print("本番")
-            for i in range(10):                     # センサー値取得失敗するかもしれないので10回ループする
-                result = humi_sensor.read()
-                if result.is_valid():                   # センサー値取得できたら
-                    temp = round(result.temperature, 1) # 温度 小数第一位まで
-                    humi = round(result.humidity, 1)    # 湿度 小数第一位まで
-                    break                               # ループから抜ける
-                else:                                   # 10回ループしても駄目なら
-                    temp = -1
-                    humi = -1                           # ありえない値を湿度に登録する
-        imgB64 = db.set_temperature(temp, humi)
-        dict = {"temp": temp,
-                "humi": humi,
-                "imgB64": imgB64}
+            dict = sampler.latest()                 # 最後に読めた値と経過秒数（古すぎれば-1）
+        return json.dumps(dict)                     # 書き込みと配信は読めたときにon_humiが行う
+
+
+# 温湿度計の読み取りの成否と、最後の読み取りのタイミング
+@app.route("/getHumiStats", methods=["POST"])
+def getHumiStats():
+    if request.method == "POST":
+        if humi_sensor is None:
+            return json.dumps({})
+        return json.dumps(dict(humi_sensor.stats(), sampler=sampler.stats(), latest=sampler.latest()))
+
+
+# バッテリーの電圧と残量　直近の値とその日の1分ごとの値
+@app.route("/getBatt", methods=["POST"])
+def getBatt():
+    if request.method == "POST":
+        date = request.form.get("date") or datetime.date.today().strftime("%Y/%m/%d")
+        dict = {"latest": analog.latest() if analog is not None else None,
+                "series": db.get_battery(date, date)}
         return json.dumps(dict)
 
 
@@ -144,7 +285,7 @@ def enpowerLED():
         is_On = int(request.form["isOn"])
         is_try = request.form["isTry"]
         print("is_On=" , is_On)
-        imgB64 = db.set_LED(is_On)
+        db.set_LED(is_On)
         if is_On:
             # print("育成LEDオン")
             if is_try != "true":                    # 本番ならば
@@ -155,22 +296,17 @@ def enpowerLED():
             if is_try != "true":                    # 本番ならば
                 contec.output(False)
             pass
-        return json.dumps({"imgB64": imgB64})
+        return json.dumps({"result": "OK"})
 
 
 # 設定DB 読み込み
 @app.route("/getConfig", methods=["POST"])
 def getConfig():
-    global sensing_count
     if request.method == "POST":
-        dict = db.get_config()                              # データベースから設定を読み込む
-        # コンテックの設定はリストにして登録する
-        arr = []
-        for i in [1, 2, 3, 4]:
-            arr.append(int(dict[f"output{i}"]))
-#        contec.define_output_relays(arr)
-        sensing_count = int(dict["sensing_count"])
-        return json.dumps(dict)
+        values, version = db.config.snapshot()              # メモリの設定（読み込みはDBを見ない）
+        response = Response(json.dumps(dict(values)))
+        response.headers["X-Config-Version"] = str(version)
+        return response
 
 # 設定DB 書き込み
 @app.route("/setConfig", methods=["POST"])
@@ -199,7 +335,7 @@ def setConfig():
                 "isLEDTry": request.form["isLEDTry"],
                 "isNightSense": request.form["isNightSense"],
                 }
-        db.set_config(dict)
+        db.set_config(dict)                         # 変わった設定は制御ループなどにも知らされる
         
         # コンテックリレー出力設定を変更する
         arr = []
@@ -217,8 +353,14 @@ def setConfig():
 def delDB():
     if request.method == "POST":
         del_date = request.form["date"]
-        db.delete(del_date)
-    return json.dumps({"result":"OK"})
+        return json.dumps(db.purge(del_date))      # バックグラウンドで少しずつ削除する
+
+
+# データベース削除の進み具合
+@app.route("/getPurgeProgress", methods=["POST"])
+def getPurgeProgress():
+    if request.method == "POST":
+        return json.dumps(db.retention.progress())
 
 
 # コンテック（光センサー＋バッテリー）
@@ -270,6 +412,33 @@ def getContec():
         return json.dumps(dict)
 
 
+# 画面へのプッシュ配信（Server-Sent Events）
+# 制御ループの状態・温湿度・グラフの描き直しをイベントとして送り続ける
+@app.route("/stream")
+def stream():
+    initial = [("control", controller.state())]     # つないだ時点の状態を最初に送る
+    return Response(events.stream(initial), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# 制御ループの状態（プッシュ配信を受けられないときのポーリング用）
+@app.route("/getControl", methods=["POST"])
+def getControl():
+    if request.method == "POST":
+        since = int(request.form.get("since", 0))   # 画面が受け取り済みのメッセージ番号
+        return json.dumps(controller.state(since))
+
+
+# 制御盤の操作（起動・停止・自動/各個・各個での強制点灯）
+@app.route("/setControl", methods=["POST"])
+def setControl():
+    if request.method == "POST":
+        action = request.form["action"]
+        since = int(request.form.get("since", 0))
+        controller.command(action)
+        return json.dumps(controller.state(since))
+
+
 # OSの時刻を設定する
 @app.route("/setClock", methods=["POST"])
 def setClock():
@@ -280,5 +449,5 @@ def setClock():
         return json.dumps({"response": "done"})
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=use_reloader)
     # app.run(debug=True)
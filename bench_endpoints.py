@@ -0,0 +1,247 @@
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import mySchema
+import myRollup
+
+"""
+Flaskのルートのベンチマーク
+1日・1か月・1年・5年分の1分ごとのデータ（temperature、light、contec）を入れた合成のagri.dbを作り、
+大きさごとに新しいPythonで app を読み込んで、テストクライアントからトライモードで各ルートを叩く
+ルートごとの応答時間（1回目、p50・p90・p99・最大）と最大RSSを表示し、結果のJSONL（既定は results/bench_endpoints.jsonl）に
+1行ずつ追記して前回と比べる
+合成のデータベースは一時ディレクトリに作って使い回す（日付が変わったら作り直す）　機器はシミュレーター（AGRI_DEVICE=sim）
+    python bench_endpoints.py [回数] [大きさ,...] [結果のJSONL]
+    大きさは day, month, year, 5years（既定は全部）
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZES = {"day": 1, "month": 30, "year": 365, "5years": 1826}           # 大きさの名前 → 日数
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "agri_bench")           # 合成のデータベースを置く場所
+HISTORY = os.path.join(HERE, "results", "bench_endpoints.jsonl")        # 結果を追記するファイル（results/はgitで無視する）
+BATCH_DAYS = 30                                                         # 何日分ずつ書き込むか
+
+# 新しいPythonで app を読み込んで各ルートを叩き、結果をJSONで出す
+PROBE = """
+import json, resource, sys, time
+import numpy as np
+start = time.perf_counter()
+import app
+import_s = time.perf_counter() - start
+client = app.app.test_client()
+count = {count}
+routes = [("/getHumi", lambda i: {{"isTry": "true"}}),
+          ("/enpowerLED", lambda i: {{"isOn": str(i % 2), "isTry": "true"}}),
+          ("/getSummaryTable", lambda i: {{}}),
+          ("/showSummaryGraph", lambda i: {{}}),
+          ("/showDairyGraph", lambda i: {{}}),
+          ("/getEphem", lambda i: {{}})]
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def call(route, data):
+    t = time.perf_counter()
+    r = client.post(route, data=data)
+    elapsed = (time.perf_counter() - t) * 1000
+    if r.status_code != 200:
+        raise RuntimeError(f"{{route}}: {{r.status_code}}")
+    return elapsed
+
+def summarize(ms):
+    ms = np.array(ms)
+    return {{"n": len(ms), "first_ms": round(float(ms[0]), 2), "mean_ms": round(float(ms.mean()), 2),
+            **{{f"p{{p}}_ms": round(float(np.percentile(ms, p)), 2) for p in [50, 90, 99]}},
+            "max_ms": round(float(ms.max()), 2)}}
+
+results = {{}}
+for route, form in routes:
+    ms = [call(route, form(i)) for i in range(count)]
+    results[route] = dict(summarize(ms), maxrss_mb=round(maxrss_mb(), 1))
+
+# /delDB は古い半分の削除をバックグラウンドで始めるだけなので、削除中のほかのルートの応答も測って止める
+ms = [call("/delDB", {{"date": "{del_date}"}})]
+during = [call(route, form(i)) for i in range(count) for route, form in routes[:1] + routes[4:5]]
+progress = app.db.retention.progress()
+app.db.retention.cancel()
+if app.db.retention.thread is not None:
+    app.db.retention.thread.join(timeout=60)
+results["/delDB"] = dict(summarize(ms), maxrss_mb=round(maxrss_mb(), 1), deleted=progress["deleted"],
+                         total=progress["total"], during=summarize(during))
+app.db.close()
+print(json.dumps({{"import_s": import_s, "maxrss_mb": round(maxrss_mb(), 1), "routes": results}}))
+"""
+
+
+def minutes_of(date_from, days):
+    """
+    date_fromから days日分の1分ごとの時刻（今より先は含めない）
+    """
+    start = datetime.datetime.combine(date_from, datetime.time())
+    count = min(days * 1440, int((datetime.datetime.now() - start).total_seconds() // 60) + 1)
+    return [start + datetime.timedelta(minutes=i) for i in range(count)]
+
+
+def synthetic_rows(dts, rng):
+    """
+    1分ごとの合成データ
+    気温は1日の周期と1年の周期の正弦波に雑音、育成LEDは朝と夕方に点灯、コンテックは8入力のビット列
+    Returns:
+        (temperature, light, contec)　それぞれ書き込む行のリスト
+    """
+    minute = np.array([dt.hour * 60 + dt.minute for dt in dts])
+    yday = np.array([dt.timetuple().tm_yday for dt in dts])
+    temp = 15 - 10 * np.cos(2 * np.pi * (yday - 20) / 365) - 5 * np.cos(2 * np.pi * (minute - 240) / 1440)
+    temp = np.round(temp + rng.normal(0, 0.5, len(dts)), 1)
+    humi = np.round(np.clip(70 + rng.normal(0, 8, len(dts)), 20, 99), 1)
+    led = ((minute >= 300) & (minute < 390)) | ((minute >= 1020) & (minute < 1110))
+    bits = rng.integers(0, 2, (len(dts), 8))
+    bits[:, :5] |= led[:, None]                                         # 点灯中は光センサーもオン
+    temperature, light, contec = [], [], []
+    for i, dt in enumerate(dts):
+        strdt = dt.strftime("%Y/%m/%d %H:%M")
+        date, epoch = strdt[:10], int(dt.timestamp())
+        temperature.append((date, strdt, float(temp[i]), float(humi[i]), epoch))
+        light.append((date, strdt, int(led[i]), epoch))
+        contec.append((date, strdt, "".join(map(str, bits[i])), epoch))
+    return temperature, light, contec
+
+
+def generate(path, days, seed=0):
+    """
+    合成のデータベースを作る（今日までの days日分）
+    サマリーとロールアップは生データからSQLで作る　設定は同梱のagri.dbのものに、累計の始点を最初の日にする
+    """
+    rng = np.random.default_rng(seed)
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    mySchema.migrate(conn)                                              # 空のテーブルを最新のスキーマで作る
+    first = datetime.date.today() - datetime.timedelta(days=days - 1)
+    for offset in range(0, days, BATCH_DAYS):
+        dts = minutes_of(first + datetime.timedelta(days=offset), min(BATCH_DAYS, days - offset))
+        temperature, light, contec = synthetic_rows(dts, rng)
+        conn.executemany("INSERT INTO temperature(date, datetime, temperature, humidity, epoch) VALUES(?, ?, ?, ?, ?)",
+                         temperature)
+        conn.executemany("INSERT INTO light(date, datetime, value, epoch) VALUES(?, ?, ?, ?)", light)
+        conn.executemany("INSERT INTO contec(date, datetime, rawdata, epoch) VALUES(?, ?, ?, ?)", contec)
+        conn.commit()
+    conn.execute("INSERT INTO summary(date, sunrise_time, sunset_time, lighting_minutes,"
+                    " max_temp, min_temp, mean_temp, temp_count, temp_sum)"
+                    " SELECT t.date, '06:00', '17:00', l.minutes, MAX(t.temperature), MIN(t.temperature),"
+                    " (MAX(t.temperature)+MIN(t.temperature))/2, COUNT(t.temperature), TOTAL(t.temperature)"
+                    " FROM temperature t JOIN (SELECT date, SUM(value) AS minutes FROM light GROUP BY date) l"
+                    " ON l.date=t.date GROUP BY t.date")
+    myRollup.Rollup().rebuild(conn)
+    shipped = os.path.join(HERE, "agri.db")
+    if os.path.exists(shipped):                                         # 設定は同梱のagri.dbから写す
+        conn.execute("ATTACH DATABASE ? AS shipped", (shipped,))
+        conn.execute('INSERT OR REPLACE INTO config("index", "value") SELECT "index", "value" FROM shipped.config')
+        conn.commit()
+        conn.execute("DETACH DATABASE shipped")
+    conn.execute('INSERT OR REPLACE INTO config("index", "value") VALUES(\'cumsum_date\', ?)',
+                 (first.strftime("%Y/%m/%d"),))                         # 累計は最初の日から（いちばん重い場合）
+    conn.commit()
+    conn.close()
+    os.replace(tmp, path)
+
+
+def database(name, days):
+    """
+    大きさごとの合成のデータベース（今日の分がなければ作る）
+    Returns:
+        (パス, 作るのにかかった秒数かNone)
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"agri_{name}_{datetime.date.today():%Y%m%d}.db")
+    if os.path.exists(path):
+        return path, None
+    for old in os.listdir(CACHE_DIR):                                   # 前の日に作ったものは消す
+        if old.startswith(f"agri_{name}_"):
+            os.remove(os.path.join(CACHE_DIR, old))
+    start = time.perf_counter()
+    generate(path, days)
+    return path, time.perf_counter() - start
+
+
+def probe(path, days, count, env):
+    """
+    データベースのコピーで1回分の計測をする（/delDBで中身が変わるので毎回コピーする）
+    """
+    del_date = (datetime.date.today() - datetime.timedelta(days=days // 2)).strftime("%Y/%m/%d")
+    with tempfile.TemporaryDirectory() as workdir:
+        shutil.copy(path, os.path.join(workdir, "agri.db"))
+        shutil.copy(os.path.join(HERE, "config.ini"), workdir)
+        result = subprocess.run([sys.executable, "-c", PROBE.format(count=count, del_date=del_date)],
+                                cwd=workdir, env=env, capture_output=True, text=True, timeout=3600)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    """
+    今のコミット（比べるときの目印）
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def previous(history):
+    """
+    結果のJSONLから、大きさごとにいちばん新しい結果（前回の結果）
+    """
+    last = {}
+    if os.path.exists(history):
+        with open(history, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    last.update(json.loads(line)["results"])
+    return last
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    names = sys.argv[2].split(",") if len(sys.argv) > 2 else list(SIZES)
+    history = sys.argv[3] if len(sys.argv) > 3 else HISTORY
+    os.makedirs(os.path.dirname(os.path.abspath(history)), exist_ok=True)
+    env = dict(os.environ, AGRI_DEVICE="sim", PYTHONPATH=HERE + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    last = previous(history)
+    results = {}
+    for name in names:
+        path, generated = database(name, SIZES[name])
+        if generated is not None:
+            print(f"{name}: 合成のデータベースを作りました　{generated:.1f}秒")
+        result = probe(path, SIZES[name], count, env)
+        result.update(days=SIZES[name], db_mb=round(os.path.getsize(path) / 1024**2, 1))
+        results[name] = result
+        print(f"{name}: {SIZES[name]}日分 {result['db_mb']}MB  import {result['import_s']*1000:.0f}ms"
+              f"  最大RSS {result['maxrss_mb']}MB")
+        for route, r in result["routes"].items():
+            before = last.get(name, {}).get("routes", {}).get(route, {}).get("p50_ms")
+            change = f"  前回 {before}ms ({r['p50_ms']/before:.2f}倍)" if before else ""
+            print(f"    {route:18s} 1回目 {r['first_ms']:9.2f}ms  p50 {r['p50_ms']:8.2f}ms  p90 {r['p90_ms']:8.2f}ms"
+                  f"  p99 {r['p99_ms']:8.2f}ms  最大RSS {r['maxrss_mb']:7.1f}MB{change}")
+        during = result["routes"]["/delDB"]["during"]
+        print(f"    {'(削除中)':18s} p50 {during['p50_ms']:8.2f}ms  p99 {during['p99_ms']:8.2f}ms"
+              f"  削除 {result['routes']['/delDB']['deleted']}/{result['routes']['/delDB']['total']}行")
+    with open(history, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"time": datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"), "commit": git_commit(),
+                            "python": sys.version.split()[0], "count": count, "results": results},
+                           ensure_ascii=False) + "\n")
+    print(f"{history} に追記しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import datetime
+import os
+import resource
+import sys
+import time
+import warnings
+import logging
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from myFigure import Figures, fig2str64
+
+"""
+グラフ描画のベンチマーク
+ひな形を使い回す描画（今の方式）と、毎回plt.subplotsで作る描画（以前の方式）を同じ回数だけ繰り返し、
+1回あたりの時間とメモリ（RSS）の増え方を比べる
+    python bench_figure.py [回数] [template|legacy|both]
+"""
+
+warnings.filterwarnings("ignore")
+logging.getLogger("matplotlib").setLevel(logging.ERROR)             # フォントがない警告を黙らせる
+
+DPI = 72
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def rss_kb():
+    """
+    現在のRSS（KB）　/procがなければ最大RSSで代用する
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_KB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def sample_day():
+    """
+    1日分のダミーデータ（10分ごと）
+    """
+    dt_0 = datetime.datetime(2023, 11, 25)
+    x = [dt_0 + datetime.timedelta(minutes=10*i) for i in range(144)]
+    temp = [round(20 + 8*np.sin(i/23), 1) for i in range(144)]
+    light = [1 if 100 <= i < 130 else 0 for i in range(144)]
+    times = {"dt_0": dt_0,
+             "dt_24": dt_0 + datetime.timedelta(days=1),
+             "dt_sunrise": dt_0.replace(hour=6, minute=1),
+             "dt_sunset": dt_0.replace(hour=17, minute=14),
+             "dt_now": dt_0.replace(hour=21)}
+    return x, temp, light, times
+
+
+def render_template(figures, i, x, temp, light, times):
+    """
+    ひな形による描画（DB.render_daily_temp_graph などと同じ呼び方）
+    """
+    y = [t + i % 5 for t in temp]
+    figures.daily_temp.render("2023/11/25", x, y, (max(y)+min(y))/2, **times)
+    figures.daily_light.render("2023/11/25", x, light, 300, **times)
+
+
+def render_legacy(i, x, temp, light, times):
+    """
+    以前の方式　毎回plt.subplotsで図を作り、closeしない
+    """
+    y = [t + i % 5 for t in temp]
+    for data in [y, light]:
+        fig, ax = plt.subplots(figsize=(900/DPI, 200/DPI))
+        ax.plot(x, data, "-b", linewidth=2)
+        ax.axvspan(times["dt_0"], times["dt_sunrise"], color="gray", alpha=0.3)
+        ax.axvspan(times["dt_sunset"], times["dt_24"], color="gray", alpha=0.3)
+        ax.axvline(times["dt_now"], color="red")
+        fig.tight_layout()
+        fig.canvas.draw()
+        fig2str64(fig)
+
+
+def run(name, func, count):
+    """
+    count回描画して、時間とRSSを表示する
+    """
+    func(0)                                                             # 1回目は準備が入るので数えない
+    rss_start = rss_kb()
+    elapsed = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        elapsed.append(time.perf_counter() - start)
+        if (i+1) % max(count//10, 1) == 0:
+            print(f"  {name}: {i+1:6d}回  RSS {rss_kb()/1024:8.1f}MB")
+    ms = np.array(elapsed) * 1000
+    print(f"{name}: 平均 {ms.mean():.2f}ms  p50 {np.percentile(ms, 50):.2f}ms  p95 {np.percentile(ms, 95):.2f}ms"
+          f"  RSS増加 {(rss_kb()-rss_start)/1024:.1f}MB  最大RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.1f}MB")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    mode = sys.argv[2] if len(sys.argv) > 2 else "template"
+    matplotlib.rcParams["figure.dpi"] = DPI
+    x, temp, light, times = sample_day()
+    if mode in ["template", "both"]:
+        figures = Figures(DPI)
+        run("template", lambda i: render_template(figures, i, x, temp, light, times), count)
+    if mode in ["legacy", "both"]:
+        run("legacy", lambda i: render_legacy(i, x, temp, light, times), count)
+
+
+if __name__ == "__main__":
+    main()
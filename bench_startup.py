@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+"""
+起動時間のベンチマーク
+モジュールごとに新しいPythonで import し、-X importtime の出力から読み込みにかかった時間（自分の分と依存を含めた分）を集める
+重いモジュール（pandas、matplotlib、OpenCV）が読み込まれたかどうかと、app を読み込んでから最初の応答までの時間も測る
+agri.db はコピーを一時ディレクトリに置いて使う（元のファイルは書き換えない）　機器はシミュレーター（AGRI_DEVICE=sim）
+    python bench_startup.py [回数] [結果のJSON]
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULES = ["myDatabase", "myControl", "myDevice", "myEphem", "myAnalog", "myFigure", "app"]
+HEAVY = ["pandas", "matplotlib", "cv2", "numpy"]
+TOP = 8                                                                 # 依存の重いものを何個表示するか
+
+# 新しいPythonで読み込んで、重いモジュールの有無と時間をJSONで出す
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+loaded = time.perf_counter()
+first = None
+if "{module}" == "app":
+    client = app.app.test_client()
+    client.post("/getConfig")
+    first = time.perf_counter() - start
+    app.db.close()
+print(json.dumps({{"import_s": loaded - start, "first_response_s": first,
+                  "heavy": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    -X importtime の出力を モジュール名 → (自分の時間, 依存を含めた時間)（マイクロ秒）にする
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def probe(module, workdir, env):
+    """
+    1回分の計測
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE.format(module=module, heavy=HEAVY)],
+                            cwd=workdir, env=env, capture_output=True, text=True, timeout=300)
+    if result.returncode != 0:
+        raise RuntimeError(f"{module}: {result.stderr.strip().splitlines()[-1]}")
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+    summary["modules"] = parse_importtime(result.stderr)
+    return summary
+
+
+def measure(module, count, workdir, env):
+    """
+    count回計測して中央値をまとめる
+    """
+    runs = [probe(module, workdir, env) for _ in range(count)]
+    names = set.intersection(*[set(run["modules"]) for run in runs])
+    cumulative = {name: statistics.median(run["modules"][name][1] for run in runs) for name in names}
+    first = [run["first_response_s"] for run in runs if run["first_response_s"] is not None]
+    return {"import_ms": round(statistics.median(run["import_s"] for run in runs) * 1000, 1),
+            "first_response_ms": round(statistics.median(first) * 1000, 1) if first else None,
+            "heavy": runs[-1]["heavy"],
+            "top": [(name, round(us / 1000, 1)) for name, us in
+                    sorted(cumulative.items(), key=lambda item: -item[1]) if name != module][:TOP]}
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    output = sys.argv[2] if len(sys.argv) > 2 else None
+    env = dict(os.environ, AGRI_DEVICE="sim", PYTHONPATH=HERE + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        if os.path.exists(os.path.join(HERE, "agri.db")):
+            shutil.copy(os.path.join(HERE, "agri.db"), workdir)
+        for module in MODULES:
+            try:
+                results[module] = measure(module, count, workdir, env)
+            except Exception as e:                                      # 読み込めないモジュールは飛ばす
+                print(f"{module}: 計測できない　{e}")
+                continue
+            r = results[module]
+            first = f"  最初の応答 {r['first_response_ms']}ms" if r["first_response_ms"] is not None else ""
+            print(f"{module}: import {r['import_ms']}ms{first}  重いモジュール {r['heavy'] or 'なし'}")
+            for name, ms in r["top"]:
+                print(f"    {name:40s} {ms:8.1f}ms")
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "count": count, "results": results}, f, ensure_ascii=False, indent=1)
+        print(f"{output} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import time
-import RPi
+import numpy as np
 
 
 class DHT11Result:
@@ -12,6 +12,7 @@ class DHT11Result:
     error_code = ERR_NO_ERROR
     temperature = -1
     humidity = -1
+    diagnostics = None
 
     def __init__(self, error_code, temperature, humidity):
         self.error_code = error_code
@@ -27,41 +28,64 @@ class DHT11:
 
     __pin = 0
 
-    def __init__(self, pin):
+    def __init__(self, pin, gpio=None, clock=None):
+        # gpio: object with the RPi.GPIO interface (e.g. a simulator), defaults to RPi.GPIO
+        # clock: function returning nanoseconds for the edge timestamps, defaults to time.perf_counter_ns
+        if gpio is None:
+            import RPi.GPIO as gpio
         self.__pin = pin
+        self.__gpio = gpio
+        self.__clock = clock or time.perf_counter_ns
+        self.__stats = {"reads": 0, "ok": 0, "missing_data": 0, "crc": 0}
+        self.last_diagnostics = None
 
     def read(self):
-        RPi.GPIO.setup(self.__pin, RPi.GPIO.OUT)
+        started = time.perf_counter()
+
+        self.__gpio.setup(self.__pin, self.__gpio.OUT)
 
         # send initial high
-        self.__send_and_sleep(RPi.GPIO.HIGH, 0.05)
+        self.__send_and_sleep(self.__gpio.HIGH, 0.05)
 
         # pull down to low
-        self.__send_and_sleep(RPi.GPIO.LOW, 0.02)
+        self.__send_and_sleep(self.__gpio.LOW, 0.02)
 
         # change to input using pull up
-        RPi.GPIO.setup(self.__pin, RPi.GPIO.IN, RPi.GPIO.PUD_UP)
-
-        # collect data into an array
-        data = self.__collect_input()
-
-        # parse lengths of all data pull up periods
-        pull_up_lengths = self.__parse_data_pull_up_lengths(data)
+        self.__gpio.setup(self.__pin, self.__gpio.IN, self.__gpio.PUD_UP)
+
+        # collect the timestamps of the level changes
+        capture_start = time.perf_counter()
+        times, levels, samples = self.__collect_edges()
+        capture_end = time.perf_counter()
+
+        # widths of all data pull up periods, classified into bits in one pass
+        widths = self.__parse_pull_up_widths(times, levels)
+        bits, threshold = self.__classify(widths)
+        decode_end = time.perf_counter()
+
+        diagnostics = {
+            "samples": samples,
+            "edges": len(times),
+            "pulses": len(widths),
+            "capture_us": round((capture_end - capture_start) * 1e6),
+            "decode_us": round((decode_end - capture_end) * 1e6),
+            "total_ms": round((decode_end - started) * 1e3, 1),
+            "min_width_us": round(float(widths.min()) / 1e3, 1) if len(widths) else None,
+            "max_width_us": round(float(widths.max()) / 1e3, 1) if len(widths) else None,
+            "threshold_us": round(threshold / 1e3, 1) if threshold is not None else None,
+        }
 
         # if bit count mismatch, return error (4 byte data + 1 byte checksum)
-        if len(pull_up_lengths) != 40:
-            return DHT11Result(DHT11Result.ERR_MISSING_DATA, 0, 0)
-
-        # calculate bits from lengths of the pull up periods
-        bits = self.__calculate_bits(pull_up_lengths)
+        if bits is None:
+            return self.__result(DHT11Result.ERR_MISSING_DATA, 0, 0, diagnostics)
 
         # we have the bits, calculate bytes
-        the_bytes = self.__bits_to_bytes(bits)
+        the_bytes = [int(b) for b in np.packbits(bits)]
 
         # calculate checksum and check
         checksum = self.__calculate_checksum(the_bytes)
         if the_bytes[4] != checksum:
-            return DHT11Result(DHT11Result.ERR_CRC, 0, 0)
+            return self.__result(DHT11Result.ERR_CRC, 0, 0, diagnostics)
 
         # ok, we have valid data
 
@@ -74,130 +98,90 @@ class DHT11:
         temperature = the_bytes[2] + float(the_bytes[3]) / 10
         humidity = the_bytes[0] + float(the_bytes[1]) / 10
 
-        return DHT11Result(DHT11Result.ERR_NO_ERROR, temperature, humidity)
+        return self.__result(DHT11Result.ERR_NO_ERROR, temperature, humidity, diagnostics)
+
+    def stats(self):
+        # counts of read results and the diagnostics of the last read
+        return dict(self.__stats, last=self.last_diagnostics)
+
+    def __result(self, error_code, temperature, humidity, diagnostics):
+        diagnostics["error_code"] = error_code
+        self.last_diagnostics = diagnostics
+        self.__stats["reads"] += 1
+        self.__stats[{DHT11Result.ERR_NO_ERROR: "ok",
+                      DHT11Result.ERR_MISSING_DATA: "missing_data",
+                      DHT11Result.ERR_CRC: "crc"}[error_code]] += 1
+        result = DHT11Result(error_code, temperature, humidity)
+        result.diagnostics = diagnostics
+        return result
 
     def __send_and_sleep(self, output, sleep):
-        RPi.GPIO.output(self.__pin, output)
+        self.__gpio.output(self.__pin, output)
         time.sleep(sleep)
 
-    def __collect_input(self):
-        # collect the data while unchanged found
-        unchanged_count = 0
+    def __collect_edges(self):
+        # only the level changes are stored, with a timestamp taken when each one is seen,
+        # so the polling loop stays short and no per-sample list is built
+        input = self.__gpio.input
+        pin = self.__pin
+        now = self.__clock
 
         # this is used to determine where is the end of the data
         max_unchanged_count = 100
 
+        # safety limit for a pin that never settles
+        max_samples = 100000
+
+        unchanged_count = 0
+        samples = 0
         last = -1
-        data = []
-        while True:
-            current = RPi.GPIO.input(self.__pin)
-            data.append(current)
-            if last != current:
+        times = []
+        levels = []
+        while samples < max_samples:
+            current = input(pin)
+            samples += 1
+            if current != last:
+                times.append(now())
+                levels.append(current)
                 unchanged_count = 0
                 last = current
             else:
                 unchanged_count += 1
                 if unchanged_count > max_unchanged_count:
                     break
-
-        return data
-
-    def __parse_data_pull_up_lengths(self, data):
-        STATE_INIT_PULL_DOWN = 1
-        STATE_INIT_PULL_UP = 2
-        STATE_DATA_FIRST_PULL_DOWN = 3
-        STATE_DATA_PULL_UP = 4
-        STATE_DATA_PULL_DOWN = 5
-
-        state = STATE_INIT_PULL_DOWN
-
-        lengths = [] # will contain the lengths of data pull up periods
-        current_length = 0 # will contain the length of the previous period
-
-        for i in range(len(data)):
-
-            current = data[i]
-            current_length += 1
-
-            if state == STATE_INIT_PULL_DOWN:
-                if current == RPi.GPIO.LOW:
-                    # ok, we got the initial pull down
-                    state = STATE_INIT_PULL_UP
-                    continue
-                else:
-                    continue
-            if state == STATE_INIT_PULL_UP:
-                if current == RPi.GPIO.HIGH:
-                    # ok, we got the initial pull up
-                    state = STATE_DATA_FIRST_PULL_DOWN
-                    continue
-                else:
-                    continue
-            if state == STATE_DATA_FIRST_PULL_DOWN:
-                if current == RPi.GPIO.LOW:
-                    # we have the initial pull down, the next will be the data pull up
-                    state = STATE_DATA_PULL_UP
-                    continue
-                else:
-                    continue
-            if state == STATE_DATA_PULL_UP:
-                if current == RPi.GPIO.HIGH:
-                    # data pulled up, the length of this pull up will determine whether it is 0 or 1
-                    current_length = 0
-                    state = STATE_DATA_PULL_DOWN
-                    continue
-                else:
-                    continue
-            if state == STATE_DATA_PULL_DOWN:
-                if current == RPi.GPIO.LOW:
-                    # pulled down, we store the length of the previous pull up period
-                    lengths.append(current_length)
-                    state = STATE_DATA_PULL_UP
-                    continue
-                else:
-                    continue
-
-        return lengths
-
-    def __calculate_bits(self, pull_up_lengths):
-        # find shortest and longest period
-        shortest_pull_up = 1000
-        longest_pull_up = 0
-
-        for i in range(0, len(pull_up_lengths)):
-            length = pull_up_lengths[i]
-            if length < shortest_pull_up:
-                shortest_pull_up = length
-            if length > longest_pull_up:
-                longest_pull_up = length
-
-        # use the halfway to determine whether the period it is long or short
-        halfway = shortest_pull_up + (longest_pull_up - shortest_pull_up) / 2
-        bits = []
-
-        for i in range(0, len(pull_up_lengths)):
-            bit = False
-            if pull_up_lengths[i] > halfway:
-                bit = True
-            bits.append(bit)
-
-        return bits
-
-    def __bits_to_bytes(self, bits):
-        the_bytes = []
-        byte = 0
-
-        for i in range(0, len(bits)):
-            byte = byte << 1
-            if (bits[i]):
-                byte = byte | 1
-            else:
-                byte = byte | 0
-            if ((i + 1) % 8 == 0):
-                the_bytes.append(byte)
-                byte = 0
-
-        return the_bytes
+        times.append(now())
+
+        return np.array(times, dtype=np.int64), np.array(levels, dtype=np.int8), samples
+
+    def __parse_pull_up_widths(self, times, levels):
+        # widths (ns) of the complete pull up periods after the initial pull down:
+        # the first one is the response of the sensor, the next 40 are the data bits
+        durations = np.diff(times)
+        complete = np.zeros(len(levels), dtype=bool)
+        complete[:-1] = True                                    # the last period has no falling edge
+        high = (levels == self.__gpio.HIGH) & complete
+        lows = np.flatnonzero(levels == self.__gpio.LOW)
+        if len(lows) == 0:
+            return durations[:0]
+        high[:lows[0]] = False                                  # skip the initial pull up
+        return durations[high]
+
+    def __classify(self, widths):
+        # returns the 40 bits (or None) and the threshold (ns) between short and long pull ups
+        if len(widths) < 41:
+            return None, None
+
+        # spurious edges before the response are dropped by using the last 41 periods
+        response, widths = widths[-41], widths[-40:]
+
+        # use the halfway between the shortest and the longest period when both kinds are present,
+        # otherwise compare with the response pull up (80us, while 0 is 26-28us and 1 is 70us)
+        shortest, longest = widths.min(), widths.max()
+        if longest > shortest * 1.5:
+            threshold = (shortest + longest) / 2
+        else:
+            threshold = response * 0.6
+        return widths > threshold, float(threshold)
 
     def __calculate_checksum(self, the_bytes):
         return the_bytes[0] + the_bytes[1] + the_bytes[2] + the_bytes[3] & 255
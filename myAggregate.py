@@ -0,0 +1,132 @@
+import datetime
+import threading
+
+"""
+日ごとのサマリー（最高・最低気温、点灯時間）をサンプルが来るたびに少しずつ更新する集計器
+1サンプルあたりO(1)で、その日の生データを読み直さない
+生データからの作り直しは起動後はじめてその日を扱うときか、明示的に頼まれたときだけ
+"""
+
+
+def lighting_minutes_between(dt_from, dt_to):
+    """
+    点灯開始から消灯までの時間（分）
+    念のため+5秒してから分にする（これまでの集計と同じ丸め方）
+    """
+    seconds = (dt_to - dt_from).total_seconds()
+    return int((seconds + 5)/60)
+
+
+class DailySummary():
+    """
+    1日分の集計値
+    """
+    def __init__(self, date):
+        self.date = date                                                # 日付（文字列）
+        self.max_temp = None                                            # 最高気温
+        self.min_temp = None                                            # 最低気温
+        self.temp_count = 0                                             # 温度サンプル数
+        self.temp_sum = 0.0                                             # 温度の合計
+        self.lighting_minutes = 0                                       # 消灯まで済んだ点灯時間の合計（分）
+        self.on_since = None                                            # 点灯中ならその開始時刻　消灯中ならNone
+        self.last_dt = None                                             # 最後に受け取った点灯サンプルの時刻
+
+    def add_temperature(self, temp):
+        """
+        温度サンプルを1件加える
+        """
+        self.max_temp = temp if self.max_temp is None else max(self.max_temp, temp)
+        self.min_temp = temp if self.min_temp is None else min(self.min_temp, temp)
+        self.temp_count += 1
+        self.temp_sum += temp
+
+    def add_light(self, dt, value):
+        """
+        点灯状態のサンプルを1件加える
+        Args:
+            dt   : 時刻（datetime）
+            value: オン=1/ オフ=0
+        """
+        if value and self.on_since is None:                             # オフからオンになったら
+            self.on_since = dt                                          # その時刻を覚えておく
+        elif not value and self.on_since is not None:                   # オンからオフになったら
+            self.lighting_minutes += lighting_minutes_between(self.on_since, dt)
+            self.on_since = None
+        self.last_dt = dt
+
+    @property
+    def mean_temp(self):
+        """
+        最高気温と最低気温の中間（画面の「平均」はこの値）
+        """
+        if self.max_temp is None:
+            return None
+        return (self.max_temp + self.min_temp)/2
+
+    def lighting_minutes_until(self, dt=None):
+        """
+        点灯中の分も含めた点灯時間（分）
+        Args:
+            dt: 点灯中の区間をどの時刻まで数えるか　Noneならば最後のサンプルの時刻まで
+        """
+        if self.on_since is None:
+            return self.lighting_minutes
+        if dt is None:
+            dt = self.last_dt
+        return self.lighting_minutes + lighting_minutes_between(self.on_since, dt)
+
+
+class Aggregator():
+    """
+    日ごとのDailySummaryをメモリ上に保持する
+    """
+    def __init__(self, max_days=7):
+        self.days = {}                                                  # 日付 → DailySummary
+        self.max_days = max_days                                        # メモリに残しておく日数
+        self.lock = threading.RLock()                                   # 集計と書き込みをまとめて排他する
+
+    def get(self, conn, date):
+        """
+        その日の集計を返す　まだなければ生データから作る
+        """
+        with self.lock:
+            summary = self.days.get(date)
+            if summary is None:
+                summary = self.rebuild(conn, date)
+            return summary
+
+    def rebuild(self, conn, date):
+        """
+        その日の集計を生データから作り直す
+        """
+        summary = DailySummary(date)
+        sql = "SELECT MAX(temperature), MIN(temperature), COUNT(temperature), TOTAL(temperature)"\
+                " FROM temperature WHERE date=?"
+        max_temp, min_temp, count, total = conn.execute(sql, (date,)).fetchone()
+        summary.max_temp, summary.min_temp = max_temp, min_temp
+        summary.temp_count, summary.temp_sum = count, total
+
+        sql = "SELECT datetime, value FROM light WHERE date=? ORDER BY datetime ASC"
+        for strdt, value in conn.execute(sql, (date,)):
+            dt = datetime.datetime.strptime(strdt, "%Y/%m/%d %H:%M")
+            summary.add_light(dt, int(value))
+
+        if count == 0 and summary.last_dt is None:                   # SQLiteにその日の行がなければキャッシュしない
+            return summary                                              # （アーカイブ済みの日を空の集計で覚えないように）
+        with self.lock:
+            self.days[date] = summary
+            while len(self.days) > self.max_days:                       # 古い日から捨てる
+                del self.days[min(self.days)]
+        return summary
+
+    def forget(self, date=None):
+        """
+        集計を捨てる　次に使うときに生データから作り直される
+        Args:
+            date: 日付（文字列）Noneならば全部
+        """
+        with self.lock:
+            if date is None:
+                self.days.clear()
+            else:
+                self.days.pop(date, None)
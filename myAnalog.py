@@ -0,0 +1,202 @@
+import datetime
+import threading
+import time
+import numpy as np
+
+"""
+MCP3004（4チャンネルのA/D変換器）の連続取り込み
+チャンネルごとのデバイス（gpiozero.MCP3004）を一度だけ開いて使い回し、決まった周期で全チャンネルを読んで
+リングバッファに入れる　一定時間ごとに平均した値（間引いた値）をDBに残す
+バッテリーのチャンネルの電圧からは、12V鉛蓄電池の電圧と残量の表で残量（％）を求める
+"""
+
+CHANNELS = [0, 1, 2, 3]                                                 # 読むチャンネル
+BATTERY_CH = 3                                                          # バッテリーの電圧をつないだチャンネル
+VREF = 5                                                                # 基準電圧（V）
+DIVIDER = 3.0                                                           # バッテリーの電圧を分圧した比（バッテリー電圧／入力電圧）
+
+# 12V鉛蓄電池の電圧（V）と残量（％）　間は直線で補間する
+SOC_CURVE = [(10.5, 0), (11.31, 10), (11.58, 20), (11.75, 30), (11.9, 40), (12.06, 50),
+             (12.2, 60), (12.32, 70), (12.42, 80), (12.5, 90), (12.7, 100)]
+
+
+def soc(battery_v):
+    """
+    バッテリーの電圧から残量（％）を求める
+    Args:
+        battery_v: 電圧（V）　数値か配列
+    Returns:
+        残量（0～100）
+    """
+    return np.interp(battery_v, [v for v, _ in SOC_CURVE], [p for _, p in SOC_CURVE])
+
+
+def mcp3004(ch):
+    """
+    実機のチャンネルを開く（gpiozeroはここで初めて読み込む）
+    """
+    from gpiozero import MCP3004
+    return MCP3004(channel=ch, max_voltage=VREF)
+
+
+class Analog():
+    def __init__(self, channels=CHANNELS, rate=10, seconds=600, vref=VREF, battery_ch=BATTERY_CH, divider=DIVIDER,
+                 decimate=60, factory=mcp3004):
+        """
+        初期設定
+        Args:
+            channels  : 読むチャンネルのリスト
+            rate      : 1秒に読む回数
+            seconds   : リングバッファに残す秒数
+            vref      : 基準電圧（V）
+            battery_ch: バッテリーのチャンネル（channelsの中のもの）　Noneならば残量は求めない
+            divider   : バッテリーの電圧の分圧比
+            decimate  : この秒数ごとに平均した値をlistenersに渡す
+            factory   : チャンネル番号から、value（0～1）を持つデバイスを作る関数
+        """
+        self.channels = list(channels)
+        self.rate = rate
+        self.vref = vref
+        self.battery_ch = battery_ch
+        self.divider = divider
+        self.decimate = decimate
+        self.devices = [factory(ch) for ch in self.channels]           # 開いたまま使い回す
+        self.size = int(rate * seconds)
+        self.buffer = np.zeros((self.size, len(self.channels)), dtype=np.float32)   # 電圧（V）
+        self.times = np.zeros(self.size, dtype=np.float64)              # 読んだ時刻（エポック秒）
+        self.pos = 0                                                    # 次に書く位置
+        self.count = 0                                                  # 書いた総数
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.listeners = []                                             # 間引いた値を受け取る関数
+        self.errors = 0                                                 # 読み取りに失敗した回数
+        self.overruns = 0                                               # 周期に間に合わなかった回数
+
+    def start(self):
+        """
+        取り込みスレッドを始める
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="analog", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        取り込みスレッドを止め、デバイスを閉じる
+        """
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+        for device in self.devices:
+            if hasattr(device, "close"):
+                device.close()
+
+    def add_listener(self, func):
+        """
+        間引いた値を受け取る関数を登録する
+        Args:
+            func: func(dict)　dictはlatest()と同じ形（平均した値）
+        """
+        self.listeners.append(func)
+
+    def run(self):
+        """
+        取り込みスレッド　1/rate秒ごとに全チャンネルを読み、decimate秒ごとに平均を渡す
+        """
+        period = 1 / self.rate
+        next_time = time.monotonic()
+        next_decimate = self.next_boundary(time.time())
+        while not self.stop_event.is_set():
+            self.sample()
+            now = time.time()
+            if now >= next_decimate:
+                try:
+                    self.publish(self.decimate)
+                except Exception as e:                                  # 受け取る側の失敗で取り込みを止めない
+                    print(f"A/D変換器の値を渡せない　{e}")
+                next_decimate = self.next_boundary(now)
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay < 0:                                               # 遅れたら過ぎた刻みは飛ばす
+                self.overruns += 1
+                next_time += (-delay // period + 1) * period
+                delay = next_time - time.monotonic()
+            self.stop_event.wait(delay)
+
+    def next_boundary(self, now):
+        """
+        次に間引く時刻（decimate秒の区切り）
+        """
+        return (now // self.decimate + 1) * self.decimate
+
+    def sample(self):
+        """
+        全チャンネルを1回読んでリングバッファに入れる
+        """
+        try:
+            volts = [device.value * self.vref for device in self.devices]
+        except Exception:                                               # 読めなければその回は飛ばす
+            self.errors += 1
+            return
+        with self.lock:
+            self.buffer[self.pos] = volts
+            self.times[self.pos] = time.time()
+            self.pos = (self.pos + 1) % self.size
+            self.count += 1
+
+    def window(self, seconds):
+        """
+        直近の区間のサンプル
+        Args:
+            seconds: 区間の秒数
+        Returns:
+            (times, volts)　時刻の配列と (サンプル数, チャンネル数) の電圧の配列（古い順）
+        """
+        with self.lock:
+            n = min(self.count, self.size)
+            order = (np.arange(self.pos - n, self.pos)) % self.size     # 古い順に並べ替える
+            times, volts = self.times[order], self.buffer[order]
+        keep = times > time.time() - seconds
+        return times[keep], volts[keep]
+
+    def summarize(self, times, volts):
+        """
+        サンプルの平均をまとめる
+        """
+        if len(times) == 0:
+            return None
+        means = volts.mean(axis=0)
+        result = {"time": datetime.datetime.fromtimestamp(times[-1]).strftime("%Y/%m/%d %H:%M:%S"),
+                  "age": round(float(time.time() - times[-1]), 1),
+                  "volts": [round(float(v), 3) for v in means],
+                  "battery_v": None, "soc": None}
+        if self.battery_ch in self.channels:
+            battery_v = float(means[self.channels.index(self.battery_ch)]) * self.divider
+            result["battery_v"] = round(battery_v, 2)
+            result["soc"] = round(float(soc(battery_v)), 1)
+        return result
+
+    def latest(self, seconds=1.0):
+        """
+        直近の値（seconds秒の平均でノイズをならす）
+        Returns:
+            dict: {"time", "age", "volts", "battery_v", "soc"}　まだ読んでいなければNone
+        """
+        return self.summarize(*self.window(seconds))
+
+    def publish(self, seconds):
+        """
+        seconds秒の平均をlistenersに渡す
+        """
+        result = self.summarize(*self.window(seconds))
+        if result is None:
+            return
+        for func in self.listeners:
+            func(result)
+
+    def stats(self):
+        """
+        取り込みの統計
+        """
+        return {"rate": self.rate, "samples": self.count, "errors": self.errors, "overruns": self.overruns}
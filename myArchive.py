@@ -0,0 +1,224 @@
+import datetime
+import glob
+import os
+import sqlite3
+import sys
+import threading
+import numpy as np
+
+"""
+古い生データのアーカイブ（コールドストレージ）
+一定の日数より古い生データ（temperature、light、contec）を月ごとの圧縮したNumPyファイル（.npz）に移し、
+SQLiteからは消す　サマリーとロールアップはSQLiteに残すので、長い期間のグラフはこれまでどおり速い
+.npzは列ごとの配列を持つ（列指向）　1日分を読むときはその月のファイルだけを開く
+    python myArchive.py [日数] [agri.db]
+"""
+
+ARCHIVE_DIR = "archive"                                                 # アーカイブを置くディレクトリ
+TABLES = ["temperature", "light", "contec"]                             # アーカイブする生データのテーブル
+
+
+def to_array(values, type):
+    """
+    列の値をNumPy配列にする　NULLは数値ならばnan、文字列ならば空文字にする
+    """
+    if type in ("REAL", "INTEGER"):
+        if type == "INTEGER" and all(v is not None for v in values):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(["" if v is None else str(v) for v in values], dtype=np.str_)
+
+
+def to_value(v):
+    """
+    NumPyの値をPythonの値に戻す（nanはNone）
+    """
+    if v is None:                                                       # アーカイブにない列
+        return None
+    v = v.item()
+    if isinstance(v, float) and v != v:
+        return None
+    return v
+
+
+class Archive():
+    def __init__(self, directory=ARCHIVE_DIR, cache_size=4):
+        """
+        初期設定
+        Args:
+            directory : アーカイブを置くディレクトリ
+            cache_size: 読み込んだ月のファイルをメモリに残しておく数
+        """
+        self.directory = directory
+        self.cache_size = cache_size
+        self.cache = {}                                                 # (ファイル名, 更新時刻) → 列の辞書
+        self.lock = threading.Lock()
+
+    def path(self, table, month):
+        """
+        月のファイル名　month は 'YYYY/MM'
+        """
+        return os.path.join(self.directory, f"{table}_{month.replace('/', '-')}.npz")
+
+    def months(self, table):
+        """
+        アーカイブ済みの月（'YYYY/MM'）のリスト
+        """
+        files = glob.glob(os.path.join(self.directory, f"{table}_*.npz"))
+        return sorted(os.path.basename(f)[len(table)+1:-4].replace("-", "/") for f in files
+                      if not f.endswith(".tmp.npz"))                    # 書きかけで残った一時ファイルは月に数えない
+
+    def load(self, table, month):
+        """
+        月のファイルを列の辞書として読む　なければNone
+        """
+        path = self.path(table, month)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        with self.lock:
+            data = self.cache.get((path, mtime))
+        if data is None:
+            with np.load(path) as npz:
+                data = {key: npz[key] for key in npz.files}
+            with self.lock:
+                self.cache[(path, mtime)] = data
+                while len(self.cache) > self.cache_size:                # 古いものから捨てる
+                    del self.cache[next(iter(self.cache))]
+        return data
+
+    def save(self, table, month, data):
+        """
+        月のファイルを書く　一時ファイルに書いてから置き換えるので、途中で止まっても壊れない
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(table, month)
+        tmp = path[:-4] + ".tmp.npz"
+        np.savez_compressed(tmp, **data)
+        with open(tmp, "rb") as f:                                      # SQLiteから消す前にディスクに書き切る
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def append(self, table, month, data):
+        """
+        月のファイルに行を足す　ファイルの最後の日時までの行は足さない
+        （ファイルを書いたあとSQLiteから消す前に止まった場合、次回同じ行がもう一度来るため）
+        """
+        old = self.load(table, month)
+        if old is not None and len(old["datetime"]):
+            new = data["datetime"] > old["datetime"][-1]                # ファイルは日時の順
+            data = {key: np.concatenate((old[key], data[key][new])) for key in data}
+        order = np.argsort(data["datetime"], kind="stable")             # 日時の順にしておく
+        self.save(table, month, {key: values[order] for key, values in data.items()})
+
+    def read(self, table, columns, date_from, date_to):
+        """
+        期間の行を読む
+        Args:
+            table    : テーブル名
+            columns  : 列名のリスト　前のスキーマでアーカイブした月にない列はNone
+            date_from, date_to: 期間（日付の文字列、両端を含む）
+        Returns:
+            rows     : 行のタプルのリスト（日時の順）
+        """
+        rows = []
+        month = date_from[:7]
+        while month <= date_to[:7]:
+            data = self.load(table, month)
+            if data is not None:
+                dates = data["date"]
+                mask = (dates >= date_from) & (dates <= date_to)
+                n = int(mask.sum())
+                cols = [data[c][mask] if c in data else [None] * n for c in columns]     # 列は名前で合わせる
+                rows += [tuple(to_value(v) for v in row) for row in zip(*cols)]
+            month = next_month(month)
+        return rows
+
+    def purge(self, table, date_to):
+        """
+        ある日以前の行をアーカイブから消す　月の全部が消える月はファイルごと消し、
+        date_toの月は残す行だけで書き直す　読み込んでおいた月もメモリから捨てる
+        Args:
+            table  : テーブル名
+            date_to: 日付の文字列　この日以前を消す
+        Returns:
+            int    : 消した行数
+        """
+        deleted = 0
+        for month in self.months(table):
+            if month > date_to[:7]:                                     # 月の順なのでこの先は残す
+                break
+            data = self.load(table, month)
+            keep = data["date"] > date_to
+            deleted += int(len(keep) - keep.sum())
+            path = self.path(table, month)
+            if keep.any():                                              # 残す行があれば書き直す
+                self.save(table, month, {key: values[keep] for key, values in data.items()})
+            else:
+                os.remove(path)
+            with self.lock:
+                for key in [key for key in self.cache if key[0] == path]:
+                    del self.cache[key]
+        return deleted
+
+    def move(self, conn, before):
+        """
+        ある日より前の生データをアーカイブに移し、SQLiteから消す
+        月ごとに、ファイルを書いてからその月の行を消す（1か月ずつのトランザクション）
+        Args:
+            conn  : 接続
+            before: 日付の文字列　この日より前を移す
+        Returns:
+            dict  : テーブル → 移した行数
+        """
+        moved = {}
+        for table in TABLES:
+            info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            if not info:
+                continue
+            names = [row[1] for row in info]
+            types = [row[2].upper() for row in info]
+            months = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT substr(date, 1, 7) FROM {table} WHERE date < ? ORDER BY 1", (before,))]
+            moved[table] = 0
+            for month in months:
+                date_from, date_to = f"{month}/01", min(f"{month}/31", before)
+                rows = conn.execute(f"SELECT * FROM {table} WHERE date >= ? AND date <= ? AND date < ?",
+                                    (date_from, date_to, before)).fetchall()
+                data = {name: to_array([row[i] for row in rows], type)
+                        for i, (name, type) in enumerate(zip(names, types))}
+                self.append(table, month, data)
+                conn.execute(f"DELETE FROM {table} WHERE date >= ? AND date <= ? AND date < ?",
+                             (date_from, date_to, before))
+                conn.commit()
+                moved[table] += len(rows)
+        return moved
+
+
+def next_month(month):
+    """
+    'YYYY/MM' の次の月
+    """
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year + mon // 12:04d}/{mon % 12 + 1:02d}"
+
+
+def cutoff(days):
+    """
+    今日からdays日前の日付の文字列（この日より前をアーカイブする）
+    """
+    return (datetime.date.today() - datetime.timedelta(days=days)).strftime("%Y/%m/%d")
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    dbname = sys.argv[2] if len(sys.argv) > 2 else "agri.db"
+    conn = sqlite3.connect(dbname)
+    moved = Archive().move(conn, cutoff(days))
+    conn.close()
+    print(f"{dbname}: {cutoff(days)}より前をアーカイブ {moved}")
+
+
+if __name__ == "__main__":
+    main()
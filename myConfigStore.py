@@ -0,0 +1,106 @@
+import threading
+import types
+
+"""
+設定（configテーブル）のメモリ上の置き場所
+起動時に一度だけ読み込み、読むときはメモリの辞書を返すだけにする
+書くときは変わったキーだけを1行ずつupsertし（テーブルを作り直さない）、バージョンを上げて、
+登録しておいた使い手（DB.cumsum_date・ephem_config、制御ループの設定など）に知らせる
+辞書は書き換えずに新しいものと差し替えるので、読む側はロックなしで一貫した値が読める
+"""
+
+UPSERT_SQL = 'INSERT INTO config("index", "value") VALUES(?, ?) ON CONFLICT("index") DO UPDATE SET "value"=excluded."value"'
+
+
+class ConfigStore():
+    def __init__(self, pool):
+        """
+        初期設定
+        Args:
+            pool: 接続プール（ConnectionPool）
+        """
+        self.pool = pool
+        self.lock = threading.Lock()                                    # 書き込みは同時に一つだけ
+        self.values = types.MappingProxyType({})                        # 読み取り専用の今の設定
+        self.version = 0                                                # 設定が変わるたびに1増える
+        self.listeners = []                                             # (関数, 見ているキーの集合かNone)
+
+    def load(self):
+        """
+        configテーブルを読み込む（起動時）
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute('SELECT "index", "value" FROM config').fetchall()
+        with self.lock:
+            old = self.values
+            self.values = types.MappingProxyType({key: value for key, value in rows})
+            self.version += 1
+            changed = {key for key in set(old) | set(self.values) if old.get(key) != self.values.get(key)}
+        self.notify(changed)
+
+    def get(self, key, default=None):
+        """
+        ある設定の値
+        """
+        return self.values.get(key, default)
+
+    def snapshot(self):
+        """
+        今の設定全部（読み取り専用の辞書）とバージョン
+        """
+        with self.lock:
+            return self.values, self.version
+
+    def set(self, key, value):
+        """
+        一つの設定を書き込む
+        """
+        return self.update({key: value})
+
+    def update(self, changes):
+        """
+        設定を書き込む　値が変わったキーだけを一つのトランザクションでupsertする
+        Args:
+            changes: キー → 値（文字列にして保存する）
+        Returns:
+            changed: 変わったキーの集合
+        """
+        with self.lock:
+            new = {str(key): str(value) for key, value in changes.items()}
+            changed = {key for key, value in new.items() if self.values.get(key) != value}
+            if not changed:
+                return changed
+            with self.pool.connection() as conn:
+                try:
+                    conn.executemany(UPSERT_SQL, [(key, new[key]) for key in sorted(changed)])
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            self.values = types.MappingProxyType({**self.values, **{key: new[key] for key in changed}})
+            self.version += 1
+        self.notify(changed)
+        return changed
+
+    def subscribe(self, func, keys=None):
+        """
+        設定が変わったときに呼ぶ関数を登録し、今の設定で一度呼ぶ
+        Args:
+            func: func(values, changed)　valuesは今の設定全部、changedは変わったキーの集合
+            keys: このキーのどれかが変わったときだけ呼ぶ　Noneならばいつでも
+        """
+        keys = None if keys is None else set(keys)
+        self.listeners.append((func, keys))
+        if self.values:
+            func(self.values, set(self.values))
+
+    def notify(self, changed):
+        """
+        変わったキーを見ている関数を呼ぶ
+        """
+        if not changed:
+            return
+        values = self.values
+        for func, keys in list(self.listeners):
+            if keys is None or keys & changed:
+                func(values, changed)
@@ -1,13 +1,25 @@
 # coding: utf-8
 import ctypes
 import sys
-import cdio
 import time
 import datetime
+import collections
+import queue
+import threading
+import numpy as np
 
 class Contec():
-    def __init__(self):
+    def __init__(self, max_events=1000, driver=None):
+        """
+        初期設定
+        Args:
+            max_events: 割り込みモードで覚えておく入力変化の数（リングバッファの大きさ）
+            driver    : cdioと同じ関数・定数を持つドライバ（シミュレーターなど）　Noneならばcdio（libcdio.so）
+        """
         print("start")
+        if driver is None:
+            import cdio as driver                           # Raspberry Pi以外ではここで失敗する
+        self.cdio = driver
         self.DEV_NAME = "DIO000"                            # デバイス名
         self.port_no = ctypes.c_short(0)                    # ポートNo
         # input_pins = [1, 2, 3, 4, 5]		                # 光センサーが接続されているコンテックの入力コネクタのピン番号
@@ -25,12 +37,25 @@ class Contec():
         self.lights = []                                    # インプットの状態（初期値）
         self.relays = [1, 1, 1, 1]                          # 4個のリレーへの出力（初期値＝全出力）
 
+        # 割り込みモード　入力が変化したときだけドライバから呼ばれ、ボードをポーリングしない
+        self.event_mode = False                             # 割り込みモードで動いているか
+        self.io_state = 0                                   # 割り込みで更新する入力の状態（8ビット）
+        self.io_lock = threading.Lock()
+        self.events = queue.Queue(maxsize=max_events)       # 入力変化のキュー (時刻, ピン番号, 値)　制御ループが受け取る
+        self.history = collections.deque(maxlen=max_events) # 入力変化のリングバッファ（直近の履歴）
+        self.dropped = 0                                    # キューがあふれて捨てた入力変化の数
+        self.int_callback = self.cdio.PDIO_INT_CALLBACK(self.on_interrupt)   # ドライバに渡すコールバック　参照を持ち続ける
+
+        # バッファ取り込みモード　ボードが一定周期で入力ポートを読み、NumPyのリングバッファに直接書き込む
+        self.dm_mode = False                                # バッファ取り込みで動いているか
+        self.dm_rate = 0                                    # 取り込み周期（Hz）
+        self.dm_buff = None                                 # リングバッファ　要素はドライバのunsigned long
+
         # ドライバ初期化
-        ret = cdio.DioInit(self.DEV_NAME.encode(), ctypes.byref(self.dio_id))
-        if ret != cdio.DIO_ERR_SUCCESS:
-            cdio.DioGetErrorString(ret, self.err_str)
-            print(f"DioInit = {ret}: {self.err_str.value.decode('utf-8')}")
-            sys.exit()
+        ret = self.cdio.DioInit(self.DEV_NAME.encode(), ctypes.byref(self.dio_id))
+        if ret != self.cdio.DIO_ERR_SUCCESS:
+            self.cdio.DioGetErrorString(ret, self.err_str)
+            raise RuntimeError(f"DioInit = {ret}: {self.err_str.value.decode('utf-8')}")
 
     def num2array(self, num):
         # """8ビットの入力データを光センサーオンオフのリストとして返す"""
@@ -50,32 +75,195 @@ class Contec():
 
     def input(self):
         print("contec input start")
-        ret = cdio.DioInpByte(self.dio_id, self.port_no, ctypes.byref(self.io_data))
-        if ret == cdio.DIO_ERR_SUCCESS:
+        if self.event_mode:                                 # 割り込みモードならば覚えている状態を返す（ボードは読まない）
+            with self.io_lock:
+                return self.num2array(self.io_state)
+        ret = self.cdio.DioInpByte(self.dio_id, self.port_no, ctypes.byref(self.io_data))
+        if ret == self.cdio.DIO_ERR_SUCCESS:
             arr = self.num2array(self.io_data.value)
             return arr
         else:
-            cdio.DioGetErrorString(ret, self.err_str)
+            self.cdio.DioGetErrorString(ret, self.err_str)
             print(f"DioInpByte = {ret}: {self.err_str.value.decode('utf-8')}")
             return []
 
     def output(self, bool):
         num = self.array2num(self.relays)
         io_data = ctypes.c_ubyte(num) if bool else ctypes.c_ubyte(0)
-        ret = cdio.DioOutByte(self.dio_id, self.port_no, io_data)
-        if ret == cdio.DIO_ERR_SUCCESS:
-            cdio.DioGetErrorString(ret, self.err_str)
+        ret = self.cdio.DioOutByte(self.dio_id, self.port_no, io_data)
+        if ret == self.cdio.DIO_ERR_SUCCESS:
+            self.cdio.DioGetErrorString(ret, self.err_str)
             print(f'DioOutByte port = {self.port_no.value}: data = 0x{io_data.value:02x}')
         else:
-            cdio.DioGetErrorString(ret, self.err_str)
+            self.cdio.DioGetErrorString(ret, self.err_str)
             print(f"DioOutByte = {ret}: {self.err_str.value.decode('utf-8')}")
     
     def define_output_relays(self, array):
         self.relays = array
 
-contec = Contec()
+    def start_interrupts(self):
+        """
+        入力ピンの割り込みを登録して割り込みモードにする
+        DioSetInterruptEventは立ち上がりか立ち下がりの片方しか指定できないので、
+        今の値と逆向きの変化を待ち、変化するたびに向きを入れ替える
+        Returns:
+            bool: 割り込みモードになったかどうか　失敗したらポーリングのまま
+        """
+        ret = self.cdio.DioInpByte(self.dio_id, self.port_no, ctypes.byref(self.io_data))     # 開始時の状態を一度だけ読む
+        if ret != self.cdio.DIO_ERR_SUCCESS:
+            return self.interrupt_error("DioInpByte", ret)
+        with self.io_lock:
+            self.io_state = self.io_data.value
+        ret = self.cdio.DioSetInterruptCallBackProc(self.dio_id, self.int_callback, None)
+        if ret != self.cdio.DIO_ERR_SUCCESS:
+            return self.interrupt_error("DioSetInterruptCallBackProc", ret)
+        for bit in self.input_bits:
+            ret = self.arm_interrupt(bit, self.io_state >> bit & 1)
+            if ret != self.cdio.DIO_ERR_SUCCESS:
+                self.stop_interrupts()
+                return self.interrupt_error("DioSetInterruptEvent", ret)
+        self.event_mode = True
+        return True
+
+    def stop_interrupts(self):
+        """
+        割り込みを解除してポーリングに戻す
+        """
+        self.event_mode = False
+        for bit in self.input_bits:
+            self.cdio.DioSetInterruptEvent(self.dio_id, bit, self.cdio.DIO_INT_NONE)
+
+    def arm_interrupt(self, bit, value):
+        """
+        ビットの今の値と逆向きの変化で割り込むよう設定する
+        """
+        logic = self.cdio.DIO_INT_FALL if value else self.cdio.DIO_INT_RISE
+        return self.cdio.DioSetInterruptEvent(self.dio_id, bit, logic)
+
+    def interrupt_error(self, name, ret):
+        self.cdio.DioGetErrorString(ret, self.err_str)
+        print(f"{name} = {ret}: {self.err_str.value.decode('utf-8')}　ポーリングで動きます")
+        return False
+
+    def on_interrupt(self, id, message, wparam, lparam, param):
+        """
+        ドライバのスレッドから呼ばれる割り込みのコールバック　lparamが割り込んだビット
+        ここでは状態を更新してキューに積むだけにし、すぐに戻る
+        """
+        if message != self.cdio.DIOM_INTERRUPT:
+            return
+        bit = lparam
+        data = ctypes.c_ubyte()
+        self.cdio.DioInpBit(self.dio_id, bit, ctypes.byref(data))       # 変化後の値（チャタリングで戻っていることもある）
+        value = data.value
+        self.arm_interrupt(bit, value)                              # 次は逆向きの変化を待つ
+        with self.io_lock:
+            self.io_state = self.io_state | (1 << bit) if value else self.io_state & ~(1 << bit)
+        event = (time.time(), 8 - bit, value)                       # (時刻, 入力コネクタのピン番号, 値)
+        self.history.append(event)
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:                                          # 受け取り手が止まっていたら捨てる（履歴には残る）
+            self.dropped += 1
+
+    def start_buffered(self, rate=100, seconds=600):
+        """
+        DioDm系の関数（バスマスタ転送）で入力ポートを一定周期で取り込み始める
+        Pythonからはボードを読まず、必要なときにバッファの区間をまとめて集計する
+        Args:
+            rate   : 取り込み周期（Hz）
+            seconds: リングバッファに残す秒数
+        Returns:
+            bool   : 取り込みを始められたかどうか　バスマスタ非対応のボードなどではFalse
+        """
+        length = int(rate * seconds)
+        dtype = np.dtype(f"u{ctypes.sizeof(ctypes.c_ulong)}")      # ドライバのunsigned longと同じ大きさ
+        self.dm_buff = np.zeros(length, dtype=dtype)
+        period = int(1000000 / rate)                                # 取り込み周期（マイクロ秒）
+        buff = self.dm_buff.ctypes.data_as(ctypes.POINTER(ctypes.c_ulong))
+        steps = [("DioDmReset", lambda: self.cdio.DioDmReset(self.dio_id, self.cdio.DIODM_RESET_FIFO_IN)),
+                 ("DioDmSetDirection", lambda: self.cdio.DioDmSetDirection(self.dio_id, self.cdio.DIODM_DIR_IN)),
+                 ("DioDmSetStandAlone", lambda: self.cdio.DioDmSetStandAlone(self.dio_id)),
+                 ("DioDmSetStartTrg", lambda: self.cdio.DioDmSetStartTrg(self.dio_id, self.cdio.DIODM_DIR_IN, self.cdio.DIODM_START_SOFT)),
+                 ("DioDmSetClockTrg", lambda: self.cdio.DioDmSetClockTrg(self.dio_id, self.cdio.DIODM_DIR_IN, self.cdio.DIODM_CLK_CLOCK)),
+                 ("DioDmSetInternalClock", lambda: self.cdio.DioDmSetInternalClock(self.dio_id, self.cdio.DIODM_DIR_IN, period, self.cdio.DIODM_TIM_UNIT_US)),
+                 ("DioDmSetStopTrg", lambda: self.cdio.DioDmSetStopTrg(self.dio_id, self.cdio.DIODM_DIR_IN, self.cdio.DIODM_STOP_SOFT)),
+                 ("DioDmSetBuff", lambda: self.cdio.DioDmSetBuff(self.dio_id, self.cdio.DIODM_DIR_IN, buff, length, self.cdio.DIODM_WRITE_RING)),
+                 ("DioDmStart", lambda: self.cdio.DioDmStart(self.dio_id, self.cdio.DIODM_DIR_IN)),
+                 ]
+        for name, func in steps:                                    # 順に設定し、失敗したらそこでやめる
+            ret = func()
+            if ret != self.cdio.DIO_ERR_SUCCESS:
+                self.dm_buff = None
+                self.cdio.DioGetErrorString(ret, self.err_str)
+                print(f"{name} = {ret}: {self.err_str.value.decode('utf-8')}　バッファ取り込みは使いません")
+                return False
+        self.dm_rate = rate
+        self.dm_mode = True
+        return True
+
+    def stop_buffered(self):
+        """
+        バッファ取り込みを止める
+        """
+        if self.dm_mode:
+            self.dm_mode = False
+            self.cdio.DioDmStop(self.dio_id, self.cdio.DIODM_DIR_IN)
+
+    def window(self, seconds):
+        """
+        バッファ取り込みの直近の区間
+        Args:
+            seconds: 何秒分か（バッファより長ければバッファ全体）
+        Returns:
+            samples: 入力ポートの値のNumPy配列（古い順）
+        """
+        write_pointer, count, carry = ctypes.c_ulong(), ctypes.c_ulong(), ctypes.c_ulong()
+        self.cdio.DioDmGetWritePointerUserBuf(self.dio_id, self.cdio.DIODM_DIR_IN,
+                                              ctypes.byref(write_pointer), ctypes.byref(count), ctypes.byref(carry))
+        length = len(self.dm_buff)
+        end = write_pointer.value % length                          # 次に書き込まれる位置
+        available = length if carry.value else end                  # 一周していなければ書き込まれた分だけ
+        k = min(int(seconds * self.dm_rate), available)
+        if k <= end:
+            return self.dm_buff[end-k:end].copy()
+        return np.concatenate((self.dm_buff[length-(k-end):], self.dm_buff[:end]))    # 折り返しをまたぐ
+
+    def window_means(self, seconds):
+        """
+        直近の区間で各入力ピンがオンだった割合
+        Args:
+            seconds: 何秒分か
+        Returns:
+            means  : 入力ピンの順（num2arrayと同じ順）の0～1のNumPy配列　データがなければNone
+        """
+        samples = self.window(seconds)
+        if len(samples) == 0:
+            return None
+        bits = np.unpackbits(samples.astype(np.uint8)[:, None], axis=1)    # 列jがビット7-j
+        return bits[:, [7-bit for bit in self.input_bits]].mean(axis=0)
+
+    def wait_event(self, timeout):
+        """
+        入力変化を待つ
+        Args:
+            timeout: 待つ秒数
+        Returns:
+            event  : (時刻, ピン番号, 値)　変化がなければNone
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def recent_events(self, count=100):
+        """
+        直近の入力変化の履歴（古い順）
+        """
+        return list(self.history)[-count:]
 
 def main():
+    contec = Contec()
     while True:
         input_array = contec.input()
         print(f"{datetime.datetime.now().strftime('%H:%M:%S')}")
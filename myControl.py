@@ -0,0 +1,457 @@
+import collections
+import datetime
+import random
+import threading
+import time
+from myAggregate import lighting_minutes_between
+
+"""
+育成LEDの制御ループ
+これまでブラウザ（myscript.jsのshowTime, getContec, getTimeMode）がタイマーで行っていた
+・日の出日の入りから決まる時刻モード（夜／朝／昼／夕方）による強制点灯・消灯
+・光センサーの積算と、しきい値・バッテリーの色による点灯消灯の判断
+をサーバーのスレッドで1秒ごとに実行する　ブラウザは状態を見るだけになる
+"""
+
+SENSING_THRESHOLD = 0.5         # LEDを付けるか消すかのしきい値（5個×回数 に対する割合）
+LIGHT_CNT = 5                   # コンテックの入力のうち光センサーの数（残りは電圧リレー）
+
+
+def str2bool(value):
+    """
+    設定の文字列（"1"/"0"、"true"/"false"）を真偽値にする
+    """
+    return str(value).strip().lower() in ["1", "true"]
+
+
+def soc_color(soc, batt_yellow, batt_green):
+    """
+    バッテリーの残量（％）をバッテリーの色にする　設定のbatt_yellow未満は黄、batt_green未満は緑、それ以上は青
+    """
+    if soc < batt_yellow:
+        return "黄"
+    elif soc < batt_green:
+        return "緑"
+    else:
+        return "青"
+
+
+def volt_color(volts):
+    """
+    電圧リレーの状態をバッテリーの色にする
+    リレー1=緑信号（低圧）　リレー2=青信号（高圧）
+    """
+    relay1, relay2 = volts[0], volts[1]
+    if relay2:                                                          # リレー2がオンならば
+        return "青"
+    elif relay1:                                                        # リレー2がオフでリレー1がオンならば
+        return "緑"
+    else:                                                               # いずれでもなければ
+        return "黄"
+
+
+class Controller():
+    def __init__(self, db, contec=None, events=None, interval=1.0, max_messages=100, analog=None):
+        """
+        初期設定
+        Args:
+            db          : データベースのクラス
+            contec      : コンテックのクラス（input()とoutput(bool)を持つもの）Noneならば本番の入出力はしない
+            events      : 状態が変わったら知らせるEventBus　Noneならば知らせない
+            interval    : ループの周期（秒）
+            max_messages: 残しておくメッセージの数
+            analog      : MCP3004の連続取り込み（myAnalog.Analog）　あればバッテリーの色を電圧リレーでなく残量で決める
+        """
+        self.db = db
+        self.contec = contec
+        self.events = events
+        self.analog = analog
+        self.published = None                                           # 最後に知らせた状態（メッセージを除く）
+        self.published_seq = 0                                          # 最後に知らせたメッセージ番号
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.seq = 0                                                    # メッセージの通し番号
+        self.messages = collections.deque(maxlen=max_messages)          # (通し番号, 文字列)
+        self.light_log = []                                             # 今回の判断までの光センサーのログ
+
+        self.is_run = False                                             # 起動中
+        self.is_auto = True                                             # 自動か各個か
+        self.is_force = False                                           # LEDを強制的にオンオフさせるか光センサーで制御するか
+        self.is_led = False                                             # 育成LEDの点灯状態
+        self.light_on_time = None                                       # 育成LEDの点灯時刻
+        self.mode = ""                                                  # 時刻モード（夜／朝／昼／夕方）
+        self.last_mode = ""                                             # 一つ前の時刻モード　変わったら強制点灯消灯する
+        self.date = None                                                # 暦を計算した日
+        self.sunrise_time = self.sunset_time = None                     # 日の出日の入り時刻（HH:MM）
+        self.times = {}                                                 # 強制点灯の開始・終了時刻（HH:MM）
+        self.sensing_time = None                                        # 次に光センサーを積算する時刻
+        self.light_cnt = -1                                             # 光センサーの積算回数（次で0回目）
+        self.light_sum = 0                                              # 光センサーオンの累計
+        self.inputs = []                                                # 直近のコンテックの入力
+        self.volt = ""                                                  # バッテリーの色
+        self.battery = None                                             # バッテリーの電圧と残量（analogがあるとき）
+        db.config.subscribe(self.on_config)                             # 設定が変わるたびに読み込み直す
+        if str2bool(db.config.get("is_run", "0")):                      # 停電などで止まる前に運転中だったら再開する
+            self.is_run = True
+            self.add_message(f"{datetime.datetime.now():%H:%M:%S}　運転を再開しました")
+
+    def on_config(self, values, changed):
+        """
+        設定が変わったとき　運転中かどうか（is_run）は自分で書いたものなので読み込み直さない
+        """
+        if changed != {"is_run"}:
+            self.load_config(values)
+
+    def load_config(self, dict):
+        """
+        設定を読み込む　設定が変わったら光センサーの積算をやり直す
+        Args:
+            dict: 設定の辞書（DB.config.valuesと同じ形）
+        """
+        with self.lock:
+            self.config = dict
+            self.sensing_interval = int(dict["sensing_interval"])       # 何分おきに
+            self.sensing_count = int(dict["sensing_count"])             # 何回光センサーの状態を取得するか
+            self.is_contec_try = str2bool(dict["isContecTry"])
+            self.is_led_try = str2bool(dict["isLEDTry"])
+            self.is_night_sense = str2bool(dict["isNightSense"])        # 夜間でも光センサー取得するか
+            self.batt_yellow = float(dict.get("batt_yellow", 30))       # 残量がこれ未満ならば黄
+            self.batt_green = float(dict.get("batt_green", 70))         # 残量がこれ未満ならば緑
+            if self.contec is not None:                                 # コンテックリレー出力設定
+                self.contec.define_output_relays([int(dict[f"output{i}"]) for i in [1, 2, 3, 4]])
+            self.light_cnt = -1
+            self.light_sum = 0
+            self.light_log = []
+            now = datetime.datetime.now()
+            if self.is_night_sense:                                     # 夜でもセンシングする設定ならば1分後に測定する
+                self.sensing_time = (now + datetime.timedelta(minutes=1)).replace(second=30, microsecond=0)
+            else:                                                       # さもなくば時刻モードを改めて適用する
+                self.last_mode = ""
+            if self.sunrise_time is not None:
+                self.calc_times()
+
+    def start(self):
+        """
+        制御ループのスレッドを起動する
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="controller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        制御ループのスレッドを止める
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """
+        interval秒ごとにstepを実行する
+        処理時間の分だけ周期がずれていかないよう、開始時刻からの刻みで待つ
+        """
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                self.step(datetime.datetime.now())
+            except Exception as e:
+                self.add_message(f"制御エラー　{e}")
+            next_time += self.interval
+            delay = next_time - time.monotonic()
+            if delay < 0:                                               # 遅れて刻みを過ぎていたら
+                next_time += (-delay // self.interval + 1) * self.interval      # 過ぎた刻みは飛ばす
+            self.wait_until(next_time)
+
+    def wait_until(self, deadline):
+        """
+        次の刻みまで待つ
+        コンテックが割り込みモードならば、待っている間の入力変化をすぐに状態へ反映する
+        """
+        while not self.stop_event.is_set():
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                return
+            if self.contec is None or self.is_contec_try or not self.contec.event_mode:
+                self.stop_event.wait(delay)
+                return
+            if self.contec.wait_event(delay) is not None:               # 入力が変化したら
+                self.on_input()
+
+    def on_input(self):
+        """
+        割り込みで入力が変化したときの処理　光センサーランプと電圧の表示を更新する
+        積算と点灯消灯の判断はこれまでどおり刻みごとのstepで行う
+        """
+        with self.lock:
+            inputs = self.contec.input()
+            if inputs:
+                self.inputs = inputs
+                self.volt = self.battery_color(inputs)
+            self.publish()
+
+    def step(self, now):
+        """
+        1周期分の制御
+        Args:
+            now: 現在時刻（datetime）
+        """
+        with self.lock:
+            if now.date() != self.date:                                 # 日付が変わったら暦を取得しなおす
+                self.new_day(now)
+            self.update_mode(now)
+
+            is_light_cnt = False                                        # 光センサーの状態を積算するかどうか
+            if self.sensing_time is None or now >= self.sensing_time:   # センサーを取得する時刻になったら
+                self.sensing_time = (now + datetime.timedelta(minutes=self.sensing_interval)).replace(second=30, microsecond=0)
+                is_light_cnt = self.is_run and (self.mode == "昼" or self.is_night_sense)    # 運転中 かつ （昼間 もしくは夜でもセンシングする設定）
+
+            inputs = self.read_inputs()
+            if not inputs:                                              # 入力が取れなければ何もしない
+                return
+            self.inputs = inputs
+            self.volt = self.battery_color(inputs)
+            if is_light_cnt:
+                self.count_lights(now, inputs[:LIGHT_CNT])
+            self.publish()
+
+    def battery_color(self, inputs):
+        """
+        バッテリーの色　MCP3004の電圧が新しければ残量から、なければ電圧リレーから決める
+        """
+        latest = self.analog.latest(self.analog.decimate) if self.analog is not None else None
+        if latest is not None and latest["soc"] is not None and latest["age"] < 10:
+            self.battery = {"battery_v": latest["battery_v"], "soc": latest["soc"]}
+            return soc_color(latest["soc"], self.batt_yellow, self.batt_green)
+        self.battery = None
+        return volt_color(inputs[LIGHT_CNT:])
+
+    def new_day(self, now):
+        """
+        日付が変わったときの処理　日の出日の入りを求め、強制点灯の時刻を計算する
+        """
+        if self.date is not None:
+            self.add_message(f"{now:%H:%M:%S}　日付が変わった")
+        self.date = now.date()
+        try:
+            dict = self.db.get_ephem(self.date)
+            self.db.set_ephem(dict)
+            self.sunrise_time = dict["sunrise_time"]
+            self.sunset_time = dict["sunset_time"]
+            self.calc_times()
+        except Exception as e:                                          # 暦が取れなければ前日の時刻のまま
+            self.add_message(f"{now:%H:%M:%S}　暦取得失敗　{e}")
+
+    def calc_times(self):
+        """
+        日の出日の入り時刻から育成LED強制点灯の開始・終了時刻を計算する
+        """
+        sunrise = datetime.datetime.strptime(self.sunrise_time, "%H:%M")
+        sunset = datetime.datetime.strptime(self.sunset_time, "%H:%M")
+        minutes = lambda key: datetime.timedelta(minutes=int(self.config[key]))
+        morning_start = sunrise + minutes("morning_offset")
+        morning_end = morning_start + minutes("morning_minutes")
+        evening_end = sunset - minutes("evening_offset")
+        evening_start = evening_end - minutes("evening_minutes")
+        self.times = {"morning_start": morning_start.strftime("%H:%M"),
+                      "morning_end": morning_end.strftime("%H:%M"),
+                      "evening_start": evening_start.strftime("%H:%M"),
+                      "evening_end": evening_end.strftime("%H:%M"),
+                      }
+
+    def update_mode(self, now):
+        """
+        現在がどの時刻モードかを調べ、モードが変わったら強制点灯・消灯する
+        """
+        hm = now.strftime("%H:%M")
+        if not self.times:                                              # 暦が取れていなければ判断しない
+            self.mode = ""
+            return
+        if hm >= self.times["evening_end"]:                           # 日の入り以降は強制OFF
+            mode = "夜"
+        elif hm >= self.times["evening_start"]:                         # 日の入り1.5H前以降は強制ON
+            mode = "夕方"
+        elif hm >= self.times["morning_end"]:                           # 日の出1.5H後以降は自動制御
+            mode = "昼"
+        elif hm >= self.times["morning_start"]:                         # 日の出以降は強制ON
+            mode = "朝"
+        else:                                                           # それ以前（0時以降）は強制OFF
+            mode = "夜"
+        self.mode = mode
+
+        if not self.is_run:                                             # 運転中でなかったら
+            self.last_mode = ""                                         # 起動がかかったときモードを適用するため
+            return
+        if mode == self.last_mode:
+            return
+        self.last_mode = mode
+        if mode == "夜":
+            self.is_force, is_led = True, False
+        elif mode in ["朝", "夕方"]:
+            self.is_force, is_led = True, True
+        else:                                                           # 昼は光センサーで制御する
+            self.is_force, is_led = False, self.is_led
+        self.add_message(f"{now:%H:%M:%S}　モード変更　{mode}")
+        self.set_led(now, is_led)
+
+    def read_inputs(self):
+        """
+        コンテックの入力　トライならば乱数
+        """
+        if self.is_contec_try:
+            return [random.choice([1, 0]) for _ in range(8)]
+        if self.contec is None:
+            return []
+        return self.contec.input()
+
+    def count_lights(self, now, lights):
+        """
+        光センサーの状態を積算し、指定した回数になったら点灯消灯を判断する
+        """
+        window = self.light_window()
+        if window is not None:                                          # バッファ取り込みならば区間の平均を使う
+            lights = window
+        self.light_cnt = (self.light_cnt + 1) % self.sensing_count
+        if self.light_cnt == 0:                                         # 0回目ならば積算をやり直す
+            self.light_sum = 0
+            self.light_log = []
+        self.light_sum = round(self.light_sum + sum(lights), 3)
+        log = "".join("○" if v >= 0.5 else "−" for v in lights)
+        self.light_log.append(f"{now:%H:%M:%S}　#{self.light_cnt+1}　{log}")
+        if self.light_cnt == self.sensing_count - 1:                    # 指定した回数だけセンサー値を測定したら
+            self.decide(now)
+
+    def light_window(self):
+        """
+        コンテックがバッファ取り込みをしていれば、前回の積算から今までの各光センサーの曇りの割合（0～1）
+        一瞬の値でなく区間全体で判断できる
+        Returns:
+            list: 光センサーごとの割合　バッファ取り込みでなければNone
+        """
+        if self.contec is None or self.is_contec_try or not self.contec.dm_mode:
+            return None
+        means = self.contec.window_means(self.sensing_interval * 60)
+        if means is None:
+            return None
+        return [round(float(v), 3) for v in means[:LIGHT_CNT]]
+
+    def decide(self, now):
+        """
+        光センサーの積算としきい値、バッテリーの色から点灯消灯を判断する
+        """
+        th = LIGHT_CNT * self.sensing_count * SENSING_THRESHOLD
+        self.light_log.append(f"曇りのカウント{self.light_sum}　　しきい値{th}")
+        was_led = self.is_led                                           # さっきまで点灯していたか
+        if self.light_sum < th:                                         # しきい値未満ならば消灯にする
+            is_led = False
+            msg = f"十分明るいので消灯します　点灯時間 {self.lighting_minutes(now)}分" if was_led else "消灯を継続します"
+        elif self.volt in ["青", "緑"]:                                 # しきい値以上で電圧が青か緑ならば点灯にする
+            is_led = True
+            msg = "点灯を継続します" if was_led else "暗いので点灯します"
+        else:                                                           # 電圧が黄色ならば消灯にする
+            is_led = False
+            msg = f"消灯します　点灯時間 {self.lighting_minutes(now)}分" if was_led else "消灯を継続します"
+        self.add_message(f"{now:%H:%M:%S}　{msg}")
+        self.light_log.append(msg)
+        self.set_led(now, is_led)
+
+    def lighting_minutes(self, now):
+        """
+        点灯してから今までの時間（分）
+        """
+        if self.light_on_time is None:
+            return 0
+        return lighting_minutes_between(self.light_on_time, now)
+
+    def set_led(self, now, is_led):
+        """
+        育成LEDを点灯・消灯し、DBに記録する
+        """
+        if is_led and not self.is_led:                                  # 消灯から点灯になったら
+            self.light_on_time = now
+        self.is_led = is_led
+        if not self.is_led_try and self.contec is not None:             # 本番ならば
+            self.contec.output(is_led)
+        self.db.set_LED(int(is_led))
+
+    def command(self, action):
+        """
+        画面からの操作
+        Args:
+            action: run（起動）/ stop（停止）/ auto（自動）/ manual（各個）/ led_on, led_off（各個のときの強制点灯）
+        """
+        now = datetime.datetime.now()
+        with self.lock:
+            was_run = self.is_run
+            if action == "run" and self.is_auto and not self.is_run:    # 自動モードのみ起動可能
+                self.is_run = True
+                self.add_message(f"{now:%H:%M:%S}　起動しました")
+                self.update_mode(now)
+            elif action == "stop" and self.is_run:                      # 起動中のみ停止可能
+                self.is_run = False
+                self.last_mode = ""
+                self.add_message(f"{now:%H:%M:%S}　停止しました")
+            elif action == "auto" and not self.is_auto:
+                self.is_auto = True
+                self.add_message(f"{now:%H:%M:%S}　自動に切り替えました")
+            elif action == "manual" and self.is_auto:                   # 手動にしたら運転が落ちる
+                self.is_auto = False
+                self.is_run = False
+                self.last_mode = ""
+                self.set_led(now, False)
+                self.add_message(f"{now:%H:%M:%S}　手動に切り替えました")
+            elif action in ["led_on", "led_off"] and not self.is_auto:  # 強制点灯は手動操作時のみ
+                self.set_led(now, action == "led_on")
+            if self.is_run != was_run:                                  # 運転中かどうかは再起動しても残す
+                self.db.config.set("is_run", int(self.is_run))
+            self.publish()
+
+    def publish(self):
+        """
+        状態が変わっていたら、または新しいメッセージがあればイベントとして知らせる
+        """
+        if self.events is None:
+            return
+        with self.lock:
+            state = self.state(self.published_seq)
+            current = {key: value for key, value in state.items() if key not in ["seq", "messages"]}
+            if current == self.published and not state["messages"]:    # 何も変わっていなければ知らせない
+                return
+            self.published = current
+            self.published_seq = state["seq"]
+        self.events.publish("control", state)
+
+    def add_message(self, txt):
+        """
+        メッセージを残す
+        """
+        with self.lock:
+            self.seq += 1
+            self.messages.append((self.seq, txt))
+
+    def state(self, since=0):
+        """
+        画面に表示する状態
+        Args:
+            since: このメッセージ番号より後のメッセージだけを返す
+        """
+        with self.lock:
+            return {"is_run": self.is_run,
+                    "is_auto": self.is_auto,
+                    "is_led": self.is_led,
+                    "mode": self.mode,
+                    "times": self.times,
+                    "log": "".join("○" if v == 1 else "−" for v in self.inputs),
+                    "volt": self.volt,
+                    "battery": self.battery,
+                    "light_cnt": self.light_cnt,
+                    "light_sum": self.light_sum,
+                    "light_log": self.light_log,
+                    "seq": self.seq,
+                    "messages": [[seq, txt] for seq, txt in self.messages if seq > since],
+                    }
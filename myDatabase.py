@@ -1,63 +1,182 @@
 import sqlite3
 import datetime
-import pandas as pd
+import threading
+import queue
+import contextlib
+import mySchema
+import myQuery
+from myAggregate import Aggregator, DailySummary
+from myGraphCache import GraphCache
+from myWriter import WriteBehind
+from myRollup import Rollup
+from myArchive import Archive, cutoff, next_month
+from myExport import Exporter
+from myRetention import Retention
+from myEphem import EphemTable
+from myConfigStore import ConfigStore
 import random
-import matplotlib
-matplotlib.use("Agg")                   # メインスレッド外で使うときはこうする
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import numpy as np
-import cv2
-import base64
+
+SUMMARY_SOURCES = ("temperature", "light")                              # 書き込むとサマリーが変わるテーブル
+
+
+class ConnectionPool():
+    """
+    SQLiteの接続を使い回すためのプール
+    接続はWALモードで開き、リクエストのたびに開け閉めしない
+    """
+    def __init__(self, dbname, size=4, timeout=10):
+        """
+        初期設定
+        Args:
+            dbname : データベース名
+            size   : プールしておく接続の最大数（Flaskのワーカースレッド数に合わせる）
+            timeout: 接続が空くのを待つ秒数 兼 ロック解除を待つ秒数
+        """
+        self.dbname = dbname
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()                                   # 空いている接続　直近に使ったものから再利用する
+        self.local = threading.local()                                  # スレッドごとに借りている接続
+        self.lock = threading.Lock()
+        self.created = 0                                                # これまでに作った接続の数
+
+    def open(self):
+        """
+        新しい接続を作り、プラグマを設定する
+        Returns:
+            conn : sqlite3の接続
+        """
+        conn = sqlite3.connect(self.dbname, timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")                         # 読み込みと書き込みが互いに待たない
+        conn.execute("PRAGMA synchronous=NORMAL")                       # WALならNORMALでも壊れない　コミットごとのfsyncをなくす
+        conn.execute(f"PRAGMA busy_timeout={int(self.timeout*1000)}")   # ロック中は即エラーにせず待つ
+        conn.execute("PRAGMA temp_store=MEMORY")                        # 一時テーブルはメモリ上に
+        conn.execute("PRAGMA cache_size=-8000")                         # ページキャッシュ 8MB
+        return conn
+
+    def acquire(self):
+        """
+        接続を借りる　空きがなく上限に達していれば返却を待つ
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:                                # まだ上限に達していなければ新しく作る
+                self.created += 1
+                return self.open()
+        return self.idle.get(timeout=self.timeout)                      # 上限に達していれば返却を待つ
+
+    def release(self, conn):
+        """
+        接続を返す　コミットされていない変更は取り消しておく
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        with文で接続を借りる
+        同じスレッドの中で入れ子になった場合は同じ接続を使う
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:                                            # このスレッドが既に借りていれば
+            yield conn                                                  # それをそのまま使う
+            return
+        conn = self.acquire()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self.release(conn)
+
+    def close(self):
+        """
+        空いている接続をすべて閉じる
+        """
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
 
 class DB():
-    def __init__(self):
+    def __init__(self, dbname="agri.db"):
         """
         初期設定
         """
-        self.dbname = "agri.db"                                         # データベース名
-        self.get_config()                                               # 設定データを読み込む
+        self.dbname = dbname                                            # データベース名
+        self.pool = ConnectionPool(self.dbname)                         # 接続プール
+        self.aggregator = Aggregator()                                  # 日ごとのサマリーの集計器
+        self.rollup = Rollup()                                          # 5分・1時間・1日ごとのロールアップ
+        self.archive = Archive()                                        # 古い生データの月ごとのアーカイブ
+        self._archived_before = None                                    # アーカイブとSQLiteの境目の日付
+        self.retention = Retention(self)                                # 古いデータのバックグラウンド削除
+        self.ephem_table = EphemTable()                                 # 1年分の暦
+        self.graph_cache = GraphCache()                                 # 描画済みグラフのキャッシュ
+        self.versions = {}                                              # (テーブル, 日付) → データのバージョン
+        self.version_lock = threading.Lock()
+        self.version_counter = 0                                        # バージョンの通し番号　同じ値は二度と使わない
+        self.listeners = []                                             # データが変わったときに呼ぶ関数
+        self.writer = WriteBehind(self.write_batch)                     # センサー値はまとめて書き込む
+        with self.pool.connection() as conn:
+            mySchema.migrate(conn)                                      # スキーマを最新にする
+        self.config = ConfigStore(self.pool)                            # 設定はメモリに置く
+        self.config.load()                                              # 設定データを読み込む
+        self.config.subscribe(self.on_config, ["cumsum_date", "place", "lat", "lon", "elev"])
         self.dpi = 72                                                   # グラフ作成時のdpi
-        plt.rcParams["figure.dpi"] = self.dpi
-        plt.rcParams["font.family"] = "MS Gothic"
-        plt.rcParams["font.size"] = 20
+        self._figures = None                                            # グラフのひな形（最初のグラフのときに作る）
+        self.figures_lock = threading.Lock()
+        self.writer.start()
+
+
+    @property
+    def figures(self):
+        """
+        グラフのひな形　matplotlibは重いので、最初にグラフを描くときに読み込んで作る
+        （起動してセンサーと制御ループが動き出すまでを速くするため）
+        """
+        with self.figures_lock:
+            if self._figures is None:
+                import matplotlib
+                from myFigure import Figures
+                matplotlib.rcParams["figure.dpi"] = self.dpi
+                matplotlib.rcParams["font.family"] = "MS Gothic"
+                matplotlib.rcParams["font.size"] = 20
+                self._figures = Figures(self.dpi)                       # フォント設定の後に作る
+            return self._figures
 
 
     def get_config(self):
         """
-        設定データを取得する
-        """
-        sql = f"SELECT * FROM config"
-        conn = sqlite3.connect(self.dbname)
-        df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
-        conn.close()
-        df = df.set_index("index")                                      # index列をインデックスに設定する
-        dict = {}
-        for index, row in df.iterrows():                                # dataframeを辞書にする
-            dict[index] = row["value"]
-        # 辞書の中でよく使う値を変数として設定する
-        self.cumsum_date =  dict["cumsum_date"]                         # 累計の始点
-        self.ephem_config = {   "place": dict["place"],
-                                "lat": dict["lat"],
-                                "lon": dict["lon"],
-                                "elev": dict["elev"],
-                            }
-        return dict
+        設定データを取得する（メモリの設定を返すだけ）
+        """
+        return dict(self.config.values)
 
 
     def set_config(self, dict):
         """
-        設定データを書き込む
+        設定データを書き込む　変わったキーだけをupsertし、使い手（on_configなど）に知らせる
+        Returns:
+            changed: 変わったキーの集合
+        """
+        return self.config.update(dict)
+
+
+    def on_config(self, values, changed):
+        """
+        設定が変わったときに、よく使う値を変数として設定する
         """
-        df = pd.DataFrame(index=[], columns=["index", "value"])         # 空のデータフレームを用意する
-        for key, value in dict.items():                                 # 辞書をデータフレームにする
-            df.loc[key] = [key, value]
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        df.to_sql("config", conn, if_exists="replace", index=None)      # dfをデータベースに書き込む
-        cur.close()
-        conn.close()
-        self.cumsum_date = df.at["cumsum_date", "value"]              # 累計の始点
+        self.cumsum_date = values["cumsum_date"]                        # 累計の始点
+        self.ephem_config = {key: values[key] for key in ["place", "lat", "lon", "elev"]}  # 場所が変われば暦を計算し直す
 
 
     def set_temperature(self, temp, humi, strdt=None):
@@ -68,59 +187,198 @@ class DB():
             humi : 湿度
             strdt: 日時（文字列） Noneならば今
         Returns:
-            imgB64: デイリーグラフ
+            bool : 登録したかどうか（書き込みは書き込みスレッドが後でまとめて行う）
         """
         if humi == -1:                                                  # 湿度が-1ならばセンサー値取得できていないので
-            return "None"                                               # "None"を返す
+            return False                                                # 登録しない
         if strdt is None:                                               # 日時がNoneだったら
             dt = datetime.datetime.now()                                # 現在時刻
             strdt = dt.strftime("%Y/%m/%d %H:%M")                       # 日時の文字列
             strdate = dt.strftime("%Y/%m/%d")                           # 日付の文字列
         else:                                                           # 日時が文字列として与えられていたら
-            strdate = dt.split(" ")[0]                                  # スペースで区切った最初のほうが日付
-
-        sql = f"INSERT INTO temperature VALUES('{strdate}','{strdt}', {temp}, {humi})"
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        cur.execute(sql)
-        conn.commit()
-        cur.close()
-        conn.close()
-        self.set_temp_summary(strdate)                                  # その日の温度サマリーデータを更新する
-        imgB64 = self.make_daily_temp_graph(strdate)                    # デイリーデータ作成
-        return imgB64
+            strdate = strdt.split(" ")[0]                               # スペースで区切った最初のほうが日付
+        epoch = int(str2datetime(strdt).timestamp())                    # エポック秒
+
+        self.writer.put(("temperature", (strdate, strdt, temp, humi, epoch)))    # 書き込みスレッドがまとめて書く
+        return True
 
 
-    def set_temp_summary(self, date):
+    def write_batch(self, items):
         """
-        温度のサマリーデータを登録する
+        溜まったセンサー値を一つのトランザクションで書き込む（書き込みスレッドから呼ばれる）
+        生データはexecutemanyで、サマリーは日ごとに一度だけ更新する
         Args:
-            date: 日付（文字列）
+            items: (テーブル名, 行のタプル) のリスト　行の並びはINSERT文の列の順
         """
-        summary_exists = self.exists("summary", date)                   # サマリーにその日のデータがあるか
-        temp_exists = self.exists("temperature", date)                  # 温湿度テーブルにその日のデータがあるか
-        if temp_exists:                                                 # 温湿度テーブルにその日のデータがあるならば
-            df = self.get_temperature(date)                             # その日の温湿度データを取得する
-            max_temp = df["temperature"].max()                          # その日の最高気温
-            min_temp = df["temperature"].min()                          # その日の最低気温
-            mean_temp = (max_temp+min_temp)/2                           # 最高気温と最低気温の中間
-            if summary_exists:                                          # サマリーにその日のデータがあれば更新する
-                sql = f"UPDATE summary"\
-                        f" SET max_temp={max_temp}, min_temp={min_temp}, mean_temp={mean_temp}"\
-                        f" WHERE date='{date}'"
-            else:                                                       # サマリーにその日のデータがなければ追加挿入する
-                sql = f"INSERT INTO summary(date, max_temp, min_temp, mean_temp)"\
-                        f" VALUES('{date}','{max_temp}', {min_temp}, {mean_temp})"
-            conn = sqlite3.connect(self.dbname)
-            cur = conn.cursor()
-            cur.execute(sql)
+        rows = {"temperature": [], "light": [], "analog": []}
+        summaries = {}                                                  # 日付 → その日の集計
+        touched = []                                                    # 書き込んだ (テーブル, 日付)
+        with self.pool.connection() as conn, self.aggregator.lock:
+            try:
+                for table, row in items:                                # 来た順に集計に加える
+                    date = row[0]
+                    if table == "analog":                               # 電圧はサマリーに関係しない
+                        rows[table].append(row)
+                        continue
+                    if date not in summaries:
+                        summaries[date] = self.aggregator.get(conn, date)   # その日の集計（挿入前の生データから）
+                    if table == "temperature":
+                        summaries[date].add_temperature(row[2])
+                    else:
+                        summaries[date].add_light(str2datetime(row[1]), int(row[2]))
+                    rows[table].append(row)
+                    if (table, date) not in touched:
+                        touched.append((table, date))
+                self.rollup.add(conn, [(row[1], row[2]) for row in rows["temperature"]],
+                                [(row[1], row[2]) for row in rows["light"]])    # 挿入の前に（最後の点灯サンプルを読むため）
+                conn.executemany("INSERT INTO temperature(date, datetime, temperature, humidity, epoch) VALUES(?, ?, ?, ?, ?)",
+                                 rows["temperature"])
+                conn.executemany("INSERT INTO light(date, datetime, value, epoch) VALUES(?, ?, ?, ?)", rows["light"])
+                conn.executemany("INSERT INTO analog(date, datetime, epoch, ch0, ch1, ch2, ch3, battery_v, soc)"
+                                 " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)", rows["analog"])
+                for table, date in touched:                             # サマリーも同じトランザクションで更新する
+                    if table == "temperature":
+                        self.save_temp_summary(conn, summaries[date])
+                    else:
+                        self.save_LED_summary(conn, summaries[date])
+                conn.commit()
+            except Exception:
+                for date in summaries:                                  # DBと食い違わないよう集計を捨てる
+                    self.aggregator.forget(date)
+                self.rollup.forget()
+                raise
+        for table, date in touched:
+            self.bump_version(table, date)
+        for date in sorted({row[0] for row in rows["analog"]}):
+            self.bump_version("analog", date)
+
+
+    def set_analog(self, dict):
+        """
+        間引いたMCP3004の電圧を登録する（書き込みスレッドがまとめて書く）
+        Args:
+            dict : myAnalog.Analog.latest()と同じ形の辞書
+        """
+        strdt = dict["time"][:16]                                       # 'YYYY/MM/DD HH:MM'
+        volts = (list(dict["volts"]) + [None] * 4)[:4]                  # ch0～ch3
+        epoch = int(str2datetime(strdt).timestamp())
+        self.writer.put(("analog", (strdt[:10], strdt, epoch, *volts, dict["battery_v"], dict["soc"])))
+
+
+    def get_battery(self, date_from, date_to):
+        """
+        期間のバッテリーの電圧と残量
+        Args:
+            date_from, date_to: 期間（日付の文字列、両端を含む）
+        Returns:
+            dict : {"datetime", "battery_v", "soc"}　それぞれ古い順のリスト
+        """
+        self.flush(date_from, date_to)                                  # その期間の行が溜まっているときだけ先に書き込む
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT datetime, battery_v, soc FROM analog WHERE date BETWEEN ? AND ? ORDER BY date, datetime",
+                                (date_from, date_to)).fetchall()
+        return {"datetime": [row[0] for row in rows],
+                "battery_v": [row[1] for row in rows],
+                "soc": [row[2] for row in rows]}
+
+
+    def flush(self, date_from=None, date_to=None):
+        """
+        書き込み待ちのセンサー値を今すぐ書き込む
+        期間を渡したときは、その期間の行が書き込み待ちのときだけ書き込む
+        （読み込みのたびにリクエストのスレッドでコミットすると、ダッシュボードが更新を繰り返すあいだ
+        　書き込みをまとめる意味がなくなるので、読むデータに関係のない行は書き込みスレッドに任せる）
+        Args:
+            date_from: 期間の始まり（日付の文字列）Noneならば始まりを限らない
+            date_to  : 期間の終わり（日付の文字列）Noneならば期間によらず書き込む
+        """
+        if date_to is not None and not self.writer.pending_between(date_from, date_to):
+            return
+        self.writer.flush()
+
+
+    def save_temp_summary(self, conn, summary):
+        """
+        温度のサマリーデータを登録する（コミットは呼び出し側で）
+        Args:
+            conn   : 接続
+            summary: その日の集計（DailySummary）
+        """
+        sql = "INSERT INTO summary(date, max_temp, min_temp, mean_temp, temp_count, temp_sum) VALUES(?, ?, ?, ?, ?, ?)"\
+                " ON CONFLICT(date) DO UPDATE SET max_temp=excluded.max_temp, min_temp=excluded.min_temp,"\
+                " mean_temp=excluded.mean_temp, temp_count=excluded.temp_count, temp_sum=excluded.temp_sum"
+        conn.execute(sql, (summary.date, summary.max_temp, summary.min_temp, summary.mean_temp,
+                            summary.temp_count, summary.temp_sum))
+
+
+    def save_LED_summary(self, conn, summary):
+        """
+        点灯時間のサマリーデータを登録する（コミットは呼び出し側で）
+        点灯中ならば最後のサンプルの時刻までを点灯時間に含める
+        Args:
+            conn   : 接続
+            summary: その日の集計（DailySummary）
+        """
+        sql = "INSERT INTO summary(date, lighting_minutes) VALUES(?, ?)"\
+                " ON CONFLICT(date) DO UPDATE SET lighting_minutes=excluded.lighting_minutes"
+        conn.execute(sql, (summary.date, summary.lighting_minutes_until()))
+
+
+    def rebuild_summary(self, date=None):
+        """
+        その日のサマリーを生データから作り直す
+        Args:
+            date: 日付（文字列）Noneならば今日
+        """
+        self.flush()                                                    # 溜まっている書き込みを先に済ませる
+        if date is None:                                                # 日付がNoneだったら
+            date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
+        with self.pool.connection() as conn, self.aggregator.lock:
+            summary = self.aggregator.rebuild(conn, date)
+            if summary.temp_count:                                      # 温度データがあれば
+                self.save_temp_summary(conn, summary)
+            if summary.last_dt is not None:                             # 点灯データがあれば
+                self.save_LED_summary(conn, summary)
             conn.commit()
-            cur.close()
-            conn.close()
+        self.bump_version("temperature", date)
+        self.bump_version("light", date)
+
+    def bump_version(self, table, date):
+        """
+        データが変わったことを記録する　そのデータを使うグラフはキャッシュから外れる
+        Args:
+            table: テーブル名
+            date : 日付（文字列）
+        """
+        with self.version_lock:
+            self.version_counter += 1
+            self.versions[(table, date)] = self.version_counter
+            if table in SUMMARY_SOURCES:                                # サマリーのもとになるデータならば
+                self.versions[("summary", None)] = self.version_counter # サマリー全体のバージョンも進める
+        for func in self.listeners:                                     # 画面などに知らせる
+            func(table, date)
+
+
+    def add_listener(self, func):
+        """
+        データが変わったときに呼ぶ関数を登録する
+        Args:
+            func: func(テーブル名, 日付) の形で呼ばれる　すぐに戻ること
+        """
+        self.listeners.append(func)
+
+
+    def data_version(self, *keys):
+        """
+        (テーブル, 日付) の組のデータのバージョン
+        """
+        with self.version_lock:
+            return tuple(self.versions.get(key, 0) for key in keys)
+
 
     def make_daily_temp_graph(self, date=None):
         """
-        温度デイリーグラフ
+        温度デイリーグラフ　データが変わっていなければキャッシュを返す
         Args:
             date: 日付（文字列）Noneならば今日
         Returns:
@@ -128,52 +386,71 @@ class DB():
         """
         if date is None:                                                # 日付がNoneだったら
             date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
+        self.flush(date, date)                                          # その日の行が溜まっているときだけ先に書き込む
+        version = self.data_version(("temperature", date), ("ephem", date))
+        return self.graph_cache.get("daily_temp", date, version, lambda: self.render_daily_temp_graph(date))
+
+
+    def daily_summary(self, conn, date, temps=None, lights=None):
+        """
+        その日の集計（DailySummary）
+        集計器はSQLiteしか読まないので、アーカイブ済みの日はアーカイブとつないだ行から集計する（キャッシュしない）
+        Args:
+            conn  : 接続
+            date  : 日付（文字列）
+            temps : その日の (datetime, temperature) の行　Noneならば読む
+            lights: その日の (datetime, value) の行　Noneならば読む
+        """
+        if date >= self.archived_before:
+            return self.aggregator.get(conn, date)
+        if temps is None:
+            temps = self.raw_rows(conn, "temperature", ["datetime", "temperature"], date, date)
+        if lights is None:
+            lights = self.raw_rows(conn, "light", ["datetime", "value"], date, date)
+        summary = DailySummary(date)
+        for strdt, temp in temps:
+            summary.add_temperature(temp)
+        for strdt, value in lights:
+            summary.add_light(str2datetime(strdt), int(value))
+        return summary
+
+
+    def daily_row(self, conn, date):
+        """
+        デイリーグラフに使うその日の日の出・日の入り・平均気温
+        サマリーの行がまだない日（始まったばかりの日）は、日の出・日の入りを暦の表から引き、平均気温はNone
+        Returns:
+            (sunrise_time, sunset_time, mean_temp)
+        """
+        row = conn.execute("SELECT sunrise_time, sunset_time, mean_temp FROM summary WHERE date=?", (date,)).fetchone()
+        if row is None or None in row[:2]:
+            ephem = self.ephem_table.lookup(conn, self.ephem_config, datetime.datetime.strptime(date, "%Y/%m/%d").date())
+            row = (ephem["sunrise_time"], ephem["sunset_time"], row[2] if row else None)
+        return row
+
+
+    def render_daily_temp_graph(self, date):
+        """
+        温度デイリーグラフを描画する
+        Args:
+            date: 日付（文字列）
+        Returns:
+            strB64: 画像
+        """
+        with self.pool.connection() as conn:
+            # 温度データ取得（日時の順）
+            rows = self.raw_rows(conn, "temperature", ["datetime", "temperature"], date, date)
+            # サマリーデータ取得
+            sunrise_time, sunset_time, mean_temp = self.daily_row(conn, date)
 
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        # 温度データ取得
-        sql = f"SELECT * FROM temperature WHERE date='{date}' ORDER BY date ASC"
-        df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
-        # サマリーデータ取得
-        sql = f"SELECT sunrise_time, sunset_time, mean_temp FROM summary WHERE date='{date}'"
-        cur.execute(sql)
-        result = cur.fetchall()[0]                                      # fetchはリストを返すのでその中身を取得する
-        cur.close()
-        conn.close()
-
-        df["datetime"] = pd.to_datetime(df["datetime"])                 # 文字列の日時をdatetimeに変換する
-        df = df.set_index("datetime")                                   # datetime列をインデックスにする
-        df = df.sort_index()                                            # 時間（インデックス）で並び替え
-        sunrise_time, sunset_time, mean_temp = result
         dt_now = datetime.datetime.now()                                # 今
         dt_sunrise = str2datetime(f"{date} {sunrise_time}")             # 日の出
         dt_sunset = str2datetime(f"{date} {sunset_time}")               # 日の入り
         dt_0 = str2datetime(f"{date} 00:00")                            # 指定した日の00:00のdatetime
         dt_24 = str2datetime(f"{date} 23:59")
         # グラフ描画
-        x = df.index.to_list()
-        y = df["temperature"].tolist()
-
-        width_px, height_px = 900, 200                                  # ピクセルでのサイズ
-        width_in, height_in = width_px/self.dpi, height_px/self.dpi     # インチでのサイズ（整数でなくてもよい）
-        fig, ax = plt.subplots(figsize=(width_in, height_in))
-        ax.spines["right"].set_visible(False)
-        ax.spines["top"].set_visible(False)
-        plt.gca().spines['right'].set_visible(False)
-        plt.gca().spines['top'].set_visible(False)
-        ax.set_xlim(dt_0, dt_24)
-        locator = mdates.AutoDateLocator()
-        locator.intervald["HOURLY"] = 3                                 # x軸 3時間ごとに目盛表記
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%H"))
-        ax.axvspan(dt_0, dt_sunrise, color="gray", alpha=0.3)           # 夜の背景
-        ax.axvspan(dt_sunset, dt_24, color="gray", alpha=0.3)
-        ax.vlines(dt_now, min(y), max(y), "RED")                        # 現在時刻に赤線
-        ax.hlines(mean_temp, dt_0, dt_24, "BLUE", linestyles="dotted")
-        ax.plot(x, y, "-b", linewidth=2)
-        ax.set_title(f"{date}の気温 平均{mean_temp}度")
-        fig.tight_layout()
-        fig.canvas.draw()
-        imgB64 = fig2str64(fig)
+        x, y = myQuery.series(rows)                                     # 文字列の日時をdatetimeに変換する
+        imgB64 = self.figures.daily_temp.render(date, x, y, mean_temp, dt_0, dt_24, dt_sunrise, dt_sunset, dt_now)
         return imgB64
 
 
@@ -185,14 +462,14 @@ class DB():
         Returns:
             df   : dataframe
         """
-        conn = sqlite3.connect(self.dbname)
+        import pandas as pd                                             # pandasは使うときに読み込む
         if date is None:                                                # 日付がNoneだったら
             date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
-
-        sql = f"SELECT * FROM light WHERE date='{date}' ORDER BY datetime ASC"
-        df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
-        conn.close()
-        return df
+        self.flush(date, date)                                          # その日の行が溜まっているときだけ先に書き込む
+        with self.pool.connection() as conn:
+            columns = ["date", "datetime", "value", "epoch"]
+            rows = self.raw_rows(conn, "light", columns, date, date)        # アーカイブとつなぐ
+        return pd.DataFrame(rows, columns=columns)
 
 
     def set_LED(self, value):
@@ -200,105 +477,65 @@ class DB():
         LED状態をDBに追加する
         Args:
             value: オン=1/ オフ=0
-        Returns:
-            imgB64: デイリーグラフの画像
         """
         # DBに登録する
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
         dt_now = datetime.datetime.now()                                # 今
         strdate = dt_now.strftime("%Y/%m/%d")                           # 日付
         strdt = dt_now.strftime("%Y/%m/%d %H:%M")                       # 日時
-        sql = f"INSERT INTO light VALUES('{strdate}','{strdt}', '{value}')"
-        cur.execute(sql)
-        conn.commit()
-        cur.close()
-        conn.close()
-        self.set_LED_summary(strdate)
-        strB64 = db.make_daily_light_graph(strdate)
-        return strB64
+        epoch = int(str2datetime(strdt).timestamp())                    # エポック秒
+        self.writer.put(("light", (strdate, strdt, value, epoch)))      # 書き込みスレッドがまとめて書く
 
 
-    def set_LED_summary(self, date):
+    def make_daily_light_graph(self, date=None):
         """
-        点灯時間のサマリーデータを登録する
+        LED点灯状態のデイリーグラフ　データが変わっていなければキャッシュを返す
         Args:
-            date: 日付（文字列）
+            date: 日付（テキスト） Noneならば今日
+        Returns:
+            imgB64: デイリーグラフの画像
         """
-        dt_0 = str2datetime(f"{date} 00:00")                            # 指定した日の00:00のdatetime
-        dt_24 = str2datetime(f"{date} 23:59")                           # 指定した日の23:59のdatetime
-        summary_exists = self.exists("summary", date)                   # サマリーにその日のデータがあるか
-        led_exists = self.exists("LED", date)                           # LEDテーブルにその日のデータがあるか
-        if led_exists:                                                  # LEDテーブルにその日のデータがあるならば
-            df = self.get_LED(date)                                     # その日のLEDデータを取得する
-            df["datetime"] = pd.to_datetime(df["datetime"])             # 文字列の日時をdatetimeに変換する
-            x = df["datetime"].to_list()                                # 時刻をリストにする
-            x.append(dt_24)                                             # 23:59を追加
-            y = df["value"].tolist()                                    # 値をリストにする
-            y.append(0)                                                 # 0を追加
-            lighting_minutes = 0                                        # 累計時間初期値
-            last_value = 0                                              # 最初はオフ
-            last_dt = dt_0                                              # 最初は00:00
-            for dt, value in zip(x, y):                                 # xとyの各要素について
-                if not last_value and value:                            # オフからオンになったら
-                    last_dt = dt                                        # その時刻を覚えておく
-                elif last_value and not value:                          # オンからオフになったら
-                    timedelta = (dt - last_dt).total_seconds()          # オンになった時刻からの時間差を秒で求める
-                    lighting_minutes += int((timedelta + 5)/60)         # 念のため+5秒した上で分にして累計にプラスする
-                last_value = value                                      # 次の値と比較するためこの値を覚えておく
-
-            if summary_exists:                                          # サマリーにその日のデータがあれば更新する
-                sql = f"UPDATE summary"\
-                        f" SET lighting_minutes={lighting_minutes}"\
-                        f" WHERE date='{date}'"
-            else:                                                       # データがなければ追加挿入する
-                sql = f"INSERT INTO summary(date, lighting_minutes)"\
-                        f" VALUES('{date}', {lighting_minutes})"
-            conn = sqlite3.connect(self.dbname)
-            cur = conn.cursor()
-            cur.execute(sql)
-            conn.commit()
-            cur.close()
-            conn.close()
+        if date is None:                                                # 日付がNoneだったら
+            date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
+        self.flush(date, date)                                          # その日の行が溜まっているときだけ先に書き込む
+        version = self.data_version(("light", date), ("ephem", date))
+        return self.graph_cache.get("daily_light", date, version, lambda: self.render_daily_light_graph(date))
 
 
-    def make_daily_light_graph(self, date=None):
+    def render_daily_light_graph(self, date):
         """
-        LED点灯状態のデイリーグラフを作成する
+        LED点灯状態のデイリーグラフを描画する
         Args:
-            date: 日付（テキスト） Noneならば今日
+            date: 日付（テキスト）
         Returns:
             imgB64: デイリーグラフの画像
         """
         today = datetime.date.today().strftime("%Y/%m/%d")              # 今日の文字列
-        if date is None:                                                # 日付がNoneだったら
-            date = today                                                # 今日の文字列
         # 指定した日のサマリーデータ取得する
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        sql = f"SELECT sunrise_time, sunset_time FROM summary WHERE date='{date}'"
-        cur.execute(sql)
-        result = cur.fetchall()[0]
-        cur.close()
-        conn.close()
-        sunrise_time, sunset_time = result                              # 日の出、日の入り
+        with self.pool.connection() as conn:
+            sunrise_time, sunset_time, _ = self.daily_row(conn, date)   # 日の出、日の入り
         dt_sunrise = str2datetime(f"{date} {sunrise_time}")             # 日の出時刻のdatetime
         dt_sunset = str2datetime(f"{date} {sunset_time}")               # 日の入り時刻のdatetime
         dt_now = datetime.datetime.now()                                # 現在時刻のdatetime
         dt_0 = str2datetime(f"{date} 00:00")                            # 指定した日の00:00のdatetime
         dt_24 = str2datetime(f"{date} 23:59")                           # 指定した日の23:59のdatetime
-        df = self.get_LED(date)                                         # 点灯データ取得する
-        df["datetime"] = pd.to_datetime(df["datetime"])                 # 日時を文字列からdatetimeにする
-        
+        with self.pool.connection() as conn:                            # 点灯データ取得する（日時の順）
+            rows = self.raw_rows(conn, "light", ["datetime", "value"], date, date)
+        datetimes, values = myQuery.series(rows)                        # 日時を文字列からdatetimeにする
+
         # グラフデータ作成
         x, y = [dt_0], [0]                                              # xとyの初期値 0:00に点灯オフ
-        for dt, value in zip(df["datetime"], df["value"]):              # 各行について
+        if not rows:                                                    # 点灯データのない日（始まったばかりの日など）
+            x.append(dt_now if date == today else dt_24)                # ずっと0（点灯オフ）のまま
+            y.append(0)
+        for dt, value in zip(datetimes, values):                        # 各行について
             if value == y[-1]:                                          # 値が一つ前と同じならば
                 pass                                                    # グラフ的には変化ないので何もしない
             else:                                                       # 値が変化していたら
                 x.extend([dt, dt])                                      # yの値が変化するようxの値を2個追加
                 y.extend([y[-1], value])                                # yの値を変化前と変化後で2個追加
-        if date == today:                                               # 今日ならば
+        if not rows:                                                    # 点灯データがなければ最後の点は足してある
+            pass
+        elif date == today:                                             # 今日ならば
             if value:                                                   # 点灯オンならば
                 x.extend([dt_now, dt_now])                              # yの値が変化するよう現在時刻を2個追加
                 y.extend([1, 0])                                        # 集計のため一時的にオンからオフにする
@@ -309,46 +546,13 @@ class DB():
             x.append(dt_24)                                             # 最後に23:59を追加
             y.append(0)                                                 # 最後に0（点灯オフ）を追加
         
-        # 累計点灯時間
-        lighting_minutes = 0                                            # 累計時間初期値
-        last_value = False                                              # 最初はオフ
-        last_dt = dt_0                                                  # 最初は00:00
-        for dt, value in zip(x, y):                                     # xとyの各要素について
-            if not last_value and value:                                # オフからオンになったら
-                last_dt = dt                                            # その時刻を覚えておく
-            elif last_value and not value:                              # オンからオフになったら
-                timedelta = (dt - last_dt).total_seconds()              # オンになった時刻からの時間差を秒で求める
-                lighting_minutes += int((timedelta + 5)/60)             # 分にして累計にプラスする（念のために+5秒してから）
-            last_value = value                                          # 次の値と比較するためこの値を覚えておく
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        sql = f"UPDATE summary"\
-                f" SET lighting_minutes={lighting_minutes}"\
-                f" WHERE date='{date}'"
-        cur.execute(sql)                                                # 累計点灯時間をサマリーに登録する
-        conn.commit()
-        cur.close()
-        conn.close()
+        # 累計点灯時間　集計器から取得する（今日なら今まで、過去の日なら23:59まで点灯中の分を含める）
+        with self.pool.connection() as conn:
+            summary = self.daily_summary(conn, date, lights=rows)
+        lighting_minutes = summary.lighting_minutes_until(dt_now if date == today else dt_24)
 
         # グラフ描画
-        width_px, height_px = 900, 200                                  # ピクセルでのサイズ
-        width_in, height_in = width_px/self.dpi, height_px/self.dpi     # インチでのサイズ（整数でなくてもよい）
-        fig, ax = plt.subplots(figsize=(width_in, height_in))
-        ax.spines["right"].set_visible(False)
-        ax.spines["top"].set_visible(False)
-        ax.set_xlim(dt_0, dt_24)                                        # x軸の範囲
-        ax.set_ylim(0, 1)                                               # y軸の範囲
-        locator = mdates.AutoDateLocator()
-        locator.intervald["HOURLY"] = 3                                 # x軸 3時間ごとに目盛表記
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%H"))        # x軸の書式
-        ax.fill_between(x, y, "-", linewidth=2, color="orange")         # プロット y軸との間塗りつぶし
-        ax.vlines(dt_now, 0, 1, "RED")                                  # 現在時刻に赤線
-        ax.set_title(f"{date}の点灯時間 合計{lighting_minutes}分")      # タイトル
-        ax.axvspan(dt_0, dt_sunrise, color="gray", alpha=0.3)           # 夜の背景
-        ax.axvspan(dt_sunset, dt_24, color="gray", alpha=0.3)           # 夜の背景
-        fig.tight_layout()
-        fig.canvas.draw()
-        imgB64 = fig2str64(fig)
+        imgB64 = self.figures.daily_light.render(date, x, y, lighting_minutes, dt_0, dt_24, dt_sunrise, dt_sunset, dt_now)
         return imgB64
 
 
@@ -369,46 +573,10 @@ class DB():
         date_from = date - datetime.timedelta(days = days-1)            # 何日前（datetime型）
         date_from = date_from.strftime("%Y/%m/%d")                      # datetime型を文字列にする
         date_to = date.strftime("%Y/%m/%d")                             # datetime型を文字列にする
+        self.flush(None, date_to)                                       # 累計に入る日の行が溜まっているときだけ先に書き込む
 
-        conn = sqlite3.connect(self.dbname)
-
-        # 点灯時間の集計
-        sql = f"SELECT date, lighting_minutes FROM summary"\
-                f" WHERE date BETWEEN '{cumsum_date}' AND '{date_to}'"\
-                f" ORDER BY date ASC"
-        df_sunlight = pd.read_sql_query(sql, conn)                      # LED点灯時間のみのデータフレーム
-        df_sunlight = df_sunlight.set_index("date")                     # date列をインデックスに設定する
-        df_sunlight = df_sunlight.sort_index()                          # インデックスでソートする
-        df_sunlight = df_sunlight.cumsum()                              # 各日のデータを累積和にする
-        df_sunlight = df_sunlight.rename(columns={"lighting_minutes": "lighting_minutes_sum"})      # 列名変更
-
-        # 温度の集計
-        sql = f"SELECT date, mean_temp FROM summary WHERE date BETWEEN '{cumsum_date}' AND '{date_to}'"
-        df_temp = pd.read_sql_query(sql, conn)                          # 平均気温のみのデータフレーム
-        df_temp = df_temp.set_index("date")                             # date列をインデックスに設定する
-        df_temp = df_temp.sort_index()                                  # インデックスでソートする
-        df_temp = df_temp.cumsum()                                      # 各日のデータを累積和にする
-        df_temp = df_temp.rename(columns={"mean_temp": "mean_temp_sum"})        # 列名変更
-
-        sql = f"SELECT * FROM summary"\
-                f" WHERE date BETWEEN '{date_from}' AND '{date_to}'"\
-                f" ORDER BY date ASC"
-        df = pd.read_sql_query(sql, conn)                               # サマリーのデータフレーム
-        df = df.set_index("date")                                       # date列をインデックスに設定する
-        conn.close()
-
-        df = df.join(df_sunlight, how="left")                           # サマリーにLED点灯時間累計データをジョインする
-        df = df.join(df_temp, how="left")                               # サマリーに温度累計データをジョインする
-        dates = df.index.tolist()                                       # インデックス（日付）のリスト
-        dict = {}
-        for d in dates:                                                 # 各日付において
-            dict[d] = { "max_temp": df.at[d, "max_temp"],
-                        "min_temp": df.at[d, "min_temp"],
-                        "mean_temp": df.at[d, "mean_temp"],
-                        "lighting_minutes": df.at[d, "lighting_minutes"],
-                        "lighting_minutes_sum": df.at[d, "lighting_minutes_sum"],
-                        "mean_temp_sum": df.at[d, "mean_temp_sum"],
-                        }                                               # 日ごとの辞書として登録する
+        with self.pool.connection() as conn:                            # 累計はSQLのウィンドウ関数で求める
+            dict = myQuery.summary_table(conn, cumsum_date, date_from, date_to)
         return dict
 
 
@@ -437,42 +605,19 @@ class DB():
         Args:
             date: 日付（文字列）
         """
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        summary_exists = self.exists("summary", date)                   # サマリーにその日のデータがあるか
-
-        temp_exists = self.exists("temperature", date)                  # 温湿度テーブルにその日のデータがあるか
-        if temp_exists:                                                 # あるならば
-            df = self.get_temperature(date)                             # その日の温湿度データを取得する
-            max_temp = df["temperature"].max()                          # その日の最高気温
-            min_temp = df["temperature"].min()                          # その日の最低気温
-            mean_temp = (max_temp+min_temp)/2                           # 最高気温と最低気温の中間
-            if summary_exists:                                          # サマリーにその日のデータがあれば更新する
-                sql = f"UPDATE summary"\
-                        f" SET max_temp={max_temp}, min_temp={min_temp}, mean_temp={mean_temp}"\
-                        f" WHERE date='{date}'"
-            else:                                                       # データがなければ追加挿入する
-                sql = f"INSERT INTO summary(date, max_temp, min_temp, mean_temp)"\
-                        f" VALUES('{date}','{max_temp}', {min_temp}, {mean_temp})"
-            cur.execute(sql)
-            conn.commit()
+        self.flush()                                                    # 溜まっている書き込みを先に済ませる
+        with self.pool.connection() as conn:
+            max_temp, min_temp, count = myQuery.temperature_stats(conn, date)   # 最高・最低気温はSQLで集計する
+            if count:                                                       # 温湿度テーブルにその日のデータがあれば
+                mean_temp = (max_temp+min_temp)/2                           # 最高気温と最低気温の中間
+                myQuery.upsert_summary(conn, date, max_temp=max_temp, min_temp=min_temp, mean_temp=mean_temp)
+                conn.commit()
 
-        led_exists = self.exists("LED", date)                           # LEDテーブルにその日のデータがあるか
-        if led_exists:                                                  # あるならば
-            df = self.get_LED(date)                                     # その日のLEDデータを取得する
-            lighting_minutes = df["minute"].sum()                       # その日のLED点灯時間の合計
-            if summary_exists:                                          # サマリーにその日のデータがあれば更新する
-                sql = f"UPDATE summary"\
-                        f" SET lighting_minutes={lighting_minutes}"\
-                        f" WHERE date='{date}'"
-            else:                                                       # データがなければ追加挿入する
-                sql = f"INSERT INTO summary(date, lighting_minutes)"\
-                        f" VALUES('{date}', {lighting_minutes})"
-            cur.execute(sql)
-            conn.commit()
-
-        cur.close()
-        conn.close()
+            lighting_minutes = myQuery.led_minutes(conn, date)              # その日のLED点灯時間の合計
+            if lighting_minutes is not None:                                # LEDテーブルにその日のデータがあれば
+                myQuery.upsert_summary(conn, date, lighting_minutes=lighting_minutes)
+                conn.commit()
+        self.bump_version("summary", None)                              # サマリーを書き換えたのでグラフを描き直す
 
 
     def get_temperature(self, date=None):
@@ -483,19 +628,20 @@ class DB():
         Returns:
             df   : dataframe
         """
-        conn = sqlite3.connect(self.dbname)
+        import pandas as pd                                             # pandasは使うときに読み込む
         if date is None:                                                # 日付がNoneだったら
             date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
-
-        sql = f"SELECT * FROM temperature WHERE date='{date}' ORDER BY date ASC"
-        df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
-        df["datetime"] = pd.to_datetime(df["datetime"])                 # 文字列の日時をdatetimeに変換する
-        conn.close()
+        self.flush(date, date)                                          # その日の行が溜まっているときだけ先に書き込む
+        with self.pool.connection() as conn:
+            columns = ["date", "datetime", "temperature", "humidity", "epoch"]
+            rows = self.raw_rows(conn, "temperature", columns, date, date)  # アーカイブとつなぐ
+            df = pd.DataFrame(rows, columns=columns)
+            df["datetime"] = pd.to_datetime(df["datetime"])                 # 文字列の日時をdatetimeに変換する
         return df
 
     def get_summary_graph(self, cumsum_date, date=None, days=7):
         """
-        サマリーを取得する
+        サマリーグラフ　サマリーが変わっていなければキャッシュを返す
         Args:
             cumsum_date: 累計の始点
             date_to: 日付（文字列）Noneならば今日
@@ -505,91 +651,143 @@ class DB():
             temp_b64  : 温度のグラフ
         """
         if date is None:                                                # 日付がNoneだったら
-            date = datetime.date.today()                                # 今日（datetime型）
-        else:                                                           # 日付が文字列として与えられていたら
-            date = datetime.datetime.strptime(date, "%Y/%m/%d")         # 日付の計算をするためにdatetime型にする
+            date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
+        self.flush(None, date)                                          # 累計に入る日の行が溜まっているときだけ先に書き込む
+        version = self.data_version(("summary", None)) + (cumsum_date, days)
+        return self.graph_cache.get("summary", date, version, lambda: self.render_summary_graph(cumsum_date, date, days))
+
+
+    def render_summary_graph(self, cumsum_date, date, days):
+        """
+        サマリーグラフを描画する
+        Args:
+            cumsum_date: 累計の始点
+            date   : 日付（文字列）
+            days   : 何日前までか
+        Return:
+            light_b64 : 点灯時間のグラフ
+            temp_b64  : 温度のグラフ
+        """
+        date = datetime.datetime.strptime(date, "%Y/%m/%d")             # 日付の計算をするためにdatetime型にする
 
         date_from = date - datetime.timedelta(days = days-1)            # 何日前（datetime型）
         date_from = date_from.strftime("%Y/%m/%d")                      # datetime型を文字列にする
         date_to = date.strftime("%Y/%m/%d")                             # datetime型を文字列にする
-        conn = sqlite3.connect(self.dbname)
-
-        # 点灯時間の集計
-        sql = f"SELECT date, lighting_minutes FROM summary"\
-                f" WHERE date BETWEEN '{cumsum_date}' AND '{date_to}'"\
-                f" ORDER BY date ASC"
-        df_sunlight = pd.read_sql_query(sql, conn)                      # LED点灯時間のみのデータフレーム
-        df_sunlight = df_sunlight.set_index("date")                     # date列をインデックスに設定する
-        df_sunlight = df_sunlight.sort_index()                          # インデックスでソートする
-        df_sunlight = df_sunlight.cumsum()                              # 各日のデータを累積和にする
-        df_sunlight = df_sunlight.rename(columns={"lighting_minutes": "lighting_minutes_sum"})      # 列名変更
-
-        # 温度の集計
-        sql = f"SELECT date, mean_temp FROM summary WHERE date BETWEEN '{cumsum_date}' AND '{date_to}'"
-        df_temp = pd.read_sql_query(sql, conn)                          # 平均気温のみのデータフレーム
-        df_temp = df_temp.set_index("date")                             # date列をインデックスに設定する
-        df_temp = df_temp.sort_index()                                  # インデックスでソートする
-        df_temp = df_temp.cumsum()                                      # 各日のデータを累積和にする
-        df_temp = df_temp.rename(columns={"mean_temp": "mean_temp_sum"})        # 列名変更
-
-        sql = f"SELECT * FROM summary"\
-                f" WHERE date BETWEEN '{date_from}' AND '{date_to}'"\
-                f" ORDER BY date ASC"
-        df = pd.read_sql_query(sql, conn)                               # サマリーのデータフレーム
-        df = df.set_index("date")                                       # date列をインデックスに設定する
-        conn.close()
-
-        df = df.join(df_sunlight, how="left")                           # サマリーにLED点灯時間累計データをジョインする
-        df = df.join(df_temp, how="left")                               # サマリーに温度累計データをジョインする
-        dates = df.index.tolist()                                       # インデックス（日付）のリスト
-        dict = {}
-        for d in dates:                                                 # 各日付において
-            dict[d] = { "max_temp": df.at[d, "max_temp"],
-                        "min_temp": df.at[d, "min_temp"],
-                        "mean_temp": df.at[d, "mean_temp"],
-                        "lighting_minutes": df.at[d, "lighting_minutes"],
-                        "lighting_minutes_sum": df.at[d, "lighting_minutes_sum"],
-                        "mean_temp_sum": df.at[d, "mean_temp_sum"],
-                        }                                               # 日ごとの辞書として登録する
+        with self.pool.connection() as conn:                            # 累計はSQLのウィンドウ関数で求める
+            dict = myQuery.summary_table(conn, cumsum_date, date_from, date_to)
 
         # サマリーグラフ
-        width_px, height_px = 900, 200                                  # ピクセルでのサイズ
-        width_in = width_px/self.dpi                                    # インチでのサイズ（整数でなくてもよい）
-        height_in = height_px/self.dpi
         x = [key[5:] for key in dict.keys()]                            # yyyy/mm/dd から yy/dd にしてx軸とする
 
         # 温度のグラフ
-        fig, ax = plt.subplots(figsize=(width_in, height_in))
-        ax.spines["right"].set_visible(False)
-        ax.spines["top"].set_visible(False)
         y_max = [item["max_temp"] for item in dict.values()]
         y_min = [item["min_temp"] for item in dict.values()]
         y_mean = [item["mean_temp"] for item in dict.values()]
-        ax.plot(x, y_max, ":b", linewidth=1)
-        ax.plot(x, y_min, ":b", linewidth=1)
-        ax.plot(x, y_mean, ".-b", linewidth=2)
-        ax.set_title("最高・最低・平均気温（度）")
-        fig.tight_layout()
-        for i, value in enumerate(y_mean):
-            ax.text(x[i], y_mean[i]+ 2, value)
-            fig.canvas.draw()
-        temp_b64 = fig2str64(fig)
+        temp_b64 = self.figures.summary_temp.render(x, [y_max, y_min, y_mean])
 
         # 点灯時間のグラフ
-        fig, ax = plt.subplots(figsize=(width_in, height_in))
-        ax.spines["right"].set_visible(False)
-        ax.spines["top"].set_visible(False)
         y = [item["lighting_minutes"] for item in dict.values()]
-        ax.plot(x, y, ".-", linewidth=2, color="orange")
-        ax.set_title("日当たりのLED点灯時間（分）")
-        fig.tight_layout()
-        for i, value in enumerate(y):
-            ax.text(x[i], y[i]+ 2, value)
-            fig.canvas.draw()
-        light_b64 = fig2str64(fig)
+        light_b64 = self.figures.summary_light.render(x, [y])
         return light_b64, temp_b64
 
 
+    def get_summary_data(self, date=None, days=7):
+        """
+        サマリーグラフ用の日ごとの値（ブラウザで描画する）
+        Args:
+            date   : 日付（文字列）Noneならば今日
+            days   : 何日前までか
+        Return:
+            dict   : 列ごとのリスト {"date", "max_temp", "min_temp", "mean_temp", "lighting_minutes"}
+        """
+        if date is None:                                                # 日付がNoneだったら
+            date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
+        date_to = datetime.datetime.strptime(date, "%Y/%m/%d")
+        date_from = (date_to - datetime.timedelta(days = days-1)).strftime("%Y/%m/%d")
+        self.flush(date_from, date)                                     # その期間の行が溜まっているときだけ先に書き込む
+        sql = "SELECT date, max_temp, min_temp, mean_temp, lighting_minutes FROM summary"\
+                " WHERE date BETWEEN ? AND ? ORDER BY date ASC"
+        with self.pool.connection() as conn:
+            rows = conn.execute(sql, (date_from, date)).fetchall()
+        keys = ["date", "max_temp", "min_temp", "mean_temp", "lighting_minutes"]
+        return {key: [row[i] for row in rows] for i, key in enumerate(keys)}
+
+
+
+
+    def get_range(self, date_from, date_to, max_points=500):
+        """
+        長い期間の気温と点灯時間（ロールアップから）
+        点数がmax_points以下になるいちばん細かい区間（5分・1時間・1日）で返す
+        Args:
+            date_from: 始まり（'YYYY/MM/DD' または 'YYYY/MM/DD HH:MM'）
+            date_to  : 終わり（日付だけならばその日の終わりまで含む）
+            max_points: 最大の点数
+        Returns:
+            dict     : 列ごとのリスト {"resolution", "bucket", "min_temp", "max_temp", "mean_temp", "count", "on_minutes"}
+        """
+        self.flush(date_from[:10], date_to[:10])                        # その期間の行が溜まっているときだけ先に書き込む
+        start = str2datetime(date_from if " " in date_from else date_from + " 00:00")
+        if " " in date_to:
+            end = str2datetime(date_to) + datetime.timedelta(minutes=1)
+        else:
+            end = str2datetime(date_to + " 00:00") + datetime.timedelta(days=1)
+        with self.pool.connection() as conn:
+            return self.rollup.query(conn, start, end, max_points)
+
+
+    def raw_rows(self, conn, table, columns, date_from, date_to):
+        """
+        生データの行　アーカイブ済みの期間はアーカイブから読み、SQLiteの行とつなぐ
+        Args:
+            conn     : 接続
+            table    : テーブル名
+            columns  : 列名のリスト
+            date_from, date_to: 期間（日付の文字列、両端を含む）
+        Returns:
+            rows     : 行のタプルのリスト（日時の順）
+        """
+        rows, archived_to = [], ""
+        if date_from < self.archived_before:                            # アーカイブ済みの期間を含むならば
+            rows = self.archive.read(table, columns + ["datetime"], date_from, date_to)
+            if rows:                                                    # アーカイブの最後の日時
+                archived_to = rows[-1][-1]
+            rows = [row[:-1] for row in rows]
+        # アーカイブを書いたあとSQLiteから消す前に止まると両方に同じ行が残るので、SQLiteはアーカイブより後だけ
+        sql = f"SELECT {', '.join(columns)} FROM {table} WHERE date BETWEEN ? AND ? AND datetime > ? ORDER BY datetime ASC"
+        return rows + conn.execute(sql, (date_from, date_to, archived_to)).fetchall()
+
+
+    def archive_old(self, days):
+        """
+        days日より前の生データを月ごとのアーカイブに移す（サマリーとロールアップは残す）
+        Args:
+            days: 何日分をSQLiteに残すか
+        Returns:
+            dict: テーブル → 移した行数
+        """
+        self.flush()                                                    # 溜まっている書き込みを先に済ませる
+        before = cutoff(days)
+        with self.pool.connection() as conn:
+            moved = self.archive.move(conn, before)
+        self.archived_before = max(self.archived_before, before)
+        return moved
+
+
+    @property
+    def archived_before(self):
+        """
+        この日より前はアーカイブにあるかもしれない（アーカイブがなければ空文字）
+        ファイル名から求めるので月の単位　アーカイブの最後の月の翌月1日
+        """
+        if self._archived_before is None:
+            months = sorted(set(sum((self.archive.months(t) for t in ["temperature", "light"]), [])))
+            self._archived_before = f"{next_month(months[-1])}/01" if months else ""
+        return self._archived_before
+
+    @archived_before.setter
+    def archived_before(self, value):
+        self._archived_before = value
 
 
     def exists(self, table, date):
@@ -601,13 +799,12 @@ class DB():
         Returns:
             bool  : True / False
         """
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        sql = f"SELECT COUNT(date) FROM {table} WHERE date='{date}'"
-        cur.execute(sql)
-        cnt = cur.fetchone()[0]                                         # fetchは要素1のタプルを返すので、その要素を取り出す
-        cur.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            sql = f"SELECT COUNT(date) FROM {table} WHERE date='{date}'"
+            cur.execute(sql)
+            cnt = cur.fetchone()[0]                                         # fetchは要素1のタプルを返すので、その要素を取り出す
+            cur.close()
         bool = True if cnt else False                                   # 1以上ならばTrue、0ならFalse
         return bool
 
@@ -622,17 +819,16 @@ class DB():
             minute : 時間（分）
             _      : 登録日時指定不可（今を点灯終了時刻とする）
         """
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        now = datetime.datetime.now()                                   # 今
-        date = now.strftime("%Y/%m/%d")                                 # 日付
-        dt_to = now.strftime("%Y/%m/%d %H:%M")                          # 点灯終了時刻（今）
-        df_from = (now - datetime.timedelta(minutes=minute)).strftime("%Y/%m/%d %H:%M")     # 点灯開始時刻
-        sql = f"INSERT INTO LED VALUES('{date}','{df_from}', '{dt_to}', {minute})"
-        cur.execute(sql)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            now = datetime.datetime.now()                                   # 今
+            date = now.strftime("%Y/%m/%d")                                 # 日付
+            dt_to = now.strftime("%Y/%m/%d %H:%M")                          # 点灯終了時刻（今）
+            df_from = (now - datetime.timedelta(minutes=minute)).strftime("%Y/%m/%d %H:%M")     # 点灯開始時刻
+            sql = f"INSERT INTO LED VALUES('{date}','{df_from}', '{dt_to}', {minute})"
+            cur.execute(sql)
+            conn.commit()
+            cur.close()
         self.set_summary(date)                                          # その日のサマリーデータを更新する
 
 
@@ -642,38 +838,46 @@ class DB():
         Args:
             date: 日付（文字列）Noneならば今日
         """
+        import pandas as pd                                             # pandasは使うときに読み込む
         if date is None:                                                # 日付がNoneだったら
             date = datetime.date.today().strftime("%Y/%m/%d")           # 今日の文字列
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        sql = f"SELECT * FROM LED WHERE date='{date}' ORDER BY date ASC"
-        df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
-        cur.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            sql = f"SELECT * FROM LED WHERE date='{date}' ORDER BY date ASC"
+            df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
+            cur.close()
         return df
 
 
     def toCSV(self, table, date=None, days=0):
         """
-        DBをcsvとして保存する
+        DBをcsvとして保存する（Exporterで少しずつ書くのでメモリは一定）
         Args:
             table : テーブル名
             date  : 日付（テキスト）
             days  : dateから何日前まで
         """
-        conn = sqlite3.connect(self.dbname)
         if date is None:                                                # 日付がNoneだったら
             date = datetime.date.today()                                # 今日まで
         else:                                                           # 日付が文字列として与えられていたら
             date = datetime.datetime.strptime(date, "%Y/%m/%d")         # それをdatetimeにする
-
         date_to = date.strftime("%Y/%m/%d")                             # datetimeを文字列にする
-        date_from = date - datetime.timedelta(days = days)              # 何日前
-        date_from = date_from.strftime("%Y/%m/%d")                      # datetimeを文字列にする
-        sql = f"SELECT * FROM {table} WHERE date BETWEEN '{date_from}' AND '{date_to}'"
-        df = pd.read_sql_query(sql, conn)                               # sql実行しpandas形式で格納する
-        df.to_csv(f"{table}.csv", index=False ,header=True)             # インデックス無しでcsv保存する
-        conn.close()
+        date_from = (date - datetime.timedelta(days = days)).strftime("%Y/%m/%d")   # 何日前
+        with open(f"{table}.csv", mode="wb") as f:
+            for data in Exporter(self).export(table, date_from, date_to, "csv"):
+                f.write(data)
+
+
+    def get_ephem(self, date=None):
+        """
+        ある日の暦を1年分の暦の表から引く（場所か年が変わったときだけ計算する）
+        Args:
+            date : 日付（datetime.date）　Noneならば今日
+        Returns:
+            dict : {"sunrise_time", "sunset_time", "civil_dawn", "civil_dusk", "moon_phase"}
+        """
+        with self.pool.connection() as conn:
+            return self.ephem_table.lookup(conn, self.ephem_config, date)
 
 
     def set_ephem(self, dict):
@@ -696,34 +900,56 @@ class DB():
             sql = f"INSERT INTO summary(date, sunrise_time, sunset_time, moon_phase, lighting_minutes) "\
                     f" VALUES('{date}','{sunrise_time}', '{sunset_time}', {moon_phase}, 0)"
 
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        cur.execute(sql)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+            cur.close()
+        self.bump_version("ephem", date)                                # 夜の背景が変わるのでグラフを描き直す
+
+
+    def purge(self, date_to):
+        """
+        指定した日以前のデータをバックグラウンドで少しずつ削除する（すぐに戻る）
+        Args:
+            date_to: 日付（文字列）
+        Returns:
+            dict   : 進み具合（Retention.progress）
+        """
+        return self.retention.start(date_to)
 
 
     def delete(self, date_from):
         """
-        指定した日以前のデータベースを削除する
+        指定した日以前のデータベースを削除する（一つのトランザクションで一度に）
         Args:
             date_from : 日付（文字列）
         """
-        conn = sqlite3.connect(self.dbname)
-        cur = conn.cursor()
-        sql = "SELECT name FROM sqlite_master WHERE type='table'"       # DB内の全テーブル取得するSQL
-        cur.execute(sql)
-        tables = cur.fetchall()                                         # DB内の全テーブル　要素1のタプルのリスト
-        tables = [table[0] for table in tables]                         # タプルのリストを単純なリストにする
+        self.flush()                                                    # 溜まっている書き込みを先に済ませる
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            sql = "SELECT name FROM sqlite_master WHERE type='table'"       # DB内の全テーブル取得するSQL
+            cur.execute(sql)
+            tables = cur.fetchall()                                         # DB内の全テーブル　要素1のタプルのリスト
+            tables = [table[0] for table in tables]                         # タプルのリストを単純なリストにする
 
-        for table in tables:                                            # 各テーブルにおいて
-            if table != "config":                                       # configでなかったら
-                sql = f"DELETE FROM {table} WHERE date<='{date_from}'"  # データ削除するSQL
-                cur.execute(sql)
-        conn.commit()
-        cur.close()
-        conn.close()
+            for table in tables:                                            # 各テーブルにおいて
+                if table != "config":                                       # configでなかったら
+                    sql = f"DELETE FROM {table} WHERE date<='{date_from}'"  # データ削除するSQL
+                    cur.execute(sql)
+            conn.commit()
+            cur.close()
+        self.aggregator.forget()                                        # 集計もグラフも作り直させる
+        self.graph_cache.clear()
+        self.bump_version("summary", None)
+
+
+    def close(self):
+        """
+        書き込み待ちを書き込んでから接続プールを閉じる
+        """
+        self.writer.stop()
+        self.pool.close()
 
 
     def draw_dailygraph(self, date=None):
@@ -743,29 +969,66 @@ class DB():
         return lightB64, tempB64
 
 
-def fig2str64(fig):
-    # matplotlib.pyplotの画像をBase64の画像に変換する
-    img = np.array(fig.canvas.renderer.buffer_rgba())           # numpy配列にする
-    img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)                 # OpenCV画像にする
-    #cv2.imshow("graph", img)
-    #cv2.waitKey(0)
-    #cv2.destroyAllWindows()
-    _, imgEnc = cv2.imencode(".jpg", img)                       # メモリ上にエンコード
-    imgB64 = base64.b64encode(imgEnc)                           # base64にエンコード
-    strB64 = "data:image/jpg;base64," + str(imgB64, "utf-8")    # 文字列化
-    return strB64
+    def get_daily_data(self, date=None):
+        """
+        デイリーグラフ用の時系列データ（ブラウザで描画する）
+        時刻はすべてその日の0時からの分で表す
+        Args:
+            date: 日付（文字列）Noneならば今日
+        Returns:
+            dict: {"date", "sunrise", "sunset", "now", "mean_temp", "lighting_minutes",
+                   "temp": [[分, 気温], ...], "light": [[点灯した分, 消灯した分], ...]}
+        """
+        today = datetime.date.today().strftime("%Y/%m/%d")              # 今日の文字列
+        if date is None:                                                # 日付がNoneだったら
+            date = today
+        self.flush(date, date)                                          # その日の行が溜まっているときだけ先に書き込む
+        dt_now = datetime.datetime.now()
+        dt_24 = str2datetime(f"{date} 23:59")
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT sunrise_time, sunset_time FROM summary WHERE date=?", (date,)).fetchone()
+            temps = self.raw_rows(conn, "temperature", ["datetime", "temperature"], date, date)
+            lights = self.raw_rows(conn, "light", ["datetime", "value"], date, date)
+            summary = self.daily_summary(conn, date, temps, lights)
+        sunrise_time, sunset_time = row if row else (None, None)
+        now = dt_now.hour*60 + dt_now.minute if date == today else None
+
+        intervals, on_since = [], None                                  # 点灯していた区間のリスト
+        for strdt, value in lights:
+            if int(value) and on_since is None:                         # オフからオンになったら
+                on_since = minute_of_day(strdt)
+            elif not int(value) and on_since is not None:               # オンからオフになったら
+                intervals.append([on_since, minute_of_day(strdt)])
+                on_since = None
+        if on_since is not None:                                        # 点灯中のままならば今（過去の日なら23:59）まで
+            intervals.append([on_since, now if now is not None else 23*60+59])
+
+        return {"date": date,
+                "sunrise": sunrise_time,
+                "sunset": sunset_time,
+                "now": now,
+                "mean_temp": summary.mean_temp,
+                "lighting_minutes": summary.lighting_minutes_until(dt_now if date == today else dt_24),
+                "temp": [[minute_of_day(strdt), temp] for strdt, temp in temps],
+                "light": intervals,
+                }
+
 
 def str2datetime(str):
     # 文字列をdatetimeに変換する
     return datetime.datetime.strptime(str, "%Y/%m/%d %H:%M")
 
 
-db = DB()
+def minute_of_day(strdt):
+    # 'YYYY/MM/DD HH:MM' の文字列を0時からの分にする
+    return int(strdt[11:13])*60 + int(strdt[14:16])
+
 
 def main():
+    db = DB()                                                           # 単体で動かすときだけ作る（importでは作らない）
     ret = db.set_LED(1)
     ret = db.set_temperature(10, 20)
-    pass
+    db.close()
 
 if __name__ == "__main__":
     main()
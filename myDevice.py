@@ -0,0 +1,71 @@
+import os
+
+"""
+機器（コンテックのボード、DHT11、MCP3004）を用意する
+環境変数 AGRI_DEVICE で切り替える
+    hw（既定）: 実機　libcdio.so と RPi.GPIO を使う　なければその機器はNone
+    sim       : シミュレーター（mySimulator）　Raspberry Piでない機械での負荷試験用
+"""
+
+HUMI_PIN = 14                               # DHT11のピン（BCM）
+
+
+def open_devices(backend=None):
+    """
+    Args:
+        backend  : "hw" か "sim"　Noneならば環境変数 AGRI_DEVICE
+    Returns:
+        contec   : Contec　使えなければNone
+        humi_sensor: dht11.DHT11　使えなければNone
+        simulator: シミュレーターならばSimulator、実機ならばNone
+    """
+    import dht11
+    from myContec import Contec
+    backend = backend or os.environ.get("AGRI_DEVICE", "hw")
+    if backend == "sim":
+        from mySimulator import Simulator
+        simulator = Simulator.from_file()
+        contec = Contec(driver=simulator.cdio)
+        humi_sensor = dht11.DHT11(pin=HUMI_PIN, gpio=simulator.gpio, clock=simulator.gpio.clock)
+    else:
+        simulator = None
+        try:
+            contec = Contec()               # コンテックのクラス
+        except Exception as e:              # ドライバがなければ（Raspberry Pi以外）トライのみ
+            print(f"コンテックなし　{e}")
+            contec = None
+        try:
+            import RPi.GPIO as GPIO
+            GPIO.setwarnings(False)
+            GPIO.setmode(GPIO.BCM)
+            humi_sensor = dht11.DHT11(pin=HUMI_PIN, gpio=GPIO)
+        except Exception as e:              # RPi.GPIOがなければ温湿度計はトライのみ
+            print(f"温湿度計なし　{e}")
+            humi_sensor = None
+    if contec is not None:
+        contec.start_interrupts()           # 入力は割り込みで受け取る（できなければポーリング）
+        contec.start_buffered()             # 光センサーはバッファ取り込みした区間で判断する（できなければその時の値）
+    return contec, humi_sensor, simulator
+
+
+def open_analog(simulator=None, rate=None):
+    """
+    MCP3004の連続取り込みを用意して始める
+    Args:
+        simulator: open_devicesが返したシミュレーター（Noneならば実機）
+        rate     : 1秒に読む回数　Noneならば環境変数 AGRI_ADC_RATE（既定10）
+    Returns:
+        analog   : myAnalog.Analog　使えなければNone
+    """
+    from myAnalog import Analog
+    rate = rate or float(os.environ.get("AGRI_ADC_RATE", 10))
+    try:
+        if simulator is not None:
+            analog = Analog(rate=rate, factory=simulator.adc.channel)
+        else:
+            analog = Analog(rate=rate)
+    except Exception as e:                  # gpiozeroやSPIがなければ（Raspberry Pi以外）使わない
+        print(f"A/D変換器なし　{e}")
+        return None
+    analog.start()
+    return analog
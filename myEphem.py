@@ -1,9 +1,22 @@
 import ephem
 import datetime
 import numpy as np
-import cv2
 import math
 import base64
+import bisect
+import hashlib
+import threading
+
+"""
+暦（日の出・日の入り・月齢）
+EphemTableは1年分の暦をまとめて計算してephemテーブルに入れ、日付をキーにメモリの辞書から引く
+計算し直すのは、年が変わったときと、設定の緯度・経度・標高が変わったときだけ
+MoonSpritesは月の画像を月齢の刻みごとに一度だけ描いてPNGのまま持ち、ETag付きの静的な画像として返す
+"""
+
+TZ = datetime.timedelta(hours=+9)                                       # 日本とUTCの時差
+SYNODIC_MONTH = 29.53                                                   # 朔望月（日）
+
 
 class Ephem():
     def __init__(self, dict, isB64=True):
@@ -42,7 +55,9 @@ class Ephem():
     def epdate2str(self, epdate):
         return (epdate)
 
-    def draw_moon(self, age, isB64):
+    @staticmethod
+    def draw_moon(age, isB64):
+        import cv2                                              # OpenCVは重いので月を描くときに読み込む
         TRANS = (0,0,0,0)                                       # 透明色
         YELLOW = (100,255,255,255)                              # 黄色
         GRAY = (60,60,60,255)                                   # 灰色
@@ -81,6 +96,161 @@ class Ephem():
             return img                                          # OpenCV画像を返す
 
 
+def location_key(config):
+    """
+    計算し直すかどうかを決める場所のキー（緯度・経度・標高）
+    """
+    return (str(config["lat"]), str(config["lon"]), int(float(config["elev"])))
+
+
+def compute_year(config, year):
+    """
+    1年分の暦をまとめて計算する
+    Observerは1つを使い回し、新月の時刻は1年分を先に求めておいて月齢は二分探索で引く
+    Args:
+        config: 場所の設定（place, lat, lon, elev）
+        year  : 年
+    Returns:
+        rows  : (日付, 日の出, 日の入り, 市民薄明の始まり, 市民薄明の終わり, 月齢) のリスト　時刻は'HH:MM'
+    """
+    lat, lon, elev = location_key(config)
+    observer = ephem.Observer()
+    observer.lat, observer.lon, observer.elev = lat, lon, elev
+    sun = ephem.Sun()
+    first = datetime.date(year, 1, 1)
+    days = (datetime.date(year + 1, 1, 1) - first).days
+
+    new_moons = [ephem.previous_new_moon(ephem.Date(first) - 1)]       # 年の前から年の後までの新月
+    while new_moons[-1] < ephem.Date(datetime.date(year + 1, 1, 2)):
+        new_moons.append(ephem.next_new_moon(new_moons[-1] + 1))
+
+    def hm(t):
+        return (ephem.Date(t).datetime() + TZ).strftime("%H:%M")
+
+    rows = []
+    for i in range(days):
+        dt = first + datetime.timedelta(days=i)
+        midnight = ephem.Date(datetime.datetime(dt.year, dt.month, dt.day) - TZ)  # ローカルの0時
+        observer.date = midnight
+        observer.horizon = "0"
+        sunrise = observer.next_rising(sun)
+        sunset = observer.next_setting(sun)
+        observer.horizon = "-6"                                         # 市民薄明は太陽の中心が-6度
+        dawn = observer.next_rising(sun, use_center=True)
+        dusk = observer.next_setting(sun, use_center=True)
+        noon = midnight + 0.5                                           # 月齢はその日の正午で計算する
+        new_moon = new_moons[bisect.bisect_right(new_moons, noon) - 1]
+        rows.append((dt.strftime("%Y/%m/%d"), hm(sunrise), hm(sunset), hm(dawn), hm(dusk),
+                     round(noon - new_moon, 2)))
+    return rows
+
+
+class EphemTable():
+    def __init__(self):
+        self.key = None                                                 # メモリにある暦の場所
+        self.years = set()                                              # メモリにある年
+        self.rows = {}                                                  # 日付 → 暦の辞書
+        self.lock = threading.Lock()
+
+    def load(self, conn, config, year):
+        """
+        1年分の暦をメモリに載せる　テーブルに同じ場所の1年分がなければ計算して書き込む
+        """
+        key = location_key(config)
+        sql = "SELECT date, sunrise_time, sunset_time, civil_dawn, civil_dusk, moon_phase FROM ephem"\
+                " WHERE date BETWEEN ? AND ? AND lat=? AND lon=? AND elev=? ORDER BY date"
+        span = (f"{year}/01/01", f"{year}/12/31")
+        rows = conn.execute(sql, (*span, *key)).fetchall()
+        if len(rows) < (datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)).days:
+            rows = compute_year(config, year)                           # 場所が変わったか、まだ計算していない
+            conn.execute("DELETE FROM ephem WHERE date BETWEEN ? AND ?", span)
+            conn.executemany("INSERT INTO ephem(date, lat, lon, elev, sunrise_time, sunset_time, civil_dawn, civil_dusk, moon_phase)"
+                                " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)", [(row[0], *key, *row[1:]) for row in rows])
+            conn.commit()
+        if key != self.key:                                             # 場所が変わったら前の暦は捨てる
+            self.key, self.years, self.rows = key, set(), {}
+        for date, sunrise, sunset, dawn, dusk, moon_phase in rows:
+            self.rows[date] = {"sunrise_time": sunrise, "sunset_time": sunset,
+                               "civil_dawn": dawn, "civil_dusk": dusk, "moon_phase": moon_phase}
+        self.years.add(year)
+
+    def lookup(self, conn, config, date=None):
+        """
+        ある日の暦
+        Args:
+            conn  : 接続（メモリにない年のときだけ使う）
+            config: 場所の設定（place, lat, lon, elev）
+            date  : 日付（datetime.date）　Noneならば今日
+        Returns:
+            dict  : {"sunrise_time", "sunset_time", "civil_dawn", "civil_dusk", "moon_phase"}
+        """
+        date = date or datetime.date.today()
+        with self.lock:
+            if location_key(config) != self.key or date.year not in self.years:
+                self.load(conn, config, date.year)
+            return dict(self.rows[date.strftime("%Y/%m/%d")])
+
+
+class MoonSprites():
+    def __init__(self, step=0.25):
+        """
+        初期設定
+        Args:
+            step: 月齢の刻み（日）　この刻みに丸めた月齢ごとに1枚の画像を持つ
+        """
+        self.step = step
+        self.sprites = {}                                               # キー → (PNGのバイト列, ETag)
+        self.valid = set(self.keys())
+        self.lock = threading.Lock()
+
+    def key(self, age):
+        """
+        月齢を刻みに丸めたキー（'7.50'のような文字列）
+        """
+        age = float(age) % SYNODIC_MONTH
+        return f"{round(age / self.step) * self.step:.2f}"
+
+    def keys(self):
+        """
+        ありうるすべてのキー
+        """
+        return [f"{i * self.step:.2f}" for i in range(int(SYNODIC_MONTH / self.step) + 1)]
+
+    def get(self, key):
+        """
+        キーの画像　まだ描いていなければ描く
+        Args:
+            key : キー（keyで作ったもの）
+        Returns:
+            (PNGのバイト列, ETag)　キーが正しくなければNone
+        """
+        if key not in self.valid:
+            return None
+        with self.lock:
+            sprite = self.sprites.get(key)
+        if sprite is None:
+            import cv2
+            _, png = cv2.imencode(".png", Ephem.draw_moon(float(key), False))
+            png = png.tobytes()
+            sprite = (png, hashlib.sha1(png).hexdigest()[:16])
+            with self.lock:
+                self.sprites[key] = sprite
+        return sprite
+
+    def prerender(self):
+        """
+        すべての月齢の画像を描いておく
+        """
+        for key in self.keys():
+            self.get(key)
+
+    def url(self, age):
+        """
+        その月齢の画像のURL
+        """
+        return f"/moon/{self.key(age)}.png"
+
+
 if __name__=="__main__":
     # このコード単品で動かす際のサンプル　本番では使わない
     nagoya = {  "place": "名古屋",
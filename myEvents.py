@@ -0,0 +1,89 @@
+import itertools
+import json
+import queue
+import threading
+
+"""
+Server-Sent Events の配信
+一つの発行元（制御ループ、温湿度、データベースの更新）から、つないでいる全ての画面に同じイベントを送る
+イベントは発行時に一度だけ文字列にし、画面ごとのキューに入れる
+遅い画面のキューがあふれたら古いイベントから捨てる（発行元は待たされない）
+"""
+
+
+class EventBus():
+    def __init__(self, max_queue=100, heartbeat=15):
+        """
+        初期設定
+        Args:
+            max_queue: 画面ごとにためておくイベントの最大数
+            heartbeat: イベントがないときに接続維持のコメントを送る間隔（秒）
+        """
+        self.max_queue = max_queue
+        self.heartbeat = heartbeat
+        self.subscribers = set()                                        # 画面ごとのキュー
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)                                   # イベントの通し番号
+
+    def publish(self, event, data):
+        """
+        イベントを全ての画面に送る
+        Args:
+            event: イベント名
+            data : JSONにできる値
+        """
+        msg = f"event: {event}\nid: {next(self.ids)}\ndata: {json.dumps(data)}\n\n"
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(msg)
+                    break
+                except queue.Full:                                      # あふれていたら一番古いものを捨てる
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def subscribe(self):
+        """
+        画面を一つ登録し、その画面用のキューを返す
+        """
+        q = queue.Queue(maxsize=self.max_queue)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        """
+        画面の登録を外す
+        """
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def stream(self, initial=()):
+        """
+        一つの画面に送る text/event-stream の本体
+        Args:
+            initial: 最初に送るイベント (イベント名, データ) のリスト（つないだ時点の状態など）
+        """
+        q = self.subscribe()
+        try:
+            yield "retry: 3000\n\n"                                     # 切れたら3秒後につなぎ直してもらう
+            for event, data in initial:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            while True:
+                try:
+                    yield q.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:                                                        # 画面が切断したら
+            self.unsubscribe(q)
+
+    def count(self):
+        """
+        つないでいる画面の数
+        """
+        with self.lock:
+            return len(self.subscribers)
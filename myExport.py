@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+import zlib
+from mySchema import TIME_SERIES_TABLES
+
+"""
+テーブルの書き出し（CSV / NDJSON）
+一定の行数ずつ取り出して文字列にし、ジェネレーターで少しずつ返す
+全体をメモリに載せないので、1年分の毎分のデータでもメモリは一定で、最初のバイトはすぐに送られる
+まとまりごとに接続をプールから借りて返し、続きは前のまとまりの最後のキー（エポック秒とrowid）から読む（キーセット）
+遅いダウンロードがあっても接続を持ち続けないので、ほかのリクエストを待たせない
+アーカイブ済みの生データ（myArchive）は月ごとに読んでSQLiteの行の前につなぐ　列は名前で合わせる
+"""
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class Exporter():
+    def __init__(self, db, chunk_size=1000):
+        """
+        初期設定
+        Args:
+            db        : DB
+            chunk_size: 一度にカーソルから取り出す行数
+        """
+        self.db = db
+        self.chunk_size = chunk_size
+
+    def tables(self, conn):
+        """
+        書き出せるテーブルの名前
+        """
+        return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")]
+
+    def rows(self, table, columns, date_from, date_to):
+        """
+        行をchunk_size行ずつのリストで返すジェネレーター
+        """
+        where, params = "", []
+        if "date" in columns:                                           # 日付のないテーブル（configなど）は全部
+            date_from, date_to = date_from or "", date_to or "9999/12/31"
+            archived_to = ""                                            # アーカイブの最後の日時
+            if date_from < self.db.archived_before:                     # アーカイブ済みの期間は1か月ずつ読む
+                for month in self.db.archive.months(table):
+                    if date_from[:7] <= month <= date_to[:7]:
+                        rows = self.db.archive.read(table, columns, max(date_from, f"{month}/01"),
+                                                    min(date_to, f"{month}/31"))
+                        if rows and "datetime" in columns:
+                            archived_to = rows[-1][columns.index("datetime")]
+                        for i in range(0, len(rows), self.chunk_size):
+                            yield rows[i:i+self.chunk_size]
+            where, params = "date BETWEEN ? AND ? AND ", [date_from, date_to]
+            if archived_to:                                             # アーカイブとSQLiteの両方にある行は一度だけ
+                where, params = where + "datetime > ? AND ", params + [archived_to]
+        source, keys, last = f'"{table}"', "rowid", (0,)                # 時系列でないテーブルは書き込んだ順
+        if table in TIME_SERIES_TABLES:                                 # アーカイブと同じく日時の順
+            with self.db.pool.connection() as conn:                     # 期間のエポック秒の範囲を先に求める
+                first, end = conn.execute(f'SELECT MIN(epoch), MAX(epoch) FROM "{table}" WHERE {where}1',
+                                          params).fetchone()
+            if first is None:
+                return
+            source = f'"{table}" INDEXED BY idx_{table}_epoch'          # 毎回並べ替えないようエポック秒の索引をたどる
+            keys, last = "epoch, rowid", (first - 1, 0)
+            where, params = where + "epoch <= ? AND ", params + [end]
+        sql = f'SELECT {keys}, * FROM {source} WHERE {where}({keys}) > ({", ".join("?" * len(last))})'\
+                f' ORDER BY {keys} LIMIT ?'
+        while True:
+            with self.db.pool.connection() as conn:                     # まとまりごとに借りてすぐ返す
+                rows = conn.execute(sql, params + list(last) + [self.chunk_size]).fetchall()
+            if not rows:
+                break
+            last = rows[-1][:len(last)]
+            yield [row[len(last):] for row in rows]
+
+    def export(self, table, date_from=None, date_to=None, format="csv", compress=False):
+        """
+        テーブルを書き出すジェネレーター
+        Args:
+            table    : テーブル名
+            date_from, date_to: 期間（日付の文字列、両端を含む）　Noneならば端まで
+            format   : "csv" または "ndjson"
+            compress : gzipで圧縮するか
+        Yields:
+            bytes    : 書き出した内容の断片
+        """
+        self.db.flush()                                                 # 溜まっている書き込みを先に済ませる
+        gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None     # wbits=31でgzip形式
+        with self.db.pool.connection() as conn:
+            if table not in self.tables(conn):
+                raise ValueError(f"テーブルがありません: {table}")
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+        chunks = self.rows(table, columns, date_from, date_to)
+        for rows in self.format_chunks(chunks, columns, format):
+            data = rows.encode("utf-8")
+            if gzip is not None:                                        # 断片ごとにフラッシュしてすぐ送れるようにする
+                data = gzip.compress(data) + gzip.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        if gzip is not None:
+            yield gzip.flush()
+
+    def format_chunks(self, chunks, columns, format):
+        """
+        行のまとまりを文字列にする　CSVは最初に見出しの行を付ける
+        """
+        if format == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf, lineterminator="\n")
+            writer.writerow(columns)
+            yield buf.getvalue()
+            for rows in chunks:
+                buf.seek(0)
+                buf.truncate()
+                writer.writerows(rows)
+                yield buf.getvalue()
+        elif format == "ndjson":
+            for rows in chunks:
+                yield "".join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+        else:
+            raise ValueError(f"形式が違います: {format}")
+
+    def filename(self, table, date_from, date_to, format, compress):
+        """
+        ダウンロードのファイル名
+        """
+        span = "_".join(d.replace("/", "") for d in [date_from, date_to] if d)
+        name = f"{table}_{span}" if span else table
+        return f"{name}.{format}" + (".gz" if compress else "")
+
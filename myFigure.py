@@ -0,0 +1,207 @@
+import threading
+import base64
+import matplotlib
+matplotlib.use("Agg")                   # メインスレッド外で使うときはこうする
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Rectangle
+import matplotlib.dates as mdates
+import numpy as np
+import cv2
+
+"""
+グラフのひな形
+軸・目盛・夜の背景などの動かない部品は最初に一度だけ作り、描画のたびに線のデータ・現在時刻の線・タイトルだけを差し替える
+pyplotを使わないので、図がpyplotのグローバルな一覧にたまっていくことはない
+matplotlibはスレッドセーフではないので、ひな形ごとにロックを持つ
+"""
+
+WIDTH_PX, HEIGHT_PX = 900, 200          # グラフのピクセルでのサイズ
+
+
+def fig2str64(fig):
+    # matplotlibの画像をBase64の画像に変換する
+    img = np.asarray(fig.canvas.buffer_rgba())                  # numpy配列にする
+    img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGR)                 # OpenCV画像にする
+    _, imgEnc = cv2.imencode(".jpg", img)                       # メモリ上にエンコード
+    imgB64 = base64.b64encode(imgEnc)                           # base64にエンコード
+    strB64 = "data:image/jpg;base64," + str(imgB64, "utf-8")    # 文字列化
+    return strB64
+
+
+class FigureTemplate():
+    """
+    ひな形の共通部分　図と軸を作り、右と上の枠線を消しておく
+    """
+    def __init__(self, dpi):
+        self.fig = Figure(figsize=(WIDTH_PX/dpi, HEIGHT_PX/dpi), dpi=dpi)
+        FigureCanvasAgg(self.fig)                                       # 図にAggのキャンバスを結びつける
+        self.ax = self.fig.add_subplot()
+        self.ax.spines["right"].set_visible(False)
+        self.ax.spines["top"].set_visible(False)
+        self.lock = threading.Lock()
+        self.layout_done = False                                        # tight_layoutは最初の描画で一度だけ
+
+    def draw(self):
+        """
+        描画してBase64の画像にする
+        """
+        if not self.layout_done:
+            self.fig.tight_layout()
+            self.layout_done = True
+        self.fig.canvas.draw()
+        return fig2str64(self.fig)
+
+
+class DailyFigure(FigureTemplate):
+    """
+    1日分（0時～23:59）を横軸にするグラフの共通部分
+    夜の背景と現在時刻の赤線を持つ
+    """
+    def __init__(self, dpi):
+        super().__init__(dpi)
+        locator = mdates.AutoDateLocator()
+        locator.intervald["HOURLY"] = 3                                 # x軸 3時間ごとに目盛表記
+        self.ax.xaxis.set_major_locator(locator)
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter("%H"))   # x軸の書式
+        trans = self.ax.get_xaxis_transform()                           # xはデータ座標、yは軸の高さに対する割合
+        self.morning = Rectangle((0, 0), 0, 1, transform=trans, color="gray", alpha=0.3)     # 夜の背景（朝まで）
+        self.evening = Rectangle((0, 0), 0, 1, transform=trans, color="gray", alpha=0.3)     # 夜の背景（日の入り後）
+        self.ax.add_patch(self.morning)
+        self.ax.add_patch(self.evening)
+        self.now_line = self.ax.axvline(0, color="red")                 # 現在時刻に赤線
+
+    def set_day(self, dt_0, dt_24, dt_sunrise, dt_sunset, dt_now):
+        """
+        横軸の範囲、夜の背景、現在時刻の線を差し替える
+        """
+        x0, x24 = mdates.date2num(dt_0), mdates.date2num(dt_24)
+        x_rise, x_set = mdates.date2num(dt_sunrise), mdates.date2num(dt_sunset)
+        self.ax.set_xlim(x0, x24)
+        self.morning.set_x(x0)
+        self.morning.set_width(x_rise - x0)
+        self.evening.set_x(x_set)
+        self.evening.set_width(x24 - x_set)
+        x_now = mdates.date2num(dt_now)
+        self.now_line.set_xdata([x_now, x_now])
+
+
+class DailyTempFigure(DailyFigure):
+    """
+    温度デイリーグラフのひな形
+    """
+    def __init__(self, dpi):
+        super().__init__(dpi)
+        self.mean_line = self.ax.axhline(0, color="blue", linestyle="dotted")   # 平均気温の点線
+        self.line, = self.ax.plot([], [], "-b", linewidth=2)            # 気温の線
+
+    def render(self, date, x, y, mean_temp, dt_0, dt_24, dt_sunrise, dt_sunset, dt_now):
+        """
+        Args:
+            date     : 日付（文字列）
+            x, y     : 時刻（datetimeのリスト）と気温のリスト
+            mean_temp: 平均気温
+            dt_0, dt_24, dt_sunrise, dt_sunset, dt_now: 横軸の範囲・日の出・日の入り・現在時刻
+        Returns:
+            strB64   : 画像
+        """
+        with self.lock:
+            self.set_day(dt_0, dt_24, dt_sunrise, dt_sunset, dt_now)
+            self.line.set_data(mdates.date2num(x) if len(x) else [], y)
+            if mean_temp is None:
+                self.mean_line.set_visible(False)
+            else:
+                self.mean_line.set_visible(True)
+                self.mean_line.set_ydata([mean_temp, mean_temp])
+            self.ax.relim()                                             # 縦軸の範囲をデータに合わせる
+            self.ax.autoscale_view(scalex=False)
+            self.ax.set_title(f"{date}の気温 平均{mean_temp}度")
+            return self.draw()
+
+
+class DailyLightFigure(DailyFigure):
+    """
+    LED点灯状態デイリーグラフのひな形
+    """
+    def __init__(self, dpi):
+        super().__init__(dpi)
+        self.ax.set_ylim(0, 1)                                          # y軸の範囲
+        self.fill = self.ax.fill_between([0, 0], [0, 0], color="orange", linewidth=2)   # 点灯中の塗りつぶし
+
+    def render(self, date, x, y, lighting_minutes, dt_0, dt_24, dt_sunrise, dt_sunset, dt_now):
+        """
+        Args:
+            date     : 日付（文字列）
+            x, y     : 時刻（datetimeのリスト）と点灯状態（1/0）のリスト
+            lighting_minutes: 点灯時間の合計（分）
+            dt_0, dt_24, dt_sunrise, dt_sunset, dt_now: 横軸の範囲・日の出・日の入り・現在時刻
+        Returns:
+            strB64   : 画像
+        """
+        with self.lock:
+            self.set_day(dt_0, dt_24, dt_sunrise, dt_sunset, dt_now)
+            xs = mdates.date2num(x)
+            verts = [(xs[0], 0)] + list(zip(xs, y)) + [(xs[-1], 0)]     # y=0との間を塗りつぶす多角形
+            self.fill.set_verts([verts])
+            self.ax.set_title(f"{date}の点灯時間 合計{lighting_minutes}分")   # タイトル
+            return self.draw()
+
+
+class SummaryFigure(FigureTemplate):
+    """
+    日ごとのサマリーグラフのひな形
+    Args:
+        styles: 線ごとの (書式, キーワード引数) のリスト
+        title : タイトル
+        max_days: 表示する最大日数（数値ラベルをその数だけ用意しておく）
+    最後の線の各点には値を表示する
+    """
+    def __init__(self, dpi, styles, title, max_days=31):
+        super().__init__(dpi)
+        self.lines = [self.ax.plot([], [], fmt, **kwargs)[0] for fmt, kwargs in styles]
+        self.labels = [self.ax.text(0, 0, "", visible=False) for _ in range(max_days)]
+        self.ax.set_title(title)
+
+    def render(self, x, ys):
+        """
+        Args:
+            x : 横軸のラベル（文字列のリスト）
+            ys: 線ごとの値のリスト
+        Returns:
+            strB64: 画像
+        """
+        with self.lock:
+            positions = list(range(len(x)))
+            for line, y in zip(self.lines, ys):
+                line.set_data(positions, [np.nan if v is None else v for v in y])
+            self.ax.set_xticks(positions)
+            self.ax.set_xticklabels(x)
+            self.ax.set_xlim(-0.5, max(len(x) - 0.5, 0.5))
+            while len(self.labels) < len(x):                            # 日数が多ければラベルを足す
+                self.labels.append(self.ax.text(0, 0, "", visible=False))
+            last = ys[-1]
+            for i, label in enumerate(self.labels):                     # 最後の線に値を表示する
+                if i < len(x) and last[i] is not None:
+                    label.set_position((i, last[i] + 2))
+                    label.set_text(str(last[i]))
+                    label.set_visible(True)
+                else:
+                    label.set_visible(False)
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=False)
+            return self.draw()
+
+
+class Figures():
+    """
+    アプリで使うひな形をまとめて持つ
+    """
+    def __init__(self, dpi):
+        self.daily_temp = DailyTempFigure(dpi)
+        self.daily_light = DailyLightFigure(dpi)
+        self.summary_temp = SummaryFigure(dpi,
+                                    [(":b", {"linewidth": 1}), (":b", {"linewidth": 1}), (".-b", {"linewidth": 2})],
+                                    "最高・最低・平均気温（度）")
+        self.summary_light = SummaryFigure(dpi,
+                                    [(".-", {"linewidth": 2, "color": "orange"})],
+                                    "日当たりのLED点灯時間（分）")
@@ -0,0 +1,89 @@
+import collections
+import datetime
+import threading
+import time
+
+"""
+描画済みグラフ（base64文字列）のキャッシュ
+キーは (グラフの種類, 日付, データのバージョン)
+データが変わっていなければ描き直さずに前回の画像を返す
+今日のグラフは現在時刻の赤線が動くので ttl 秒で描き直し、過去の日のグラフは有効期限なし
+"""
+
+
+class GraphCache():
+    def __init__(self, today_ttl=60, max_entries=32):
+        """
+        初期設定
+        Args:
+            today_ttl  : 今日のグラフを使い回す秒数
+            max_entries: 保持するグラフの最大数（古く使われたものから捨てる）
+        """
+        self.today_ttl = today_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()                        # キー → (描画した時刻, 画像)
+        self.lock = threading.Lock()
+        self.hits = 0                                                   # キャッシュにあった回数
+        self.misses = 0                                                 # 描画した回数
+        self.render_seconds = 0.0                                       # 描画にかかった時間の合計
+        self.last_render_seconds = {}                                   # グラフの種類ごとの直近の描画時間
+
+    def get(self, kind, date, version, render):
+        """
+        キャッシュにあればそれを、なければ描画して返す
+        Args:
+            kind   : グラフの種類（文字列）
+            date   : 日付（文字列）
+            version: データのバージョン　データが変わるたびに変わる値
+            render : 描画する関数　base64文字列を返す
+        Returns:
+            strB64 : 画像
+        """
+        key = (kind, date, version)
+        is_today = date == datetime.date.today().strftime("%Y/%m/%d")
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                rendered_at, strB64 = entry
+                if not is_today or now - rendered_at < self.today_ttl:  # 過去の日か、今日でも期限内ならば
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return strB64
+
+        start = time.perf_counter()
+        strB64 = render()                                               # 描画はロックの外で
+        seconds = time.perf_counter() - start
+
+        with self.lock:
+            self.misses += 1
+            self.render_seconds += seconds
+            self.last_render_seconds[kind] = seconds
+            for old_key in [k for k in self.entries if k[:2] == key[:2]]:   # 同じグラフの古いバージョンは捨てる
+                del self.entries[old_key]
+            self.entries[key] = (now, strB64)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return strB64
+
+    def clear(self):
+        """
+        キャッシュを全部捨てる
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        ヒット・ミスの回数と描画時間
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits/total, 3) if total else 0,
+                    "render_ms_total": round(self.render_seconds*1000, 1),
+                    "render_ms_mean": round(self.render_seconds*1000/self.misses, 1) if self.misses else 0,
+                    "render_ms_last": {kind: round(sec*1000, 1) for kind, sec in self.last_render_seconds.items()},
+                    "entries": len(self.entries),
+                    }
@@ -0,0 +1,80 @@
+import datetime
+
+"""
+よく通る処理（サマリー表、サマリーグラフ、デイリーグラフ、サマリーの更新）のためのデータの読み出し
+pandasを使わず、sqlite3のカーソルとSQLの集計（MIN/MAX/SUM、累計はウィンドウ関数）だけで値を作る
+データフレームを作らないので、1回あたりのCPUとメモリの確保が少なく、pandasの読み込みもいらない
+pandasはDB.get_temperatureなど、まとめて分析するときだけに使う
+"""
+
+SUMMARY_COLUMNS = ["max_temp", "min_temp", "mean_temp", "lighting_minutes"]
+
+
+def summary_table(conn, cumsum_date, date_from, date_to):
+    """
+    日ごとのサマリーと、累計の始点からの累計
+    Args:
+        conn       : 接続
+        cumsum_date: 累計の始点（日付の文字列）
+        date_from, date_to: 表に出す期間（日付の文字列、両端を含む）
+    Returns:
+        dict       : 日付 → {"max_temp", "min_temp", "mean_temp", "lighting_minutes",
+                             "lighting_minutes_sum", "mean_temp_sum"}（日付の順）
+                     累計は値のない日はNone（これまでのpandasのcumsumと同じ）
+    """
+    sql = "WITH cum AS (SELECT date,"\
+            " CASE WHEN lighting_minutes IS NULL THEN NULL ELSE SUM(lighting_minutes) OVER w END,"\
+            " CASE WHEN mean_temp IS NULL THEN NULL ELSE SUM(mean_temp) OVER w END"\
+            " FROM summary WHERE date BETWEEN ? AND ? WINDOW w AS (ORDER BY date))"\
+            " SELECT s.date, s.max_temp, s.min_temp, s.mean_temp, s.lighting_minutes, cum.*"\
+            " FROM summary s LEFT JOIN cum ON cum.date=s.date"\
+            " WHERE s.date BETWEEN ? AND ? ORDER BY s.date ASC"
+    rows = conn.execute(sql, (cumsum_date, date_to, date_from, date_to)).fetchall()
+    table = {}
+    for date, max_temp, min_temp, mean_temp, lighting_minutes, _, lighting_minutes_sum, mean_temp_sum in rows:
+        table[date] = {"max_temp": max_temp,
+                       "min_temp": min_temp,
+                       "mean_temp": mean_temp,
+                       "lighting_minutes": lighting_minutes,
+                       "lighting_minutes_sum": lighting_minutes_sum,
+                       "mean_temp_sum": mean_temp_sum,
+                       }
+    return table
+
+
+def temperature_stats(conn, date):
+    """
+    その日の気温の最高・最低・サンプル数（インデックスの範囲をSQLで集計する）
+    Returns:
+        (max_temp, min_temp, count)　データがなければ (None, None, 0)
+    """
+    sql = "SELECT MAX(temperature), MIN(temperature), COUNT(temperature) FROM temperature WHERE date=?"
+    return conn.execute(sql, (date,)).fetchone()
+
+
+def led_minutes(conn, date):
+    """
+    その日のLEDテーブルの点灯時間の合計（分）　データがなければNone
+    """
+    return conn.execute("SELECT SUM(minute) FROM LED WHERE date=?", (date,)).fetchone()[0]
+
+
+def upsert_summary(conn, date, **values):
+    """
+    その日のサマリーの列を更新する（行がなければ作る）
+    """
+    columns = list(values)
+    sql = f"INSERT INTO summary(date, {', '.join(columns)}) VALUES(?{', ?' * len(columns)})"\
+            f" ON CONFLICT(date) DO UPDATE SET {', '.join(f'{c}=excluded.{c}' for c in columns)}"
+    conn.execute(sql, (date, *values.values()))
+
+
+def series(rows):
+    """
+    (日時の文字列, 値) の行を、datetimeのリストと値のリストにする
+    """
+    return [str2datetime(row[0]) for row in rows], [row[1] for row in rows]
+
+
+def str2datetime(strdt):
+    return datetime.datetime.strptime(strdt, "%Y/%m/%d %H:%M")
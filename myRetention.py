@@ -0,0 +1,153 @@
+import datetime
+import threading
+import time
+from myArchive import TABLES
+
+"""
+古いデータの削除（リテンション）をバックグラウンドで少しずつ行う
+rowidで区切った小さなまとまりごとに削除してコミットし、まとまりの間で一休みするので、
+その間にセンサー値の書き込みや制御ループが割り込める
+削除で空いたページは incremental_vacuum で少しずつファイルから切り詰める（auto_vacuum=INCREMENTALが前提）
+SQLiteのあとで、月ごとのアーカイブ（.npz）からも同じ日以前の行を消す
+"""
+
+
+class Retention():
+    def __init__(self, db, chunk_size=500, pause=0.05, vacuum_pages=256):
+        """
+        初期設定
+        Args:
+            db          : DB
+            chunk_size  : 一度に削除する行数
+            pause       : まとまりの間に休む秒数
+            vacuum_pages: 一度のincremental_vacuumで切り詰める最大ページ数
+        """
+        self.db = db
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.lock = threading.Lock()
+        self.thread = None
+        self.cancelled = False
+        self.status = {"state": "idle"}                                 # 進み具合
+
+    def start(self, date_to):
+        """
+        削除を始める　既に動いていればそのまま
+        Args:
+            date_to: この日以前のデータを削除する（日付の文字列）
+        Returns:
+            dict   : 進み具合
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return dict(self.status)
+            self.cancelled = False
+            self.status = {"state": "running", "date": date_to, "table": None, "deleted": 0, "total": 0,
+                           "percent": 0, "freed_pages": 0, "archive_deleted": 0, "error": None,
+                           "started": datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"), "finished": None}
+            self.thread = threading.Thread(target=self.run, args=(date_to,), daemon=True)
+            self.thread.start()
+            return dict(self.status)
+
+    def cancel(self):
+        """
+        削除を途中でやめる（そこまでの削除は残る）
+        """
+        self.cancelled = True
+
+    def progress(self):
+        """
+        進み具合
+        Returns:
+            dict: {"state": idle/running/done/cancelled/error, "date", "table", "deleted", "total", "percent",
+                   "freed_pages", "archive_deleted", "error", "started", "finished"}
+        """
+        with self.lock:
+            return dict(self.status)
+
+    def update(self, **kwargs):
+        with self.lock:
+            self.status.update(kwargs)
+            if self.status.get("total"):
+                self.status["percent"] = round(self.status["deleted"] * 100 / self.status["total"], 1)
+
+    def run(self, date_to):
+        """
+        削除スレッド　テーブルごとに、rowidの小さい順に chunk_size 行ずつ削除する
+        """
+        self.db.flush()                                                 # 溜まっている書き込みを先に済ませる
+        try:
+            with self.db.pool.connection() as conn:
+                tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+                tables = [t for t in tables if t != "config"
+                          and "date" in [row[1] for row in conn.execute(f'PRAGMA table_info("{t}")')]]
+                counts = {t: conn.execute(f'SELECT COUNT(*) FROM "{t}" WHERE date<=?', (date_to,)).fetchone()[0]
+                          for t in tables}
+                self.update(total=sum(counts.values()))
+                for table in tables:
+                    if counts[table]:
+                        self.purge_table(conn, table, date_to)
+                    if self.cancelled:
+                        break
+                self.vacuum(conn, all=True)
+            if not self.cancelled:
+                self.purge_archive(date_to)
+            self.update(state="cancelled" if self.cancelled else "done")
+        except Exception as e:
+            self.update(state="error", error=str(e))
+        finally:
+            self.update(finished=datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+            self.db.archived_before = None                              # アーカイブの境目はファイルから求め直す
+            self.db.aggregator.forget()                                 # 集計もグラフも作り直させる
+            self.db.graph_cache.clear()
+            self.db.bump_version("summary", None)
+
+    def purge_table(self, conn, table, date_to):
+        """
+        1テーブル分の削除　前回のまとまりの最後のrowidから続けて探す（キーセット）
+        """
+        self.update(table=table)
+        last = 0
+        while not self.cancelled:
+            rowids = [row[0] for row in conn.execute(
+                f'SELECT rowid FROM "{table}" WHERE rowid>? AND date<=? ORDER BY rowid LIMIT ?',
+                (last, date_to, self.chunk_size))]
+            if not rowids:
+                break
+            conn.execute(f'DELETE FROM "{table}" WHERE rowid BETWEEN ? AND ? AND date<=?',
+                         (rowids[0], rowids[-1], date_to))
+            conn.commit()                                               # まとまりごとにロックを手放す
+            last = rowids[-1]
+            with self.lock:
+                self.status["deleted"] += len(rowids)
+            self.update()
+            self.vacuum(conn)
+            time.sleep(self.pause)                                      # ほかの書き込みに順番を譲る
+
+    def purge_archive(self, date_to):
+        """
+        アーカイブのファイルから削除する
+        """
+        for table in TABLES:
+            self.update(table=f"archive/{table}")
+            deleted = self.db.archive.purge(table, date_to)
+            with self.lock:
+                self.status["archive_deleted"] += deleted
+
+    def vacuum(self, conn, all=False):
+        """
+        空いたページをファイルから切り詰める
+        Args:
+            all: Trueならば空いているページを全部
+        """
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if freelist == 0 or (not all and freelist < self.vacuum_pages):
+            return
+        pages = freelist if all else self.vacuum_pages
+        conn.executescript(f"PRAGMA incremental_vacuum({pages});")      # executeでは1ページしか切り詰めない
+        freed = freelist - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        with self.lock:
+            self.status["freed_pages"] += freed
+        if all:                                                         # WALではチェックポイントでファイルが縮む
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
@@ -0,0 +1,171 @@
+import datetime
+
+"""
+5分・1時間・1日ごとのロールアップ（最低・最高・合計・件数の気温と点灯時間）
+生データ（temperature、light）を書き込むときに同じトランザクションで少しずつ更新する
+長い期間のグラフは、点数が上限に収まるいちばん細かいロールアップから読むので、
+1年分でも日ごとの365行を読むだけで済む
+"""
+
+# (名前, テーブル名, 1区間の分)　細かい順
+LEVELS = [("5min", "rollup_5min", 5),
+          ("hour", "rollup_hour", 60),
+          ("day", "rollup_day", 1440)]
+
+UPSERT_SQL = "INSERT INTO {table}(bucket, date, temp_min, temp_max, temp_sum, temp_count, on_minutes)"\
+                " VALUES(?, ?, ?, ?, ?, ?, ?)"\
+                " ON CONFLICT(bucket) DO UPDATE SET"\
+                " temp_min=min(coalesce(temp_min, excluded.temp_min), coalesce(excluded.temp_min, temp_min)),"\
+                " temp_max=max(coalesce(temp_max, excluded.temp_max), coalesce(excluded.temp_max, temp_max)),"\
+                " temp_sum=temp_sum+excluded.temp_sum, temp_count=temp_count+excluded.temp_count,"\
+                " on_minutes=on_minutes+excluded.on_minutes"
+
+
+def create_tables(conn):
+    """
+    ロールアップのテーブルを作る（マイグレーションから呼ぶ）
+    bucketは区間の始まりの文字列（1日ならば'YYYY/MM/DD'、それ以外は'YYYY/MM/DD HH:MM'）
+    dateは他の時系列テーブルと同じく日付で、古いデータの削除に使う
+    """
+    for _, table, _ in LEVELS:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ("bucket" TEXT PRIMARY KEY, "date" TEXT,'
+                        ' "temp_min" REAL, "temp_max" REAL, "temp_sum" REAL NOT NULL DEFAULT 0,'
+                        ' "temp_count" INTEGER NOT NULL DEFAULT 0, "on_minutes" INTEGER NOT NULL DEFAULT 0)')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table}(date)")
+
+
+def floor(dt, minutes):
+    """
+    その時刻を含む区間の始まり
+    """
+    if minutes == 1440:
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    m = (dt.hour * 60 + dt.minute) // minutes * minutes
+    return dt.replace(hour=m // 60, minute=m % 60, second=0, microsecond=0)
+
+
+def bucket_of(dt, minutes):
+    """
+    その時刻を含む区間のbucket（文字列）
+    """
+    if minutes == 1440:
+        return dt.strftime("%Y/%m/%d")
+    return floor(dt, minutes).strftime("%Y/%m/%d %H:%M")
+
+
+def bucket_sql(minutes):
+    """
+    datetime列（'YYYY/MM/DD HH:MM'）からbucketを求めるSQL式
+    """
+    if minutes == 1440:
+        return "date"
+    m = f"(CAST(substr(datetime, 12, 2) AS INTEGER)*60 + CAST(substr(datetime, 15, 2) AS INTEGER)) / {minutes} * {minutes}"
+    return f"substr(datetime, 1, 11) || printf('%02d:%02d', {m} / 60, {m} % 60)"
+
+
+def split_minutes(dt_from, dt_to, minutes):
+    """
+    dt_fromからdt_toまでの時間を区間ごとに分ける
+    Yields:
+        (bucket, 分)
+    """
+    cur = dt_from
+    while cur < dt_to:
+        end = min(floor(cur, minutes) + datetime.timedelta(minutes=minutes), dt_to)
+        yield bucket_of(cur, minutes), int((end - cur).total_seconds() // 60)
+        cur = end
+
+
+class Rollup():
+    def __init__(self):
+        self.last_light = None                                          # 最後の点灯サンプル (datetime, 値)
+        self.seeded = False                                             # last_lightをDBから読んだか
+
+    def forget(self):
+        """
+        覚えている最後の点灯サンプルを捨てる（書き込みに失敗したときなど）
+        """
+        self.last_light = None
+        self.seeded = False
+
+    def seed(self, conn):
+        """
+        最後の点灯サンプルをDBから読む　点灯中の区間は次のサンプルが来たときに数える
+        """
+        if not self.seeded:
+            row = conn.execute("SELECT datetime, value FROM light ORDER BY epoch DESC LIMIT 1").fetchone()
+            self.last_light = None if row is None else (str2datetime(row[0]), int(row[1]))
+            self.seeded = True
+
+    def add(self, conn, temps, lights):
+        """
+        生データを加える　生データを挿入する前に、同じトランザクションの中で呼ぶ
+        Args:
+            conn  : 接続
+            temps : (日時の文字列, 気温) のリスト
+            lights: (日時の文字列, オン=1/オフ=0) のリスト（古い順）
+        """
+        self.seed(conn)
+        for _, table, minutes in LEVELS:
+            acc = {}                                                    # bucket → [date, 最低, 最高, 合計, 件数, 点灯分]
+            for strdt, temp in temps:
+                dt = str2datetime(strdt)
+                row = acc.setdefault(bucket_of(dt, minutes), [dt.strftime("%Y/%m/%d"), temp, temp, 0.0, 0, 0])
+                row[1] = temp if row[1] is None else min(row[1], temp)
+                row[2] = temp if row[2] is None else max(row[2], temp)
+                row[3] += temp
+                row[4] += 1
+            last = self.last_light
+            for strdt, value in lights:
+                dt = str2datetime(strdt)
+                if last is not None and last[1] and dt > last[0]:       # 前のサンプルから点灯していた時間
+                    for bucket, on in split_minutes(last[0], dt, minutes):
+                        row = acc.setdefault(bucket, [bucket[:10], None, None, 0.0, 0, 0])
+                        row[5] += on
+                last = (dt, int(value))
+            conn.executemany(UPSERT_SQL.format(table=table), [(bucket, *row) for bucket, row in acc.items()])
+        if lights:
+            self.last_light = (str2datetime(lights[-1][0]), int(lights[-1][1]))
+
+    def rebuild(self, conn):
+        """
+        ロールアップを生データから作り直す
+        """
+        for _, table, minutes in LEVELS:
+            conn.execute(f"DELETE FROM {table}")
+            conn.execute(f"INSERT INTO {table}(bucket, date, temp_min, temp_max, temp_sum, temp_count)"
+                            f" SELECT {bucket_sql(minutes)}, date, MIN(temperature), MAX(temperature),"
+                            " TOTAL(temperature), COUNT(temperature) FROM temperature"
+                            " WHERE temperature IS NOT NULL GROUP BY 1")     # 気温はSQLだけで集計する
+        self.last_light, self.seeded = None, True
+        lights = conn.execute("SELECT datetime, value FROM light ORDER BY epoch ASC").fetchall()
+        self.add(conn, [], lights)                                      # 点灯時間は区間をまたぐのでPythonで
+
+    def query(self, conn, start, end, max_points=500):
+        """
+        期間のロールアップを読む　区間の数がmax_points以下になるいちばん細かいものを使う
+        Args:
+            start, end: 期間（datetime）endは含まない
+            max_points: 最大の点数
+        Returns:
+            dict      : {"resolution", "bucket", "min_temp", "max_temp", "mean_temp", "count", "on_minutes"}
+        """
+        span = (end - start).total_seconds() / 60
+        for name, table, minutes in LEVELS:
+            if span / minutes <= max_points:
+                break
+        sql = f"SELECT bucket, temp_min, temp_max, temp_sum, temp_count, on_minutes FROM {table}"\
+                " WHERE bucket BETWEEN ? AND ? ORDER BY bucket ASC"
+        last = end - datetime.timedelta(minutes=1)                     # endの1分前までを含む
+        rows = conn.execute(sql, (bucket_of(start, minutes), bucket_of(last, minutes))).fetchall()
+        return {"resolution": name,
+                "bucket": [row[0] for row in rows],
+                "min_temp": [row[1] for row in rows],
+                "max_temp": [row[2] for row in rows],
+                "mean_temp": [round(row[3] / row[4], 1) if row[4] else None for row in rows],
+                "count": [row[4] for row in rows],
+                "on_minutes": [row[5] for row in rows]}
+
+
+def str2datetime(strdt):
+    return datetime.datetime.strptime(strdt, "%Y/%m/%d %H:%M")
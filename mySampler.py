@@ -0,0 +1,131 @@
+import datetime
+import threading
+import time
+
+"""
+温湿度計のバックグラウンド読み取り
+DHT11は1回の読み取りに開始信号の待ちだけで70msかかり、失敗も多い
+読み取りスレッドが決まった間隔で読み、失敗したら間を空けながら（バックオフ）やり直し、
+最後に読めた値を時刻と一緒に覚えておく　/getHumi はその値を返すだけなのでセンサーの速さに左右されない
+DBへの書き込みと画面への配信は、読めたときにlistenersが1回だけ行う（要求の数だけ書き込まない）
+"""
+
+
+class Sampler():
+    def __init__(self, sensor, interval=60, retries=10, backoff=1.0, max_backoff=30.0):
+        """
+        初期設定
+        Args:
+            sensor     : read()でDHT11Resultを返すもの（dht11.DHT11）
+            interval   : 読み取りの間隔（秒）
+            retries    : 1回の読み取りで試す最大の回数
+            backoff    : 失敗したときに次に試すまでの最初の待ち（秒）　失敗するたびに倍にする
+            max_backoff: 待ちの上限（秒）
+        """
+        self.sensor = sensor
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        retry_window = sum(min(backoff * 2**i, max_backoff) for i in range(retries - 1))   # 1回の読み取りで待つ合計
+        self.max_age = interval + retry_window                          # これより古い値は読めなくなったとみなす
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.listeners = []                                             # 読めたときに呼ぶ関数
+        self.last = None                                                # 最後に読めた値 (気温, 湿度, 時刻)
+        self.reads = 0                                                  # 読み取りの回数
+        self.failures = 0                                               # 失敗した試しの回数
+        self.last_error = None                                          # 最後に失敗したときの内容
+
+    def start(self):
+        """
+        読み取りスレッドを始める
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        読み取りスレッドを止める
+        """
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.max_backoff + 5)
+
+    def add_listener(self, func):
+        """
+        読めたときに呼ぶ関数を登録する
+        Args:
+            func: func(dict)　dictはlatest()と同じ形
+        """
+        self.listeners.append(func)
+
+    def run(self):
+        """
+        読み取りスレッド　間隔ごとにsampleする
+        """
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            self.sample()
+            self.stop_event.wait(max(self.interval - (time.monotonic() - started), 0))
+
+    def sample(self):
+        """
+        センサーを読む　読めるまで retries 回まで、間を空けながら試す
+        Returns:
+            bool: 読めたか
+        """
+        wait = self.backoff
+        for i in range(self.retries):
+            try:
+                result = self.sensor.read()
+                error = None if result.is_valid() else f"error_code={result.error_code}"
+            except Exception as e:                                      # センサーの例外でスレッドを止めない
+                error = str(e)
+            with self.lock:
+                self.reads += 1
+                if error is None:
+                    self.last = (round(result.temperature, 1), round(result.humidity, 1), datetime.datetime.now())
+                else:
+                    self.failures += 1
+                    self.last_error = error
+            if error is None:
+                latest = self.latest()
+                for func in self.listeners:
+                    try:
+                        func(latest)
+                    except Exception as e:                              # 受け取る側の失敗で読み取りを止めない
+                        print(f"温湿度計の値を渡せない　{e}")
+                return True
+            if i < self.retries - 1 and self.stop_event.wait(wait):     # 止めるときは待たずに抜ける
+                break
+            wait = min(wait * 2, self.max_backoff)
+        return False
+
+    def latest(self):
+        """
+        最後に読めた値
+        Returns:
+            dict: {"temp", "humi", "time", "age"}　まだ読めていなければtempとhumiは-1、timeはNone
+                  ageは読んでからの秒数　max_age（間隔と、やり直しの待ちの合計）より古ければtempとhumiは-1
+                  チェックサムの失敗などでやり直しても、その回のうちに読めれば-1にはならない
+        """
+        with self.lock:
+            last = self.last
+        if last is None:
+            return {"temp": -1, "humi": -1, "time": None, "age": None}
+        temp, humi, dt = last
+        age = round((datetime.datetime.now() - dt).total_seconds(), 1)
+        if age > self.max_age:                                          # 1回分のやり直しを全部失敗したら古い値は返さない
+            temp, humi = -1, -1
+        return {"temp": temp, "humi": humi, "time": dt.strftime("%Y/%m/%d %H:%M:%S"), "age": age}
+
+    def stats(self):
+        """
+        読み取りの統計
+        """
+        with self.lock:
+            return {"interval": self.interval, "reads": self.reads, "failures": self.failures,
+                    "last_error": self.last_error}
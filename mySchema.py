@@ -0,0 +1,182 @@
+import sqlite3
+import sys
+import myRollup
+
+"""
+データベースのスキーマ管理
+PRAGMA user_version にスキーマのバージョンを記録し、足りないマイグレーションだけを順に実行する
+単体で実行すると既存のagri.dbをその場で最新のスキーマに書き換える
+    python mySchema.py [agri.db]
+"""
+
+# 時系列テーブル　日時の文字列からエポック秒を求める列を持つもの
+TIME_SERIES_TABLES = ["temperature", "light", "contec"]
+
+# 'YYYY/MM/DD HH:MM'（ローカル時刻）の文字列をエポック秒にするSQL式
+EPOCH_SQL = "CAST(strftime('%s', replace(datetime, '/', '-'), 'utc') AS INTEGER)"
+
+
+def columns(conn, table):
+    """
+    テーブルの列名のリスト
+    """
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def add_column(conn, table, column, type):
+    """
+    列がなければ追加する
+    """
+    if column not in columns(conn, table):
+        conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {type}')
+
+
+def migrate_1(conn):
+    """
+    バージョン1
+    ・テーブルがなければ作る（新規のデータベース用）
+    ・時系列テーブルに整数のエポック秒列を追加して既存行を埋める
+    ・時系列テーブルに (date, datetime) の複合インデックスを張る
+    ・summaryの日付を一意にする（重複していれば最後の行を残す）
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS "temperature" ("date" TEXT, "datetime" TEXT, "temperature" REAL, "humidity" REAL, "epoch" INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS "light" ("date" TEXT, "datetime" TEXT, "value" INTEGER, "epoch" INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS "contec" ("date" TEXT, "datetime" TEXT, "rawdata" TEXT, "epoch" INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS "LED" ("date" TEXT, "datetime_from" TEXT, "datetime_to" TEXT, "minute" INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS "summary" ("date" TEXT, "sunrise_time" TEXT, "sunset_time" TEXT, "moon_phase" TEXT,'
+                    ' "lighting_minutes" INTEGER, "max_temp" REAL, "min_temp" REAL, "mean_temp" REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS "config" ("index" TEXT, "value" TEXT)')
+
+    for table in TIME_SERIES_TABLES:                                    # 各時系列テーブルにおいて
+        add_column(conn, table, "epoch", "INTEGER")                     # エポック秒の列を追加する
+        conn.execute(f"UPDATE {table} SET epoch={EPOCH_SQL} WHERE epoch IS NULL")      # 既存行を埋める
+
+    # 1日分の検索がインデックスだけで済むよう、よく読む列まで含めたインデックスにする
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_temperature_date ON temperature(date, datetime, temperature, humidity)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_light_date ON light(date, datetime, value)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_contec_date ON contec(date, datetime)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_LED_date ON LED(date)")
+    for table in TIME_SERIES_TABLES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_epoch ON {table}(epoch)")
+
+    conn.execute("DELETE FROM summary WHERE rowid NOT IN (SELECT MAX(rowid) FROM summary GROUP BY date)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_summary_date ON summary(date)")
+
+
+def migrate_2(conn):
+    """
+    バージョン2
+    ・summaryに温度のサンプル数と合計を追加する（日ごとの集計を少しずつ更新するため）
+    """
+    add_column(conn, "summary", "temp_count", "INTEGER")
+    add_column(conn, "summary", "temp_sum", "REAL")
+    conn.execute("UPDATE summary SET"
+                    " temp_count=(SELECT COUNT(*) FROM temperature t WHERE t.date=summary.date),"
+                    " temp_sum=(SELECT TOTAL(temperature) FROM temperature t WHERE t.date=summary.date)")
+
+
+def migrate_3(conn):
+    """
+    バージョン3
+    ・5分・1時間・1日ごとのロールアップのテーブルを作り、既存の生データから埋める
+    """
+    myRollup.create_tables(conn)
+    myRollup.Rollup().rebuild(conn)
+
+
+def migrate_4(conn):
+    """
+    バージョン4
+    ・1年分の暦（日の出・日の入り・市民薄明・月齢）を入れるテーブルを作る（中身はmyEphem.EphemTableが入れる）
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS "ephem" ("date" TEXT PRIMARY KEY, "lat" TEXT, "lon" TEXT, "elev" INTEGER,'
+                    ' "sunrise_time" TEXT, "sunset_time" TEXT, "civil_dawn" TEXT, "civil_dusk" TEXT, "moon_phase" REAL)')
+
+
+def migrate_5(conn):
+    """
+    バージョン5
+    ・MCP3004の電圧を間引いて（1分ごとの平均で）残すテーブルを作る
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS "analog" ("date" TEXT, "datetime" TEXT, "epoch" INTEGER,'
+                    ' "ch0" REAL, "ch1" REAL, "ch2" REAL, "ch3" REAL, "battery_v" REAL, "soc" REAL)')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analog_date ON analog(date, datetime)")
+
+
+def migrate_6(conn):
+    """
+    バージョン6
+    ・configのキーを一意にする（重複していれば最後の行を残す）　設定は1キーずつupsertする
+    """
+    conn.execute('DELETE FROM config WHERE rowid NOT IN (SELECT MAX(rowid) FROM config GROUP BY "index")')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_config_index ON config("index")')
+
+
+# バージョン番号とマイグレーション関数　追加するときは末尾に足していく
+MIGRATIONS = [
+    (1, migrate_1),
+    (2, migrate_2),
+    (3, migrate_3),
+    (4, migrate_4),
+    (5, migrate_5),
+    (6, migrate_6),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    """
+    データベースのスキーマのバージョン
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    足りないマイグレーションを順に実行する
+    バージョンごとに1トランザクションなので、途中で失敗してもそのバージョンの前に戻る
+    Args:
+        conn   : sqlite3の接続
+    Returns:
+        version: 実行後のバージョン
+    """
+    version = get_version(conn)
+    for number, func in MIGRATIONS:
+        if number <= version:                                           # 実行済みならば飛ばす
+            continue
+        conn.execute("BEGIN")
+        try:
+            func(conn)
+            conn.execute(f"PRAGMA user_version={number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    enable_incremental_vacuum(conn)
+    return version
+
+
+def enable_incremental_vacuum(conn):
+    """
+    削除で空いたページを少しずつ切り詰められるよう auto_vacuum=INCREMENTAL にする
+    既存のファイルで切り替えるにはVACUUMが要るので、まだのときに一度だけ（トランザクションの外で）行う
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:          # 2=INCREMENTAL
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def main():
+    dbname = sys.argv[1] if len(sys.argv) > 1 else "agri.db"
+    conn = sqlite3.connect(dbname)
+    before = get_version(conn)
+    after = migrate(conn)
+    conn.execute("VACUUM")                                              # 書き換えたファイルを詰め直す
+    conn.close()
+    print(f"{dbname}: スキーマ {before} → {after}")
+
+
+if __name__ == "__main__":
+    main()
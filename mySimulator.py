@@ -0,0 +1,523 @@
+import configparser
+import ctypes
+import datetime
+import math
+import random
+import threading
+import time
+
+"""
+ハードウェアのシミュレーター
+Raspberry Piやコンテックのボードがない機械でも、アプリと制御ループを本番と同じ呼び方で動かすためのもの
+    SimCdio : cdio.py と同じ名前の関数・定数を持ち、Contec(driver=...) に渡す
+              DioInpByte/DioOutByte/DioInpBit、割り込み、DioDm系のバッファ取り込みを真似る
+    SimGPIO : RPi.GPIO と同じ名前の関数・定数を持ち、dht11.DHT11(pin, gpio=...) に渡す
+              DHT11の40ビットの信号（Low 50us のあとHigh 26～28us なら0、70us なら1）を1サンプルずつ返す
+    SimADC  : gpiozero.MCP3004 の代わりのチャンネルを作る　ch0は太陽電池、ch3はバッテリーの電圧（分圧後）
+    CloudProfile: 時刻ごとの曇り具合（光センサーが暗いと答える確率）の台本
+呼び出しごとの遅延と失敗率は設定できる（simulator.ini）
+"""
+
+SETTINGS_FILE = "simulator.ini"
+DEFAULT_SETTINGS = {"profile": "passing",       # 曇り具合の台本（PROFILESの名前か「時刻 値, 時刻 値, ...」）
+                    "speed": "1",               # 台本の時計の速さ（60なら1分で1時間進む）
+                    "latency_ms": "0.05",       # ボードの呼び出し1回の遅延（ミリ秒）
+                    "jitter_ms": "0.02",        # 遅延のばらつき（ミリ秒）
+                    "failure_rate": "0",        # ボードの呼び出しが失敗する確率
+                    "tick_ms": "100",           # 入力が変わりうる間隔（ミリ秒）
+                    "hold_s": "5",              # 光センサーが同じ値を保つ平均の秒数
+                    "battery": "1,1,1",         # 電圧リレーの入力（入力ピン6～8）
+                    "temp": "25",               # 平均気温
+                    "temp_range": "8",          # 気温の日較差
+                    "humi": "60",               # 平均湿度
+                    "dht_failure_rate": "0.1",  # DHT11の読み取りが失敗する確率（半分は欠け、半分はチェックサム誤り）
+                    "sample_us": "5",           # DHT11の信号を読む1サンプルの時間（マイクロ秒）
+                    "battery_v": "12.3",        # バッテリーの平均の電圧（V）
+                    "seed": "",                 # 乱数の種（空ならば毎回違う）
+                    }
+
+# 曇り具合の台本　(時刻, 暗いと答える確率)　間は直線で補間し、23:59の次は0:00につながる
+PROFILES = {"clear": [("00:00", 1), ("05:30", 1), ("06:30", 0), ("17:00", 0), ("18:00", 1)],
+            "cloudy": [("00:00", 1), ("05:30", 1), ("06:30", 0.8), ("17:00", 0.8), ("18:00", 1)],
+            "passing": [("00:00", 1), ("05:30", 1), ("06:30", 0.1), ("09:00", 0.7), ("10:00", 0.1),
+                        ("12:00", 0.9), ("13:00", 0.2), ("15:00", 0.6), ("17:00", 0.4), ("18:00", 1)],
+            "dark": [("00:00", 1)],
+            }
+
+
+class CloudProfile():
+    def __init__(self, points, speed=1.0):
+        """
+        Args:
+            points: (時刻"HH:MM", 0～1) のリスト
+            speed : 台本の時計の速さ
+        """
+        self.points = sorted((hm2minutes(hm), float(v)) for hm, v in points)
+        self.speed = speed
+        self.origin = time.time()
+        self.start = minutes_of_day(datetime.datetime.now())            # 台本の時計は今の時刻から始める
+
+    @classmethod
+    def parse(cls, text, speed=1.0):
+        """
+        名前（PROFILESのキー）か「06:00 0.1, 12:00 0.8」の形の文字列から作る
+        """
+        text = text.strip()
+        if text in PROFILES:
+            return cls(PROFILES[text], speed)
+        points = [item.split() for item in text.split(",") if item.strip()]
+        return cls([(hm, v) for hm, v in points], speed)
+
+    def minutes(self, now=None):
+        """
+        台本の時計の時刻（0時からの分）
+        """
+        now = time.time() if now is None else now
+        return (self.start + (now - self.origin) * self.speed / 60) % 1440
+
+    def value(self, minutes):
+        """
+        ある時刻の曇り具合
+        """
+        points = self.points
+        if len(points) == 1:
+            return points[0][1]
+        for (m0, v0), (m1, v1) in zip(points, points[1:] + [(points[0][0] + 1440, points[0][1])]):
+            if m0 <= minutes < m1:
+                return v0 + (v1 - v0) * (minutes - m0) / (m1 - m0)
+        first, last = points[0], points[-1]                             # 最初の点より前は前日の最後の点から補間する
+        return last[1] + (first[1] - last[1]) * (minutes + 1440 - last[0]) / (first[0] + 1440 - last[0])
+
+
+class Device():
+    """
+    SimCdioとSimGPIOの共通部分　遅延・失敗の起こし方と乱数を持つ
+    """
+    def __init__(self, latency, jitter, failure_rate, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.calls = 0                                                  # 呼び出しの回数
+        self.failures = 0                                               # わざと失敗させた回数
+
+    def io_wait(self):
+        """
+        ボードとのやり取りにかかる時間だけ待ち、失敗させるかどうかを返す
+        """
+        self.calls += 1
+        wait = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+        if self.rng.random() < self.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+
+class SimCdio(Device):
+    # cdio.pyと同じ値の定数
+    DIO_ERR_SUCCESS = 0
+    DIO_ERR_DLL_CALL_DRIVER = 10002
+    DIOM_INTERRUPT = 0x1300
+    DIO_INT_NONE, DIO_INT_RISE, DIO_INT_FALL = 0, 1, 2
+    DIODM_DIR_IN = 0x1
+    DIODM_START_SOFT = 1
+    DIODM_CLK_CLOCK = 1
+    DIODM_TIM_UNIT_S, DIODM_TIM_UNIT_MS, DIODM_TIM_UNIT_US, DIODM_TIM_UNIT_NS = 1, 2, 3, 4
+    DIODM_STOP_SOFT = 1
+    DIODM_RESET_FIFO_IN = 0x02
+    DIODM_WRITE_RING = 1
+    PDIO_INT_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_short, ctypes.c_short, ctypes.c_long, ctypes.c_long, ctypes.c_void_p)
+    ERRORS = {0: "Normal complete",
+              10002: "Driver cannot be called (simulated failure)"}
+
+    def __init__(self, profile, latency=0.00005, jitter=0.00002, failure_rate=0.0,
+                 tick=0.1, hold=5.0, battery=(1, 1, 1), rng=None):
+        """
+        Args:
+            profile : CloudProfile
+            latency, jitter: 呼び出し1回の遅延とばらつき（秒）
+            failure_rate   : DioInpByte/DioInpBit/DioOutByteが失敗する確率
+            tick    : 入力が変わりうる間隔（秒）
+            hold    : 光センサーが同じ値を保つ平均の秒数
+            battery : 入力ピン6～8（電圧リレー）の値
+        """
+        super().__init__(latency, jitter, failure_rate, rng or random.Random())
+        self.profile = profile
+        self.tick = tick
+        self.hold = hold
+        self.battery = list(battery)
+        self.lights = [1] * 5                                           # 入力ピン1～5（光センサー）
+        self.lock = threading.Lock()
+        self.in_byte = self.to_byte()                                   # 入力ポートの値（ピン1がビット7）
+        self.out_byte = 0                                               # 出力ポートの値
+        self.outputs = []                                               # 出力の履歴 (時刻, 値)
+        self.callback = None                                            # 割り込みのコールバック
+        self.int_logic = {}                                             # ビットごとの割り込みの向き
+        self.dm = None                                                  # バッファ取り込みの状態
+        self.thread = None
+
+    def to_byte(self):
+        """
+        入力ピン1～8の値を8ビットにする（Contec.num2arrayの逆）
+        """
+        return sum(v << (7 - i) for i, v in enumerate(self.lights + self.battery))
+
+    def update(self, now):
+        """
+        1ティック分、光センサーを台本に沿って変え、割り込みとバッファ取り込みを起こす
+        """
+        cloud = self.profile.value(self.profile.minutes(now))
+        p = min(self.tick * self.profile.speed / self.hold, 1)         # このティックで読み直す確率
+        with self.lock:
+            old = self.in_byte
+            self.lights = [(1 if self.rng.random() < cloud else 0) if self.rng.random() < p else v
+                           for v in self.lights]
+            self.in_byte = self.to_byte()
+            new = self.in_byte
+            callback, logic = self.callback, dict(self.int_logic)
+        for bit in range(8):                                            # 変わったビットで割り込む
+            was, now_bit = old >> bit & 1, new >> bit & 1
+            if was == now_bit or callback is None:
+                continue
+            if logic.get(bit) == (self.DIO_INT_RISE if now_bit else self.DIO_INT_FALL):
+                callback(0, self.DIOM_INTERRUPT, 0, bit, None)
+        self.fill_buffer(now, new)
+
+    def run(self):
+        """
+        ティックごとにupdateを呼ぶスレッド
+        """
+        deadline = time.monotonic()
+        while True:
+            deadline += self.tick
+            self.update(time.time())
+            time.sleep(max(deadline - time.monotonic(), 0))
+
+    def DioInit(self, name, id_ref):
+        id_ref._obj.value = 0
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self.DIO_ERR_SUCCESS
+
+    def DioExit(self, id):
+        return self.DIO_ERR_SUCCESS
+
+    def DioGetErrorString(self, ret, err_str):
+        err_str.value = self.ERRORS.get(ret, "Unknown error").encode()
+        return self.DIO_ERR_SUCCESS
+
+    def DioInpByte(self, id, port_no, data_ref):
+        if self.io_wait():
+            return self.DIO_ERR_DLL_CALL_DRIVER
+        with self.lock:
+            data_ref._obj.value = self.in_byte
+        return self.DIO_ERR_SUCCESS
+
+    def DioInpBit(self, id, bit_no, data_ref):
+        if self.io_wait():
+            return self.DIO_ERR_DLL_CALL_DRIVER
+        with self.lock:
+            data_ref._obj.value = self.in_byte >> int(getattr(bit_no, "value", bit_no)) & 1
+        return self.DIO_ERR_SUCCESS
+
+    def DioOutByte(self, id, port_no, data):
+        if self.io_wait():
+            return self.DIO_ERR_DLL_CALL_DRIVER
+        value = getattr(data, "value", data)
+        with self.lock:
+            self.out_byte = value
+            self.outputs.append((time.time(), value))
+        return self.DIO_ERR_SUCCESS
+
+    def DioSetInterruptCallBackProc(self, id, callback, param):
+        with self.lock:
+            self.callback = callback
+        return self.DIO_ERR_SUCCESS
+
+    def DioSetInterruptEvent(self, id, bit_no, logic):
+        with self.lock:
+            self.int_logic[bit_no] = logic
+        return self.DIO_ERR_SUCCESS
+
+    # バッファ取り込み　設定を覚えておき、ティックごとに経過時間分のサンプルをバッファに書く
+    def DioDmReset(self, id, reset):
+        self.dm = {"period": 0, "buff": None, "length": 0, "running": False}
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetDirection(self, id, dir):
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetStandAlone(self, id):
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetStartTrg(self, id, dir, start):
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetClockTrg(self, id, dir, clock):
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetInternalClock(self, id, dir, clock, unit):
+        scale = {self.DIODM_TIM_UNIT_S: 1, self.DIODM_TIM_UNIT_MS: 1e-3,
+                 self.DIODM_TIM_UNIT_US: 1e-6, self.DIODM_TIM_UNIT_NS: 1e-9}[unit]
+        self.dm["period"] = clock * scale
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetStopTrg(self, id, dir, stop):
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmSetBuff(self, id, dir, buff, length, is_ring):
+        self.dm.update(buff=buff, length=length)
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmStart(self, id, dir):
+        with self.lock:
+            self.dm.update(running=True, last=time.time(), pointer=0, carry=0, rest=0.0)
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmStop(self, id, dir):
+        with self.lock:
+            self.dm["running"] = False
+        return self.DIO_ERR_SUCCESS
+
+    def DioDmGetWritePointerUserBuf(self, id, dir, pointer_ref, count_ref, carry_ref):
+        with self.lock:
+            pointer_ref._obj.value = self.dm["pointer"]
+            count_ref._obj.value = self.dm["carry"] * self.dm["length"] + self.dm["pointer"]
+            carry_ref._obj.value = self.dm["carry"]
+        return self.DIO_ERR_SUCCESS
+
+    def fill_buffer(self, now, value):
+        """
+        前回から経過した時間分のサンプルを取り込みバッファに書く
+        """
+        with self.lock:
+            dm = self.dm
+            if not dm or not dm["running"]:
+                return
+            samples = (now - dm["last"]) / dm["period"] + dm["rest"]
+            n, dm["rest"], dm["last"] = int(samples), samples - int(samples), now
+            for _ in range(n):
+                dm["buff"][dm["pointer"]] = value
+                dm["pointer"] += 1
+                if dm["pointer"] == dm["length"]:
+                    dm["pointer"] = 0
+                    dm["carry"] += 1
+
+
+class SimGPIO(Device):
+    """
+    RPi.GPIOの代わり　DHT11のピンだけを真似る
+    ピンを出力でLowにしたあと入力にすると、その時点の温湿度の信号を1サンプルずつ返す
+    """
+    BCM, OUT, IN, PUD_UP, LOW, HIGH = 11, 0, 1, 22, 0, 1
+
+    def __init__(self, profile, temp=25.0, temp_range=8.0, humi=60.0, failure_rate=0.1, sample_us=5, rng=None):
+        """
+        Args:
+            profile     : CloudProfile（時計だけを使う）
+            temp, temp_range: 平均気温と日較差（14時が最高）
+            humi        : 平均湿度（気温が高いほど低くなる）
+            failure_rate: 読み取りが失敗する確率
+            sample_us   : 1サンプルの時間（マイクロ秒）　実機のinput()1回分に相当する
+        """
+        super().__init__(0, 0, failure_rate, rng or random.Random())
+        self.profile = profile
+        self.temp = temp
+        self.temp_range = temp_range
+        self.humi = humi
+        self.sample_us = sample_us
+        self.level = self.HIGH
+        self.signal = []                                                # これから返すサンプル
+        self.pos = 0
+        self.ticks = 0                                                  # input()を呼ばれた回数（仮想の時計）
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def cleanup(self, *args):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None):
+        if mode == self.IN and self.level == self.LOW:                  # 開始信号のあとに入力にしたら送り始める
+            self.signal = self.make_signal()
+            self.pos = 0
+
+    def output(self, pin, value):
+        self.level = value
+
+    def input(self, pin):
+        self.ticks += 1
+        if self.pos < len(self.signal):
+            self.pos += 1
+            return self.signal[self.pos - 1]
+        return self.HIGH
+
+    def clock(self):
+        """
+        仮想の時計（ナノ秒）　input()1回をsample_usマイクロ秒と数える
+        DHT11のエッジの時刻はこれで測るので、Pythonの速さに関係なく実機と同じパルス幅になる
+        """
+        return int(self.ticks * self.sample_us * 1000)
+
+    def reading(self):
+        """
+        今の気温と湿度（DHT11の分解能にまるめる）
+        """
+        minutes = self.profile.minutes()
+        phase = math.cos((minutes - 14 * 60) / 1440 * 2 * math.pi)     # 14時に1、2時に-1
+        temp = self.temp + self.temp_range / 2 * phase + self.rng.uniform(-0.5, 0.5)
+        humi = self.humi - 10 * phase + self.rng.uniform(-2, 2)
+        return round(min(max(temp, 0), 50), 1), round(min(max(humi, 20), 90))
+
+    def make_signal(self):
+        """
+        DHT11の応答信号をサンプルの列にする
+        応答 Low 80us・High 80us、各ビット Low 50us のあとHigh 26～28us（0）か70us（1）
+        """
+        temp, humi = self.reading()
+        data = [humi, 0, int(temp), round(temp * 10) % 10]
+        data.append(sum(data) & 255)
+        bits = [b >> (7 - i) & 1 for b in data for i in range(8)]
+        if self.io_wait():                                              # 失敗させる
+            if self.rng.random() < 0.5:
+                bits = bits[:self.rng.randrange(1, 40)]                 # 途中で途切れる
+            else:
+                i = self.rng.randrange(32)                              # データのビットが化ける
+                bits[i] ^= 1
+        n = lambda us: max(int(round((us + self.rng.uniform(-2, 2)) / self.sample_us)), 1)
+        signal = [self.HIGH] * n(30) + [self.LOW] * n(80) + [self.HIGH] * n(80)
+        for bit in bits:
+            signal += [self.LOW] * n(50) + [self.HIGH] * n(70 if bit else 27)
+        signal += [self.LOW] * n(50)
+        return signal
+
+
+class SimADC():
+    """
+    MCP3004の代わり　channel(ch)がgpiozero.MCP3004と同じくvalue（0～1）を持つものを返す
+    晴れているほど太陽電池（ch0）の電圧が上がり、バッテリー（ch3）が充電されて電圧が少し上がる
+    """
+    def __init__(self, profile, battery_v=12.3, vref=5, divider=3.0, rng=None):
+        self.profile = profile
+        self.battery_v = battery_v
+        self.vref = vref
+        self.divider = divider
+        self.rng = rng or random.Random()
+        self.reads = 0
+
+    def channel(self, ch):
+        return SimADCChannel(self, ch)
+
+    def volts(self, ch):
+        """
+        そのチャンネルの今の入力電圧（V）
+        """
+        self.reads += 1
+        sun = 1 - self.profile.value(self.profile.minutes())            # 晴れ具合
+        if ch == 0:                                                     # 太陽電池（分圧後）
+            v = 18 * sun / self.divider
+        elif ch == 3:                                                   # バッテリー（分圧後）
+            v = (self.battery_v + 0.4 * (sun - 0.5)) / self.divider
+        else:
+            v = 0
+        return v + self.rng.gauss(0, 0.01)
+
+
+class SimADCChannel():
+    def __init__(self, adc, ch):
+        self.adc = adc
+        self.ch = ch
+
+    @property
+    def value(self):
+        return min(max(self.adc.volts(self.ch) / self.adc.vref, 0), 1)
+
+    def close(self):
+        pass
+
+
+class Simulator():
+    """
+    シミュレーターの一式　設定を読み、同じ台本を共有するSimCdioとSimGPIOを作る
+    """
+    def __init__(self, settings=None):
+        s = dict(DEFAULT_SETTINGS)
+        s.update(settings or {})
+        self.settings = s
+        rng = random.Random(int(s["seed"])) if s["seed"] else random.Random()
+        self.profile = CloudProfile.parse(s["profile"], float(s["speed"]))
+        self.cdio = SimCdio(self.profile,
+                            latency=float(s["latency_ms"]) / 1000,
+                            jitter=float(s["jitter_ms"]) / 1000,
+                            failure_rate=float(s["failure_rate"]),
+                            tick=float(s["tick_ms"]) / 1000,
+                            hold=float(s["hold_s"]),
+                            battery=[int(v) for v in s["battery"].split(",")],
+                            rng=random.Random(rng.random()))
+        self.gpio = SimGPIO(self.profile,
+                            temp=float(s["temp"]),
+                            temp_range=float(s["temp_range"]),
+                            humi=float(s["humi"]),
+                            failure_rate=float(s["dht_failure_rate"]),
+                            sample_us=float(s["sample_us"]),
+                            rng=random.Random(rng.random()))
+        self.adc = SimADC(self.profile, battery_v=float(s["battery_v"]), rng=random.Random(rng.random()))
+
+    @classmethod
+    def from_file(cls, filename=SETTINGS_FILE):
+        """
+        simulator.ini の[SIMULATOR]から設定を読む（なければ既定値）
+        """
+        parser = configparser.ConfigParser()
+        parser.read(filename, encoding="utf-8")
+        return cls(dict(parser["SIMULATOR"]) if parser.has_section("SIMULATOR") else {})
+
+    def stats(self):
+        """
+        呼び出しと失敗の回数など
+        """
+        return {"profile": self.settings["profile"],
+                "clock": minutes2hm(self.profile.minutes()),
+                "cloud": round(self.profile.value(self.profile.minutes()), 2),
+                "cdio_calls": self.cdio.calls, "cdio_failures": self.cdio.failures,
+                "dht_reads": self.gpio.calls, "dht_failures": self.gpio.failures, "adc_reads": self.adc.reads,
+                "in_byte": self.cdio.in_byte, "out_byte": self.cdio.out_byte}
+
+
+def hm2minutes(hm):
+    h, m = hm.split(":")
+    return int(h) * 60 + int(m)
+
+
+def minutes2hm(minutes):
+    return f"{int(minutes) // 60:02d}:{int(minutes) % 60:02d}"
+
+
+def minutes_of_day(dt):
+    return dt.hour * 60 + dt.minute + dt.second / 60
+
+
+def main():
+    """
+    実機のdht11とContecをシミュレーターで動かしてみる
+    """
+    import dht11
+    from myContec import Contec
+    sim = Simulator.from_file()
+    contec = Contec(driver=sim.cdio)
+    sensor = dht11.DHT11(pin=14, gpio=sim.gpio)
+    for _ in range(5):
+        result = sensor.read()
+        print(result.is_valid(), result.temperature, result.humidity, contec.input())
+        time.sleep(1)
+    print(sim.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import atexit
+import queue
+import threading
+
+"""
+書き込みの後回し（write-behind）
+センサー値の登録はキューに入れるだけですぐに戻り、書き込みスレッドが一定間隔でまとめて一つのトランザクションで書く
+SDカードではコミットのたびにfsyncが走るので、リクエストの応答時間がカードの速さに左右されなくなり、書き込み回数も減る
+キューの大きさには上限があり、いっぱいならば登録する側を待たせる（バックプレッシャー）
+失敗したまとまりは次回やり直し、やり直しも失敗したら半分ずつに分けて書き、1件でも書けないものは捨てる
+（書けない1件のために、そのあとの書き込みが全部止まらないように）
+"""
+
+
+class WriteBehind():
+    def __init__(self, write_batch, interval=1.0, max_pending=10000, max_batch=1000, put_timeout=10):
+        """
+        初期設定
+        Args:
+            write_batch: 溜まったもののリストを受け取り、一つのトランザクションで書き込む関数
+            interval   : 書き込む間隔（秒）
+            max_pending: キューに溜めておける最大数
+            max_batch  : これだけ溜まったら間隔を待たずに書き込む
+            put_timeout: キューがいっぱいのとき、空くのを待つ秒数　過ぎたらqueue.Full
+        """
+        self.write_batch = write_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.retry = []                                                 # 書き込みに失敗して次回やり直すもの
+        self.writing = []                                               # いま書き込んでいるもの
+        self.flush_lock = threading.Lock()                              # 書き込みは同時に一つだけ
+        self.wake = threading.Event()                                   # 間隔を待たずに書き込ませる
+        self.stopping = False
+        self.thread = None
+        self.written = 0                                                # 書き込んだ件数
+        self.batches = 0                                                # コミットした回数
+        self.errors = 0                                                 # 書き込みに失敗した回数
+        self.dropped = 0                                                # やり直しがあふれたか、書けなくて捨てた件数
+
+    def start(self):
+        """
+        書き込みスレッドを始める　終了時には残りを書き込む
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def put(self, item):
+        """
+        書き込むものをキューに入れる
+        Args:
+            item: write_batchに渡すリストの要素
+        """
+        self.queue.put(item, timeout=self.put_timeout)                  # いっぱいならば空くまで待つ
+        if self.queue.qsize() >= self.max_batch:
+            self.wake.set()
+
+    def run(self):
+        """
+        書き込みスレッド　一定間隔（または溜まったとき）にflushする
+        """
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        溜まっているものを今すぐ書き込む（呼んだスレッドで）
+        読み込みの前に呼べば、登録したばかりのデータも読める
+        Returns:
+            int: 書き込んだ件数
+        """
+        with self.flush_lock:
+            retried = bool(self.retry)                                  # 前回失敗したものを含むか
+            items = self.writing = self.retry                           # 取り出したものも書き込み待ちに数える
+            self.retry = []
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not items:
+                return 0
+            try:
+                self.write_batch(items)
+            except Exception as e:                                      # 失敗したら次回やり直す
+                self.errors += 1
+                if retried:                                             # やり直しも失敗したら分けて書く
+                    print(f"書き込みエラー　{len(items)}件を分けて書き込む　{e}")
+                    written = self.write_split(items)
+                    self.written += written
+                    return written
+                print(f"書き込みエラー　{len(items)}件を次回やり直す　{e}")
+                if len(items) > self.max_pending:                       # やり直しも上限を超えたら古いものから捨てる
+                    self.dropped += len(items) - self.max_pending
+                    items = items[-self.max_pending:]
+                self.retry = items
+                return 0
+            finally:
+                self.writing = []
+            self.written += len(items)
+            self.batches += 1
+            return len(items)
+
+    def write_split(self, items):
+        """
+        半分ずつに分けて書き込む　1件にしても書けないものはログに残して捨てる
+        Returns:
+            int: 書き込んだ件数
+        """
+        try:
+            self.write_batch(items)
+            self.batches += 1
+            return len(items)
+        except Exception as e:
+            if len(items) == 1:
+                self.dropped += 1
+                print(f"書き込めないので捨てる　{items[0]}　{e}")
+                return 0
+        half = len(items) // 2
+        return self.write_split(items[:half]) + self.write_split(items[half:])
+
+    def stop(self):
+        """
+        書き込みスレッドを止め、残りを書き込む
+        """
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=self.interval + 5)
+        self.flush()
+
+    def pending(self):
+        """
+        まだ書き込んでいない件数
+        """
+        return self.queue.qsize() + len(self.retry)
+
+    def pending_between(self, date_from, date_to):
+        """
+        期間内の日付の行がまだ書き込まれていないか（いま書き込んでいるものも含む）
+        要素は (テーブル名, 行のタプル) で、行の先頭が日付の文字列であること
+        Args:
+            date_from: 期間の始まり（日付の文字列）Noneならば始まりを限らない
+            date_to  : 期間の終わり（日付の文字列、両端を含む）
+        """
+        with self.queue.mutex:                                          # キューの中身をそのまま覗く
+            items = list(self.queue.queue)
+        items += list(self.retry) + list(self.writing)
+        return any((date_from is None or date_from <= row[0]) and row[0] <= date_to for table, row in items)
+
+    def stats(self):
+        """
+        書き込みの統計
+        """
+        return {"pending": self.pending(), "written": self.written, "batches": self.batches,
+                "errors": self.errors, "dropped": self.dropped}
@@ -32,16 +32,12 @@ let isReady = true;                 // 運転準備　プログラム内に運
 let isRun = false;                  // 起動中
 let isAuto = true;                  // 自動か各個か
 
-let isLightCnt = false;             // 光センサーを取得するだけか積算するか
-let isLED = false;                  // 育成LEDを光らせるか
-let lastIsLED = isLED;              // 一つ前の育成LED点灯状況
-let isForce = false;                // LEDを強制的にオンオフさせるか光センサーで制御するか
+let isLED = false;                  // 育成LEDが光っているか
 let mode = true                     // モード（自動／強制オン／強制オフ／手動操作中）
-let lastmode = false                // 1秒前のモード　モードが変わったらログを残す
-
-let sensing_time = "00:00";         // 次に光センサーの状態を取得する時刻
-const sensing_threshold = 0.5;      // ★ LEDを付けるか消すかのしきい値（5個×回数 に対する割合）
-let lightOnTime;                    // 育成LED点灯時刻　引き算をするのでdayjs形式
+let msgSeq = 0;                     // 制御ループから受け取り済みのメッセージ番号
+let isStreaming = false;            // プッシュ配信を受信できているか　できていなければポーリングする
+let graphTimer = null;              // グラフ描き直しの予約
+let shownLightLog = "";             // 表示中の光センサーログ
 
 let tab = "main";
 let lights = "○−○−○";
@@ -58,47 +54,20 @@ $(async function() {
     // 起動ボタンを押す
     $("#btnRun").on('click', function(){
         if (isAuto) {                           // 自動モードのみ起動可能　各個（手動）では動かない
-            isRun = true;
-            addMsg(time + "　起動しました");
-            showRunLamp(isRun);
-            getTimeMode();
+            setControl("run");
         };
     });
 
     // 停止ボタンを押す
     $("#btnStop").on('click', function(){
         if (isRun) {                            // 起動中のみ停止可能
-            isRun = false;
-            showRunLamp(isRun);
-            lastmode = "";                      // 起動ボタン押したときに時間モードを調べるためlastmodeの値をどのモードでもない値にする
-            addMsg(time + "　停止しました");
+            setControl("stop");
         };
     });
 
     // 自動手動　切り替え
     $("#swAuto").on('click', function(){
-        isAuto = !isAuto;
-        showState();
-        if (isAuto) {                   // 自動ならば
-            showLights(lights);
-            enpowerLED(isLED);
-            showLedLamp(isLED);
-            $("#mode").text(mode);
-            addMsg(time + "　自動に切り替えました");
-            showRunLamp(isRun);
-        } else {
-            isRun = false;              // 手動にしたら運転が落ちる
-            isLED = false;
-            showRunLamp(isRun);
-            enpowerLED(isLED);
-            showLedLamp(isLED);
-            addMsg(time + "　手動に切り替えました");
-            $("#mode").text("手動操作中");
-            $("#main_msg").removeClass("main_msg_ok");
-            $("#main_msg").addClass("main_msg_ng");
-            $("#main_msg").text("手動操作モードです　制御盤で自動に切り替え、起動ボタンを押してください");
-
-        }
+        setControl(isAuto ? "manual" : "auto");     // 手動にしたら運転が落ちる（サーバー側で）
     })
 
     // ランプ全点灯ボタンを押す（手動操作時のみ）
@@ -123,7 +92,7 @@ $(async function() {
     $("#btnLedOn").mousedown(function(){
         if (! isAuto) {
             $("#imgLedOn").attr("src", "static/images/btnRedOn.png");
-            enpowerLED(true);
+            setControl("led_on");
         }
     })
 
@@ -131,8 +100,7 @@ $(async function() {
     $("#btnLedOn").mouseup(function(){
         if (! isAuto) {
             $("#imgLedOn").attr("src", "static/images/btnRedOff.png");
-            enpowerLED(false);
-            showLedLamp(false);
+            setControl("led_off");
         }
     })
 
@@ -197,10 +165,9 @@ $(async function() {
         const del_date = dayjs(del_strdate).format("YYYY/MM/DD");                   // それをdayjsにし、再度年/月/日にする
         const isValid = (del_strdate==del_date);                                    // del_strdate と del_date は等しいかどうか
         if (isValid) {
-            msg = del_strdate + " 以前のデータを削除しました";
-            delDB(del_strdate);
+            msg = del_strdate + " 以前のデータの削除を始めました";
+            delDB(del_strdate);                                                     // 削除はサーバーのバックグラウンドで進む
             closePopupWindow();
-            getSummaryTable();
         } else {
             msg = del_strdate + " は有効な日付ではありません";
         };
@@ -251,9 +218,8 @@ async function do1st() {
     calcTime();                 // 時間を計算する
     clearLightMsg();
     getHumi(isHumiTry);
-    enpowerLED(false);
-    await getContec(isContecTry, isLightCnt);
-    showLights(lights);
+    await getControl();         // 制御ループの状態を取得する
+    startStream();              // 以降の変化はプッシュ配信で受け取る
     getSummaryTable();
     showSummaryGraph();
 }
@@ -285,21 +251,10 @@ async function showTime() {
     const s = now.second();
 
     // 毎秒実施
-    // 光センサーの状態を積算するかどうかの条件
-    const cond = isRun && (mode=="昼" || isNightSense);                 // 条件　運転中 かつ （昼間 もしくは夜でもセンシングする設定）
-    
-    // 条件かつ定期的にコンテック（光センサー＋バッテリー）を取得する
-    if (time >= sensing_time) {                                         // センサーを取得する時刻になったら
-        sensing_time = dayjs().add(sensing_interval, "minutes").format("HH:mm:30");     // 次に光センサーを取得する時刻
-        if (cond) {                                                     // 条件を満たしていたら
-            isLightCnt = true;                                          // 光センサー積算する
-        } else {                                                        // 条件を満たしていなかったら
-            isLightCnt = false;                                         // 積算しない
-        };
-    } else {                                                            // センサーを取得する時刻になっていなかったら
-        isLightCnt = false;                                             // 積算しない
-    };
-    getContec(isContecTry, isLightCnt);                                 // 以上の条件でコンテック取得する
+    // 光センサーの積算と点灯消灯の判断はサーバーの制御ループが行う　ここでは状態を表示するだけ
+    if (! isStreaming) {                                                // プッシュ配信が切れているときだけポーリングする
+        getControl();
+    }
 
 
     // 一定時間で温湿度を更新する
@@ -308,16 +263,10 @@ async function showTime() {
     }
 
 
-    // 起動中のみ時刻する機能
-    if (isAuto) {
-        //0時0分になったらあらためて1日分の記録を残し、暦を取得する
-        if (time=="00:00:00") {
-            addMsg(time+"　日付が変わった")
-            getEphem();
-        }
-
-        // 日の出などの時間による制御
-        getTimeMode();
+    //0時0分になったらあらためて暦を取得して表示する
+    if (time=="00:00:00") {
+        await getEphem();
+        calcTime();
     }
 
     // 10分に1回デイリーグラフを更新する
@@ -406,42 +355,225 @@ async function getSummaryTable() {
     });
 };
 
-// サマリーグラフ
+// サマリーグラフ　数値だけを受け取ってブラウザで描く
 async function showSummaryGraph() {
-    await $.ajax("/showSummaryGraph", {
+    await $.ajax("/getSummaryData", {
         type: "POST",
         data: {},
     }).done(function(data) {
         const dict = JSON.parse(data);
-        const light_b64 = dict["light_b64"];
-        const temp_b64 = dict["temp_b64"];
-        $("#graph_light").attr("src", light_b64);
-        $("#graph_temp").attr("src", temp_b64);
+        const labels = dict["date"].map(d => d.slice(5));              // yyyy/mm/dd から mm/dd にしてx軸とする
+        drawSummaryGraph("graph_temp", "最高・最低・平均気温（度）", labels,
+                        [{y: dict["max_temp"], color: "blue", width: 1, dash: [2, 3]},
+                         {y: dict["min_temp"], color: "blue", width: 1, dash: [2, 3]},
+                         {y: dict["mean_temp"], color: "blue", width: 2, dash: [], label: true}]);
+        drawSummaryGraph("graph_light", "日当たりのLED点灯時間（分）", labels,
+                        [{y: dict["lighting_minutes"], color: "orange", width: 2, dash: [], label: true}]);
         console.log("サマリーグラフ取得成功");
     }).fail(function() {
         console.log("サマリーグラフ取得失敗");
     });
 };
 
-// 一日グラフ
+// 一日グラフ　数値だけを受け取ってブラウザで描く
 async function showDairyGraph() {
-    await $.ajax("/showDairyGraph", {
+    await $.ajax("/getDailyData", {
         type: "POST",
         data: {},
     }).done(function(data) {
         const dict = JSON.parse(data);
-        const html = dict["html"];
-        const light_b64 = dict["light_b64"];
-        const temp_b64 = dict["temp_b64"];
-        $("#dailylog").html(html);
-        $("#dailylog_main").html(html);
-        $("#daily_light").attr("src", light_b64);
-        $("#daily_temp").attr("src", temp_b64);
+        drawDailyLight("daily_light", dict);
+        drawDailyTemp("daily_temp", dict);
     }).fail(function() {
         console.log("デイリーログ取得失敗");
     });
 };
 
+
+//////////////////////////////////////////////////////////////////////
+//    グラフ描画（canvas）
+//////////////////////////////////////////////////////////////////////
+const graphMargin = {left: 50, right: 15, top: 32, bottom: 28};     // グラフの余白（ピクセル）
+
+// canvasを消してタイトルを書き、描画範囲を返す
+function initGraph(id, title) {
+    const canvas = document.getElementById(id);
+    const ctx = canvas.getContext("2d");
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    ctx.font = "18px sans-serif";
+    ctx.fillStyle = "black";
+    ctx.textAlign = "center";
+    ctx.textBaseline = "alphabetic";
+    ctx.fillText(title, canvas.width/2, 22);
+    const area = {left: graphMargin.left, right: canvas.width - graphMargin.right,
+                  top: graphMargin.top, bottom: canvas.height - graphMargin.bottom};
+    return [ctx, area];
+}
+
+// 値の範囲 [v0, v1] を画素の範囲 [p0, p1] に写す関数
+function scale(v0, v1, p0, p1) {
+    const k = (v1 == v0) ? 0 : (p1 - p0)/(v1 - v0);
+    return v => p0 + (v - v0)*k;
+}
+
+// 縦軸の範囲と目盛（値のリストからきりのよい数で）
+function niceRange(values) {
+    const vs = values.filter(v => v != null);
+    let lo = vs.length ? Math.min(...vs) : 0;
+    let hi = vs.length ? Math.max(...vs) : 1;
+    if (hi == lo) {                                                     // 値が一つしかなければ上下に幅を持たせる
+        lo -= 1;
+        hi += 1;
+    }
+    const raw = (hi - lo)/4;
+    const mag = Math.pow(10, Math.floor(Math.log10(raw)));
+    const step = [1, 2, 5, 10].map(m => m*mag).find(v => v >= raw);    // 目盛はおよそ4～5本
+    lo = Math.floor(lo/step)*step;
+    hi = Math.ceil(hi/step)*step;
+    const ticks = [];
+    for (let v=lo; v<=hi+step/2; v+=step) {
+        ticks.push(Math.round(v*1000)/1000);
+    }
+    return [lo, hi, ticks];
+}
+
+// 左と下の軸、目盛、目盛ラベルを描く　xTicksは [画素, ラベル] のリスト
+function drawAxes(ctx, area, xTicks, yTicks, sy) {
+    ctx.strokeStyle = "black";
+    ctx.lineWidth = 1;
+    ctx.setLineDash([]);
+    ctx.beginPath();
+    ctx.moveTo(area.left, area.top);
+    ctx.lineTo(area.left, area.bottom);
+    ctx.lineTo(area.right, area.bottom);
+    ctx.stroke();
+    ctx.font = "16px sans-serif";
+    ctx.fillStyle = "black";
+    ctx.textAlign = "center";
+    ctx.textBaseline = "top";
+    for (const [px, label] of xTicks) {
+        ctx.fillText(label, px, area.bottom + 6);
+    }
+    ctx.textAlign = "right";
+    ctx.textBaseline = "middle";
+    for (const v of yTicks) {
+        ctx.fillText(v, area.left - 6, sy(v));
+    }
+}
+
+// "HH:MM" を0時からの分にする
+function hm2minutes(hm) {
+    const [h, m] = hm.split(":");
+    return Number(h)*60 + Number(m);
+}
+
+// 一日グラフの共通部分　夜の背景と現在時刻の赤線、3時間ごとの目盛
+function drawDay(ctx, area, dict, sy, yTicks) {
+    const sx = scale(0, 24*60-1, area.left, area.right);
+    ctx.fillStyle = "rgba(128, 128, 128, 0.3)";
+    if (dict["sunrise"] != null) {                                      // 日の出前の夜
+        ctx.fillRect(sx(0), area.top, sx(hm2minutes(dict["sunrise"])) - sx(0), area.bottom - area.top);
+    }
+    if (dict["sunset"] != null) {                                       // 日の入り後の夜
+        ctx.fillRect(sx(hm2minutes(dict["sunset"])), area.top, area.right - sx(hm2minutes(dict["sunset"])), area.bottom - area.top);
+    }
+    const xTicks = [];
+    for (let h=0; h<24; h+=3) {
+        xTicks.push([sx(h*60), String(h).padStart(2, "0")]);
+    }
+    drawAxes(ctx, area, xTicks, yTicks, sy);
+    if (dict["now"] != null) {                                          // 今日ならば現在時刻に赤線
+        ctx.strokeStyle = "red";
+        ctx.lineWidth = 1;
+        ctx.beginPath();
+        ctx.moveTo(sx(dict["now"]), area.top);
+        ctx.lineTo(sx(dict["now"]), area.bottom);
+        ctx.stroke();
+    }
+    return sx;
+}
+
+// 温度の一日グラフ
+function drawDailyTemp(id, dict) {
+    const mean_temp = dict["mean_temp"];
+    const [ctx, area] = initGraph(id, dict["date"] + "の気温 平均" + mean_temp + "度");
+    const [lo, hi, yTicks] = niceRange(dict["temp"].map(p => p[1]));
+    const sy = scale(lo, hi, area.bottom, area.top);
+    const sx = drawDay(ctx, area, dict, sy, yTicks);
+    if (mean_temp != null) {                                            // 平均気温の点線
+        ctx.strokeStyle = "blue";
+        ctx.lineWidth = 1;
+        ctx.setLineDash([2, 3]);
+        ctx.beginPath();
+        ctx.moveTo(area.left, sy(mean_temp));
+        ctx.lineTo(area.right, sy(mean_temp));
+        ctx.stroke();
+        ctx.setLineDash([]);
+    }
+    ctx.strokeStyle = "blue";                                           // 気温の線
+    ctx.lineWidth = 2;
+    ctx.beginPath();
+    dict["temp"].forEach(([m, t], i) => {
+        if (i == 0) {
+            ctx.moveTo(sx(m), sy(t));
+        } else {
+            ctx.lineTo(sx(m), sy(t));
+        }
+    });
+    ctx.stroke();
+}
+
+// 点灯状態の一日グラフ　点灯していた区間を塗りつぶす
+function drawDailyLight(id, dict) {
+    const [ctx, area] = initGraph(id, dict["date"] + "の点灯時間 合計" + dict["lighting_minutes"] + "分");
+    const sy = scale(0, 1, area.bottom, area.top);
+    const sx = drawDay(ctx, area, dict, sy, [0, 0.5, 1]);
+    ctx.fillStyle = "orange";
+    for (const [from, to] of dict["light"]) {
+        ctx.fillRect(sx(from), area.top, sx(to) - sx(from), area.bottom - area.top);
+    }
+}
+
+// サマリーグラフ　日付ごとの折れ線　labelがある線には値を表示する
+function drawSummaryGraph(id, title, labels, series) {
+    const [ctx, area] = initGraph(id, title);
+    const [lo, hi, yTicks] = niceRange(series.flatMap(s => s.y));
+    const sy = scale(lo, hi, area.bottom, area.top);
+    const sx = scale(-0.5, Math.max(labels.length - 0.5, 0.5), area.left, area.right);
+    drawAxes(ctx, area, labels.map((label, i) => [sx(i), label]), yTicks, sy);
+    for (const s of series) {
+        ctx.strokeStyle = s.color;
+        ctx.fillStyle = s.color;
+        ctx.lineWidth = s.width;
+        ctx.setLineDash(s.dash);
+        ctx.beginPath();
+        let pen = false;                                                // 値のない日は線を切る
+        s.y.forEach((v, i) => {
+            if (v == null) {
+                pen = false;
+            } else if (pen) {
+                ctx.lineTo(sx(i), sy(v));
+            } else {
+                ctx.moveTo(sx(i), sy(v));
+                pen = true;
+            }
+        });
+        ctx.stroke();
+        ctx.setLineDash([]);
+        if (s.label) {                                                  // 点と値を表示する
+            ctx.font = "16px sans-serif";
+            ctx.textAlign = "left";
+            ctx.textBaseline = "bottom";
+            s.y.forEach((v, i) => {
+                if (v != null) {
+                    ctx.fillRect(sx(i) - 2, sy(v) - 2, 4, 4);
+                    ctx.fillText(v, sx(i), sy(v) - 4);
+                }
+            });
+        }
+    }
+}
+
 //////////////////////////////////////////////////////////////////////
 //    温湿度
 //////////////////////////////////////////////////////////////////////
@@ -450,118 +582,158 @@ async function getHumi(isTry) {
         type: "post",
         data: {"isTry": isTry},                 // テストか本番かのbool値をisTryとして送る
     }).done(function(data) {
-        const dict = JSON.parse(data);
-        if (dict["temp"] != "N/A") {            // センサー値取得できていたら
-            temp = dict["temp"];
-            humi = dict["humi"];
-            imgB64 = dict["imgB64"]
-            $("#temp").text(temp + "℃");
-            $("#humi").text(humi + "％");
-            $("#daily_temp").attr("src", imgB64);
-            addMsg(time + "　温湿度更新");
-        } else {                                // センサー値取得できなかったら
-            console.log("温湿度　センサー失敗");
+        if (! isStreaming) {                    // プッシュ配信を受けていればそちらで表示する
+            showHumi(JSON.parse(data));
         }
     }).fail(function() {                        // ajaxのリターン失敗したら更新しない
         console.log("温湿度　通信失敗");
     });
 }
 
+// 温湿度を表示する
+function showHumi(dict) {
+    if (dict["temp"] != "N/A") {                // センサー値取得できていたら
+        temp = dict["temp"];
+        humi = dict["humi"];
+        $("#temp").text(temp + "℃");
+        $("#humi").text(humi + "％");
+        showDairyGraph();                       // デイリーグラフを描き直す
+        addMsg(time + "　温湿度更新");
+    } else {                                    // センサー値取得できなかったら
+        console.log("温湿度　センサー失敗");
+    }
+}
+
 
 
 //////////////////////////////////////////////////////////////////////
-//    コンテック
+//    制御ループ（コンテック＋育成LED）
 //////////////////////////////////////////////////////////////////////
-async function getContec(isTry, isLightCnt) {
-    let msg = "";
-    await $.ajax("/getContec", {
+// 制御ループの状態を取得する
+async function getControl() {
+    await $.ajax("/getControl", {
         type: "post",
-        data: {"isTry": isTry,                                          // テストか本番かのbool値をisTryとして、
-               "isLightCnt": isLightCnt},                               // 光センサーを取得するだけか積算するかをisLightCntとして送る
+        data: {"since": msgSeq},                                        // 受け取り済みのメッセージ番号
     }).done(function(data) {
-        const dict = JSON.parse(data);
-        try {                                                           // センサー値取得できていたら
-            // 電圧リレーの状態
-            const volt_status = dict["volt"];                           // コンテックの電圧
-            if (volt_status == "青" ) {                                  // 「青」ならば
-                $(".batt_blue").css("visibility","visible");            // グラフの青バーを表示
-                $(".batt_green").css("visibility","visible");           // グラフの緑バーを表示
-            } else if (volt_status == "緑") {                            // 「緑」ならば
-                $(".batt_blue").css("visibility","hidden");             // グラフの青バーを非表示
-                $(".batt_green").css("visibility","visible");           // グラフの緑バーを表示
-            } else {                                                    // いずれでもなければ
-                $(".batt_blue").css("visibility","hidden");             // グラフの青バーを非表示
-                $(".batt_green").css("visibility","hidden");            // グラフの緑バーを非表示
-            };                                                          // つまり、グラフの黄色バーは消えない（0の判定はない）
-
-            // 光センサーの状態
-            showLights(dict["log"]);                                    // 制御盤のランプを点灯させる
-            if (isLightCnt) {                                           // 光センサー積算する設定ならば
-                if (dict["light_cnt"]==0) {                             // 0回目で
-                    clearLightMsg();                                    // メッセージをクリアする
-                }
-                const lightlog = dict["log"].slice(0,5);                // コンテックの光センサー＋バッテリーから光センサーを切り出す
-                msg = time + "　#" + (dict["light_cnt"]+1) + "　" + lightlog;
-                addLightLog(msg);
-
-                const th = 5*sensing_count*sensing_threshold;
-                if (dict["light_cnt"] == sensing_count-1) {                     // 指定した回数だけセンサー値を測定したら
-                    addLightLog("曇りのカウント" + dict["light_sum"] + "　　しきい値" + th);
-                    if (dict["light_sum"] < th) {                               // 点灯消灯判断　しきい値未満ならば
-                        isLED = false;                                          // 消灯にする
-                        if (lastIsLED) {                                        // さっきまで点灯していたら
-                            msg = "十分明るいので消灯します";
-                            const lightSeconds = dayjs().diff(lightOnTime, "seconds") + 5;  // lightOnTimeから今までの時間（秒） 念のため5秒プラスしておく
-                            const lightMinutes = Math.trunc(lightSeconds/60);               // 秒を分にする
-                            msg += "　点灯時間 " + lightMinutes + "分";
-                            addMsg(time + "　" + msg);
-                            writeDB("LED", lightMinutes);
-                        } else {                                                // さっきまでも消灯していたら
-                            msg = "消灯を継続します";
-                            addMsg(time + "　" + msg);
-                        };
-                    } else {                                                    // しきい値以上ならば
-                        if (volt_status == "青" || volt_status == "緑") {             // コンテックの電圧が青か緑ならば
-                            isLED = true;                                           // 点灯にする
-                            if (lastIsLED) {                                        // さっきまでも点灯していたら
-                                msg = "点灯を継続します";
-                                addMsg(time + "　" + msg);
-                            } else {                                                // さっきまで消灯していたら
-                                msg = "暗いので点灯します";
-                                lightOnTime = dayjs();                              // 点灯開始時刻
-                                addMsg(time + "　" + msg);
-                            };
-                        } else {                                                    // 電圧が黄色ならば
-                            isLED = false;                                          // 消灯にする
-                            if (lastIsLED) {                                        // さっきまで点灯していたら
-                                const lightSeconds = dayjs().diff(lightOnTime, "seconds") + 2;  // lightOnTimeから今までの時間（秒） 念のため2秒プラスしておく
-                                const lightMinutes = Math.trunc(lightSeconds/60);               // 秒を分にする
-                                writeDB("LED", lightMinutes);
-                                //msg = "バッテリーが不足気味なので消灯します"
-                                msg = "消灯します"
-                                msg += "　点灯時間 " + lightMinutes + "分";
-                                addMsg(time + "　" + msg);
-                            } else {                                                // さっきまでも消灯していたら
-                                //msg = "バッテリーが不足気味で消灯を継続します"
-                                msg = "消灯を継続します"
-                                addMsg(time + "　" + msg);
-                            };
-                        };
-                    };
-                    addLightLog(msg);
-                    lastIsLED = isLED;
-                    enpowerLED(isLED);
-                };
-            };
-        } catch(e) {                            // センサー値取得できなかったら
-            console.log("コンテック　データ失敗");
-            console.log(e);
-        };
+        showControl(JSON.parse(data));
     }).fail(function() {                        // ajaxのリターン失敗したら
-        console.log("コンテック　通信失敗");
+        console.log("制御ループ　通信失敗");
+    });
+};
+
+// 制御盤の操作を制御ループに送る
+async function setControl(action) {
+    await $.ajax("/setControl", {
+        type: "post",
+        data: {"action": action,                                        // run/stop/auto/manual/led_on/led_off
+               "since": msgSeq},
+    }).done(function(data) {
+        showControl(JSON.parse(data));
+    }).fail(function() {
+        console.log("制御盤操作　通信失敗");
     });
 };
 
+// 制御ループの状態を表示する
+function showControl(dict) {
+    // 電圧リレーの状態
+    const volt_status = dict["volt"];                                   // コンテックの電圧
+    if (volt_status == "青" ) {                                          // 「青」ならば
+        $(".batt_blue").css("visibility","visible");                    // グラフの青バーを表示
+        $(".batt_green").css("visibility","visible");                   // グラフの緑バーを表示
+    } else if (volt_status == "緑") {                                    // 「緑」ならば
+        $(".batt_blue").css("visibility","hidden");                     // グラフの青バーを非表示
+        $(".batt_green").css("visibility","visible");                   // グラフの緑バーを表示
+    } else {                                                            // いずれでもなければ
+        $(".batt_blue").css("visibility","hidden");                     // グラフの青バーを非表示
+        $(".batt_green").css("visibility","hidden");                    // グラフの緑バーを非表示
+    };                                                                  // つまり、グラフの黄色バーは消えない（0の判定はない）
+
+    // 光センサーの状態
+    if (dict["log"] != "") {
+        showLights(dict["log"]);                                        // 制御盤のランプを点灯させる
+    }
+    const lightLog = dict["light_log"].join("<br>");
+    if (lightLog != shownLightLog) {                                    // 光センサーログが変わっていたら表示しなおす
+        clearLightMsg();
+        dict["light_log"].forEach(addLightLog);
+        shownLightLog = lightLog;
+    }
+
+    // 育成LEDの状態
+    if (dict["is_led"] != isLED) {                                      // 点灯消灯が変わったらデイリーグラフを描き直す
+        showDairyGraph();
+    }
+    isLED = dict["is_led"];
+    $("#imgLed").attr("src", "static/images/" + (isLED ? "led_on.png" : "led_off.png"));
+    showLedLamp(isLED);
+
+    // 起動・自動の状態
+    const changed = (dict["is_run"] != isRun) || (dict["is_auto"] != isAuto);
+    isRun = dict["is_run"];
+    isAuto = dict["is_auto"];
+    if (changed) {
+        showState();
+        showRunLamp(isRun);
+        if (! isAuto) {
+            $("#main_msg").removeClass("main_msg_ok");
+            $("#main_msg").addClass("main_msg_ng");
+            $("#main_msg").text("手動操作モードです　制御盤で自動に切り替え、起動ボタンを押してください");
+        }
+    }
+    mode = isAuto ? dict["mode"] : "手動操作中";
+    $("#mode").text(mode);
+
+    // 制御ループのメッセージ　ポーリングとプッシュで重ならないよう番号で判断する
+    for (const [seq, txt] of dict["messages"]) {
+        if (seq > msgSeq) {
+            addMsg(txt);
+        }
+    }
+    msgSeq = Math.max(msgSeq, dict["seq"]);
+};
+
+
+//////////////////////////////////////////////////////////////////////
+//    プッシュ配信（Server-Sent Events）
+//////////////////////////////////////////////////////////////////////
+function startStream() {
+    if (! window.EventSource) {                                         // 使えないブラウザはポーリングのまま
+        return;
+    }
+    const es = new EventSource("/stream");
+    es.onopen = function() {
+        isStreaming = true;
+        console.log("プッシュ配信　接続");
+    };
+    es.onerror = function() {                                           // 切れたらブラウザが自動でつなぎ直す　その間はポーリング
+        isStreaming = false;
+        console.log("プッシュ配信　切断");
+    };
+    es.addEventListener("control", function(e) {                        // 制御ループの状態
+        showControl(JSON.parse(e.data));
+    });
+    es.addEventListener("humi", function(e) {                           // 温湿度
+        showHumi(JSON.parse(e.data));
+    });
+    es.addEventListener("graph", function(e) {                          // データが変わった
+        redrawGraphs();
+    });
+}
+
+// グラフを描き直す　続けて届いた知らせは1秒分まとめる
+function redrawGraphs() {
+    if (graphTimer != null) {
+        return;
+    }
+    graphTimer = setTimeout(function() {
+        graphTimer = null;
+        showDairyGraph();
+        showSummaryGraph();
+        getSummaryTable();
+    }, 1000);
+}
+
 // 光センサーの状態を表示する関数
 function showLights(txt) {
     const arr = txt.split("");
@@ -577,37 +749,6 @@ function showLights(txt) {
 };
 
 
-// 育成LEDを光らせる
-async function enpowerLED(flag) {
-    let img = "static/images/";
-    let color = "";
-    let isOn = 0;
-    if (flag) {
-        img += "led_on.png";
-        color = "red";
-        isOn = 1;
-    } else {
-        img += "led_off.png";
-        color = "gray";
-        isOn = 0;
-    }
-    $("#imgLed").attr("src", img);
-    $("#lamp_led").css("color", color);
-    console.log("isOn=" + isOn);
-    await $.ajax("/enpowerLED", {
-        type: "post",
-        data: { "isOn": isOn,
-                "isTry": isLEDTry},
-        }).done(function(data) {
-            const dict = JSON.parse(data);
-            const imgB64 = dict["imgB64"];
-            $("#daily_light").attr("src", imgB64);       // 点灯時間のデイリーグラフ
-    }).fail(function() {
-        console.log("LED失敗");
-    });
-}
-
-
 // フラグの状態を表示する関数
 function showState() {
     var strAuto = "";
@@ -679,68 +820,6 @@ function calcTime() {
 }
 
 
-async function getTimeMode() {
-    getNow();
-    let msg = ""
-    const now = time.slice(0, 5)            // HH:mm:ss を HH:mm にする
-    // 現在がどの時刻モードかを調べる　これは毎秒おこなう必要がある
-    switch (true) {                         // ここは優先順位として大きい値から判断していく
-        case now >= evening_end:            // 日の入り以降は強制OFF
-            mode = "夜";
-            break;
-        case now >= evening_start:          // 日の入り1.5H前以降は強制ON
-            mode = "夕方";
-            break;
-        case now >= morning_end:            // 日の出1.5H後以降は自動制御
-            mode = "昼";
-            break;
-        case now >= morning_start:          // 日の出以降は強制ON
-            mode = "朝";
-            break;
-        default:                            // それ以前（0時以降）は強制OFF
-            mode = "夜";
-    };
-
-    // LED制御を変更する
-    let cond;
-    if (isRun) {                            // 運転中だったら
-        if (mode != lastmode) {             // 時刻モードが変わったら
-            cond = true;                    // モードチェンジの条件オン
-        } else {                            // さもなくば
-            cond = false;                   // モードチェンジの条件オフ
-        };
-        lastmode = mode;                    // モードを覚えておく
-    } else {                                // 運転中でなかったら
-        lastmode = "";                      // 先刻のモードをどれでもないものにする（起動がかかったときモード取得するため）
-        cond = false;                       // モードチェンジの条件オフ
-    };
-    if (cond) {                             // 条件を満たしてたら
-        lastmode = mode;
-        switch (mode) {
-            case "夜":
-                isForce = true;
-                isLED = false;
-                break;
-            case "夕方":
-                isForce = true;
-                isLED = true;
-                break;
-            case "昼":
-                isForce = false;
-                break;
-            case "朝":
-                isForce = true;
-                isLED = true;
-                break;
-        };
-        msg = time + "　モード変更　" + mode;
-        addMsg(msg);
-        enpowerLED(isLED);                          // 育成LEDを制御する
-    }
-    $("#mode").text(mode);
-}
-
-
 //////////////////////////////////////////////////////////////////////
 //    データベース
 //////////////////////////////////////////////////////////////////////
@@ -818,7 +897,6 @@ async function getConfig() {
         $("#cumsum_year").val(cumsum_year);
         $("#cumsum_month").val(cumsum_month);
         $("#cumsum_day").val(cumsum_day);
-        sensing_time = dayjs().add(1, "minutes").format("HH:mm:30");    // 次に光センサーを取得する時刻
         console.log("設定ファイル取得成功");
     }).fail(function() {
         console.log("設定ファイル取得失敗");
@@ -866,13 +944,6 @@ async function setConfig() {
         console.log("設定ファイル変更失敗");
     });
 
-    if (isNightSense) {                     // 夜でもセンシングする設定ならば1分後に測定する
-        sensing_time = sensing_time = dayjs().add(1, "minutes").format("HH:mm:30");
-    } else {                                // 夜はセンシングしない設定ならば
-        lastmode = ""                       // ラストモードをリセットすることで
-        getTimeMode();                      // 強制的に時間モードを変更する（元に戻す）
-    }
-
     morning_offset = dict["morning_offset"];
     evening_offset = dict["evening_offset"];
     morning_minutes = dict["morning_minutes"];
@@ -893,7 +964,8 @@ async function delDB(date) {
         type: "POST",
         data: {"date": date},
     }).done(function(data) {
-        console.log("データベース削除成功");
+        console.log("データベース削除開始");
+        watchPurge();
     }).fail(function(e) {
         console.log("データベース削除失敗");
         console.log(e);
@@ -901,6 +973,27 @@ async function delDB(date) {
 };
 
 
+// データベース削除の進み具合を終わるまで1秒ごとに確認する
+async function watchPurge() {
+    await $.ajax("/getPurgeProgress", {
+        type: "POST",
+    }).done(function(data) {
+        const dict = JSON.parse(data);
+        if (dict["state"] == "running") {
+            $("#del_result").text(`${dict["date"]} 以前のデータを削除中 ${dict["percent"]}%`);
+            setTimeout(watchPurge, 1000);
+        } else {
+            const msg = (dict["state"] == "error") ? `削除に失敗しました ${dict["error"]}` : `${dict["date"]} 以前のデータを削除しました`;
+            $("#del_result").text(msg);
+            getSummaryTable();
+        };
+    }).fail(function(e) {
+        console.log("削除の進み具合取得失敗");
+        console.log(e);
+    });
+};
+
+
 // PythonでOSの時刻を変更する関数
 async function setClock(set_time) {
     await $.ajax("/setClock", {
@@ -0,0 +1,46 @@
+import datetime
+from myDatabase import DB
+
+"""
+古いデータの削除（Retention）がアーカイブ（.npz）の行も消すことの確認
+    python -m pytest test_retention.py
+"""
+
+
+def test_purge_removes_archived_rows(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)                                         # archive/ は一時ディレクトリに作る
+    db = DB(str(tmp_path / "agri.db"))
+    try:
+        month = (datetime.date.today() - datetime.timedelta(days=120)).strftime("%Y/%m")
+        with db.pool.connection() as conn:
+            for day in range(1, 4):
+                strdt = f"{month}/{day:02d} 12:00"
+                epoch = int(datetime.datetime.strptime(strdt, "%Y/%m/%d %H:%M").timestamp())
+                conn.execute("INSERT INTO temperature(date, datetime, temperature, humidity, epoch)"
+                             " VALUES(?, ?, ?, ?, ?)", (strdt[:10], strdt, 20.0 + day, 60.0, epoch))
+                conn.execute("INSERT INTO light(date, datetime, value, epoch) VALUES(?, ?, ?, ?)",
+                             (strdt[:10], strdt, 1, epoch))
+            conn.commit()
+
+        moved = db.archive_old(90)
+        assert moved["temperature"] == 3
+        stray = tmp_path / "archive" / f"temperature_{month.replace('/', '-')}.tmp.npz"
+        stray.write_bytes(b"")                                          # 書き込みが中断されて残った一時ファイル
+        assert db.archive.months("temperature") == [month]
+        date_from, date_to = f"{month}/01", f"{month}/31"
+        with db.pool.connection() as conn:
+            assert len(db.raw_rows(conn, "temperature", ["datetime", "temperature"], date_from, date_to)) == 3
+
+        db.purge(date_to)
+        db.retention.thread.join(timeout=30)
+        progress = db.retention.progress()
+        assert progress["state"] == "done"
+        assert progress["archive_deleted"] == 6
+
+        with db.pool.connection() as conn:
+            assert db.raw_rows(conn, "temperature", ["datetime", "temperature"], date_from, date_to) == []
+            assert db.raw_rows(conn, "light", ["datetime", "value"], date_from, date_to) == []
+        assert db.archive.months("temperature") == []
+        assert db.archived_before == ""
+    finally:
+        db.close()